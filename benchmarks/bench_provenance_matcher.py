@@ -0,0 +1,92 @@
+"""
+Benchmark the provenance matcher against the previous difflib longest-match on real retrieved chunks.
+
+It replays the chunks of a `guess_output.jsonl` written by a kilt_score run of `eval_parrot_kilt`,
+whose texts are read by their chunk_hash from the result store of the run, `results` next to it by default,
+against the gold paragraphs read from the paragraph snapshot of the same run, e.g.:
+
+    python benchmarks/bench_provenance_matcher.py \
+        --guess outputs/kilt/kilt_parrot_evaluation_res/guess_output.jsonl \
+        --gold datasets/kilt_data/hotpotqa-dev-kilt.jsonl \
+        --snapshot datasets/kilt_snapshot/hotpotqa-dev-200.sqlite
+"""
+import argparse
+import difflib
+import json
+import os
+import time
+
+from evalparrot.metric.utils.dataset.kilt_data import get_src_context_2_id
+from evalparrot.metric.utils.dataset.paragraph_snapshot import ParagraphSnapshot
+from evalparrot.metric.utils.dataset.provenance_matcher import ProvenanceMatcher
+from evalparrot.metric.utils.result_store import read_chunk_texts
+
+
+def difflib_match(chunk_context, content_2_wikipedia_id, score_threshold=30):
+    best_wikipedia_id = None
+    max_score = 0
+    for context, wikipedia_id in content_2_wikipedia_id.items():
+        matcher = difflib.SequenceMatcher(None, context, chunk_context)
+        score = matcher.find_longest_match(0, len(context), 0, len(chunk_context)).size
+        if score > max_score and score > score_threshold:
+            max_score = score
+            best_wikipedia_id = wikipedia_id
+    return best_wikipedia_id, max_score
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guess', required=True)
+    parser.add_argument('--gold', required=True)
+    parser.add_argument('--snapshot', required=True)
+    parser.add_argument('--store-dir', default=None,
+                        help='the result store of the run, default is results next to --guess.')
+    parser.add_argument('--score_threshold', type=int, default=30)
+    args = parser.parse_args()
+
+    with open(args.guess, 'r') as f:
+        guess_list = [json.loads(line) for line in f]
+    guess_ids = {guess['id'] for guess in guess_list}
+    with open(args.gold, 'r') as f:
+        gold_id_2_dict = {gold['id']: gold for gold in map(json.loads, f) if gold['id'] in guess_ids}
+    ks = ParagraphSnapshot(args.snapshot)
+    store_dir = args.store_dir or os.path.join(os.path.dirname(args.guess), 'results')
+    chunk_hash_2_text = read_chunk_texts(store_dir, {provenance['meta']['chunk_hash'] for guess in guess_list
+                                                     for provenance in guess['output'][0]['provenance']})
+
+    queries = []
+    for guess in guess_list:
+        content_2_wikipedia_id = get_src_context_2_id(gold_id_2_dict[guess['id']], ks=ks)
+        chunks = [chunk_hash_2_text[provenance['meta']['chunk_hash']].strip()
+                  for provenance in guess['output'][0]['provenance']]
+        queries.append((content_2_wikipedia_id, chunks))
+    chunk_num = sum(len(chunks) for _, chunks in queries)
+
+    t0 = time.time()
+    difflib_results = [difflib_match(chunk, content_2_wikipedia_id, args.score_threshold)
+                       for content_2_wikipedia_id, chunks in queries for chunk in chunks]
+    difflib_time = time.time() - t0
+
+    t0 = time.time()
+    matcher_results = []
+    for content_2_wikipedia_id, chunks in queries:
+        matcher = ProvenanceMatcher(content_2_wikipedia_id, score_threshold=args.score_threshold)
+        for chunk in chunks:
+            wikipedia_id, _, score = matcher.match(chunk)
+            matcher_results.append((wikipedia_id, score))
+    matcher_time = time.time() - t0
+
+    same_id_num = sum(d[0] == m[0] for d, m in zip(difflib_results, matcher_results))
+    higher_score_num = sum(m[1] > d[1] for d, m in zip(difflib_results, matcher_results))
+    print(f'{len(queries)} queries, {chunk_num} chunks')
+    print(f'difflib: {difflib_time:.3f} s, {chunk_num / difflib_time:.1f} chunks/s')
+    print(f'matcher: {matcher_time:.3f} s, {chunk_num / matcher_time:.1f} chunks/s, '
+          f'speedup = {difflib_time / matcher_time:.1f}x')
+    print(f'same wikipedia_id: {same_id_num}/{chunk_num}')
+    # difflib's autojunk heuristic ignores popular characters in chunks longer than 200,
+    # so its longest match is a lower bound of the exact one.
+    print(f'matcher found a longer common substring: {higher_score_num}/{chunk_num}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import pytest
+
+from evalparrot.testing import StubParrotServer
+
+
+@pytest.fixture(scope='session')
+def stub_parrot():
+    # a few milliseconds per request, so that the concurrency of evalparrot matters as it does with a real parrot
+    with StubParrotServer(search_latency=0.005, upsert_latency=0.005, latency_jitter=0.5) as server:
+        yield server
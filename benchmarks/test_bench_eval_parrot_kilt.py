@@ -0,0 +1,74 @@
+"""
+Benchmark the end-to-end and per-stage throughput of `eval_parrot_kilt` without parrot, milvus or the kilt mongo,
+against the bundled stub parrot server and a synthetic kilt fixture, e.g.:
+
+    pip install pytest-benchmark
+    pytest benchmarks --benchmark-columns=mean,min,max --benchmark-group-by=func
+"""
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from evalparrot import eval_parrot_kilt
+from evalparrot.testing import build_synthetic_kilt_fixture
+
+QUERY_NUM_LIST = [10, 50, 200]
+
+
+def _record_stage_throughput(benchmark, eval_result, query_num):
+    benchmark.extra_info['query_num'] = query_num
+    for stage_name, stage in eval_result['timing']['stages'].items():
+        benchmark.extra_info[f'{stage_name}_wall_time'] = stage['wall_time']
+        if stage['wall_time'] > 0:
+            benchmark.extra_info[f'{stage_name}_queries_per_second'] = query_num / stage['wall_time']
+    for call_name, latency in eval_result['timing']['latency'].items():
+        benchmark.extra_info[f'{call_name}_latency_p99'] = latency.get('p99')
+
+
+@pytest.fixture
+def kilt_fixture(tmp_path, monkeypatch):
+    # eval_parrot_kilt reads and writes under the working dir, ./datasets/kilt_data and ./outputs/kilt
+    monkeypatch.chdir(tmp_path)
+
+    def build(query_num):
+        return build_synthetic_kilt_fixture('./datasets/kilt_data', 'hotpotqa', query_num=query_num)
+
+    return build
+
+
+@pytest.mark.parametrize('query_num', QUERY_NUM_LIST)
+def test_eval_parrot_kilt_cold(benchmark, stub_parrot, kilt_fixture, query_num):
+    """A first run: the corpus is ingested again and every query is searched."""
+    knowledge_source = kilt_fixture(query_num)
+
+    def run():
+        return eval_parrot_kilt(parrot_service_address=stub_parrot.address,
+                                result_name=f'bench_cold_{query_num}',
+                                pre_query_num=query_num,
+                                knowledge_source=knowledge_source,
+                                force_reingest=True,
+                                resume=False,
+                                search_cache_mode='off')
+
+    eval_result = benchmark.pedantic(run, rounds=3, iterations=1)
+    _record_stage_throughput(benchmark, eval_result, query_num)
+    assert eval_result['recall@5'] > 0.5
+
+
+@pytest.mark.parametrize('query_num', QUERY_NUM_LIST)
+def test_eval_parrot_kilt_warm(benchmark, stub_parrot, kilt_fixture, query_num):
+    """A rerun of the same config: the ingestion is skipped by the corpus manifest and searches hit the cache."""
+    knowledge_source = kilt_fixture(query_num)
+
+    def run():
+        return eval_parrot_kilt(parrot_service_address=stub_parrot.address,
+                                result_name=f'bench_warm_{query_num}',
+                                pre_query_num=query_num,
+                                knowledge_source=knowledge_source,
+                                resume=False,
+                                search_cache_path='./outputs/kilt/bench_search_cache.sqlite')
+
+    run()
+    eval_result = benchmark.pedantic(run, rounds=3, iterations=1)
+    _record_stage_throughput(benchmark, eval_result, query_num)
+    assert eval_result['timing']['search_cache']['misses'] == 0
@@ -1 +1,3 @@
-from .evaluate_parrot_kilt import eval_parrot_kilt
\ No newline at end of file
+from .evaluate_parrot_kilt import eval_parrot_kilt, eval_parrot_kilt_top_k_sweep, eval_parrot_kilt_multi_dataset, \
+    merge_parrot_kilt_shards
+from .load_test_parrot_kilt import load_test_parrot_kilt
\ No newline at end of file
@@ -0,0 +1,111 @@
+import argparse
+import json
+
+from evalparrot.evaluate_parrot_kilt import eval_parrot_kilt, merge_parrot_kilt_shards, prepare_kilt_run
+from evalparrot.metric.utils.dataset.paragraph_snapshot import DEFAULT_SNAPSHOT_DIR
+from evalparrot.metric.utils.parrot_utils.search_cache import SEARCH_CACHE_MODES
+
+
+def add_corpus_args(parser):
+    parser.add_argument('--kilt-dataset-name', default='hotpotqa')
+    parser.add_argument('--kilt-wiki-mongo-domain', default='127.0.0.1')
+    parser.add_argument('--milvus-domain', default='127.0.0.1')
+    parser.add_argument('--parrot-service-address', default='http://127.0.0.1:8999')
+    parser.add_argument('--result-name', default='kilt_parrot_evaluation_res')
+    parser.add_argument('--pre-query-num', type=int, default=200, help='0 to use all the queries.')
+    parser.add_argument('--doc-gen-type', default='multi', choices=['multi', 'single'])
+    parser.add_argument('--no-snapshot', action='store_true', help='read the pages from the kilt mongo service.')
+    parser.add_argument('--snapshot-dir', default=DEFAULT_SNAPSHOT_DIR)
+    parser.add_argument('--upsert-concurrency', type=int, default=8)
+    parser.add_argument('--force-reingest', action='store_true')
+
+
+def corpus_kwargs(args):
+    return {
+        'kilt_dataset_name': args.kilt_dataset_name,
+        'kilt_wiki_mongo_domain': args.kilt_wiki_mongo_domain,
+        'milvus_domain': args.milvus_domain,
+        'parrot_service_address': args.parrot_service_address,
+        'result_name': args.result_name,
+        'pre_query_num': args.pre_query_num or None,
+        'doc_gen_type': args.doc_gen_type,
+        'use_snapshot': not args.no_snapshot,
+        'snapshot_dir': args.snapshot_dir,
+        'upsert_concurrency': args.upsert_concurrency,
+        'force_reingest': args.force_reingest,
+    }
+
+
+def main(argv=None):
+    """
+    Command line of the sharded kilt_score evaluation, e.g. fanned out over N workers sharing the output dir:
+        python -m evalparrot sync --kilt-dataset-name nq --pre-query-num 0
+        python -m evalparrot run --kilt-dataset-name nq --pre-query-num 0 --shard i/N
+        python -m evalparrot merge
+    """
+    parser = argparse.ArgumentParser(prog='python -m evalparrot', description='Evaluate parrot with the kilt dataset.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = subparsers.add_parser('sync', help='sync the corpus of the queries into parrot.')
+    add_corpus_args(sync_parser)
+
+    run_parser = subparsers.add_parser('run', help='evaluate all the queries, or one shard of them, with kilt_score.')
+    add_corpus_args(run_parser)
+    run_parser.add_argument('--shard', default=None, help="'i/N' to only run the i-th of N slices, 0 <= i < N, with the corpus synced before.")
+    run_parser.add_argument('--skip-ingestion', action='store_true', help='use the corpus synced before.')
+    run_parser.add_argument('--top-k', type=int, default=10)
+    run_parser.add_argument('--rerank', action='store_true')
+    run_parser.add_argument('--search-concurrency', type=int, default=8)
+    run_parser.add_argument('--search-timeout', type=float, default=60)
+    run_parser.add_argument('--search-retry-num', type=int, default=3)
+    run_parser.add_argument('--no-resume', action='store_true')
+    run_parser.add_argument('--match-workers', type=int, default=None, help='0 to match in the main process.')
+    run_parser.add_argument('--pipeline-depth', type=int, default=64)
+    run_parser.add_argument('--search-cache-mode', default='read_write', choices=SEARCH_CACHE_MODES)
+    run_parser.add_argument('--search-cache-path', default=None)
+    run_parser.add_argument('--ks', type=int, nargs='+', default=[1, 5])
+    run_parser.add_argument('--adaptive-target-width', type=float, default=None,
+                            help='stop once the confidence interval of every recall@k and success_rate@k is narrower.')
+    run_parser.add_argument('--adaptive-batch-size', type=int, default=50)
+    run_parser.add_argument('--adaptive-min-queries', type=int, default=100)
+    run_parser.add_argument('--adaptive-confidence', type=float, default=0.95)
+    run_parser.add_argument('--adaptive-seed', type=int, default=0)
+
+    merge_parser = subparsers.add_parser('merge', help='merge the partial results of all the shards.')
+    merge_parser.add_argument('--result-name', default='kilt_parrot_evaluation_res')
+    merge_parser.add_argument('--shard-num', type=int, default=None)
+    merge_parser.add_argument('--ks', type=int, nargs='+', default=None)
+
+    args = parser.parse_args(argv)
+    if args.command == 'sync':
+        kilt_run = prepare_kilt_run(**corpus_kwargs(args))
+        print(f'corpus of {kilt_run.project_name} synced, manifest hash = {kilt_run.manifest_hash}.')
+    elif args.command == 'run':
+        eval_result = eval_parrot_kilt(**corpus_kwargs(args),
+                                       shard=args.shard,
+                                       skip_ingestion=args.skip_ingestion,
+                                       top_k=args.top_k,
+                                       rerank=args.rerank,
+                                       search_concurrency=args.search_concurrency,
+                                       search_timeout=args.search_timeout,
+                                       search_retry_num=args.search_retry_num,
+                                       resume=not args.no_resume,
+                                       match_workers=args.match_workers,
+                                       pipeline_depth=args.pipeline_depth,
+                                       search_cache_mode=args.search_cache_mode,
+                                       search_cache_path=args.search_cache_path,
+                                       ks=args.ks,
+                                       adaptive_target_width=args.adaptive_target_width,
+                                       adaptive_batch_size=args.adaptive_batch_size,
+                                       adaptive_min_queries=args.adaptive_min_queries,
+                                       adaptive_confidence=args.adaptive_confidence,
+                                       adaptive_seed=args.adaptive_seed)
+        print(json.dumps({name: value for name, value in eval_result.items()
+                          if name not in ['timing', 'shard', 'adaptive']},
+                         indent=4))
+    else:
+        merge_parrot_kilt_shards(result_name=args.result_name, shard_num=args.shard_num, ks=args.ks)
+
+
+if __name__ == '__main__':
+    main()
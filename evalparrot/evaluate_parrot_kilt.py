@@ -1,15 +1,35 @@
 import json
+import multiprocessing
 import os
+import random
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
 # import argparse
 
-from kilt.eval_retrieval import evaluate
-from kilt.knowledge_source import KnowledgeSource
-from evalparrot.metric.utils.dataset.kilt_data import prepare_kilt_without_answer, find_data_jsonl_path, filter_jsonl, \
-    prepare_kilt_without_answer_with_multi_documents, find_wikipedia_id_by_gold, download_kilt_jsonl
-from evalparrot.metric.utils.io import save_dataset_with_timestamp, save_results
-from evalparrot.metric.utils.parrot_utils.http_utils import post_create, post_delete, post_upsert_kilt, \
-    post_upsert_kilt_with_multi_doc, post_search
+from evalparrot.metric.confidence_intervals import metric_interval
+from evalparrot.metric.utils.dataset.knowledge_source import get_page_store, build_mongo_connection_string
+from evalparrot.metric.utils.dataset.paragraph_snapshot import DEFAULT_SNAPSHOT_DIR, ParagraphSnapshot, \
+    get_snapshot_path, materialize_kilt_snapshot
+from evalparrot.metric.utils.dataset.kilt_data import prepare_kilt_without_answer, find_data_jsonl_path, \
+    prepare_kilt_without_answer_with_multi_documents, get_src_context_2_id, download_kilt_jsonl
+from evalparrot.metric.utils.dataset.jsonl_index import JsonlIndex
+from evalparrot.metric.utils.dataset.doc_provenance import DocProvenanceStore
+from evalparrot.metric.utils.dataset.provenance_matcher import match_chunks
+from evalparrot.metric.utils.io import save_dataset_with_timestamp, save_results, sweep_results_2_md_table, \
+    multi_dataset_results_2_md_table, timing_2_md_table, confidence_intervals_2_md_table
+from evalparrot.metric.utils.parrot_utils.http_utils import get_parrot_client
+from evalparrot.metric.utils.parrot_utils.search_cache import SearchCache, search_with_cache, \
+    SEARCH_CACHE_MODES
+from evalparrot.metric.utils.parrot_utils.corpus_sync import sync_corpus, load_manifest, get_manifest_hash
+from evalparrot.metric.utils.checkpoint import ResumableJsonlWriter, BackgroundWriter
+from evalparrot.metric.utils.parrot_utils.search_executor import concurrent_search
 from evalparrot.metric.utils.multi_run import multi_evaluate_one_dataset
+from evalparrot.metric.utils.judge_cache import JudgeCache, DEFAULT_JUDGE_CACHE_PATH
+from evalparrot.metric.utils.result_store import CHUNKS_NAME, KiltResultStoreWriter, hash_chunk, \
+    iter_record_batches, read_kilt_metric_values, summarize_kilt_hits, summarize_kilt_result_store
+from evalparrot.metric.utils.timing import StageTimer
 from ragas.metrics import context_recall, context_precision  # , context_relevancy
 from datasets import Dataset
 from tqdm import tqdm
@@ -17,6 +37,504 @@ from tqdm import tqdm
 
 # dataset_with_paragraph_id = ['fever', 'triviaqa', 'wow', 'eli5', 'hotpotqa', 'nq', 'structured_zeroshot', 'trex']
 
+FAILED_ANSWER = 'failed. please retry.'
+
+KiltRun = namedtuple('KiltRun', ['project_name', 'output_dir', 'kilt_data_path', 'data_jsonl_path', 'knowledge_source',
+                                 'question_list', 'ground_truth_list', 'input_list', 'id_list', 'manifest_hash',
+                                 'offline', 'doc_provenance'])
+
+
+def is_search_succeeded(guess_line_dict):
+    return guess_line_dict['output'][0]['answer'] != FAILED_ANSWER
+
+
+def parse_shard(shard):
+    """Parse the shard spec 'i/N' into (i, N), where 0 <= i < N."""
+    shard_ind, shard_num = (int(part) for part in str(shard).split('/'))
+    assert 0 <= shard_ind < shard_num, f'shard should be i/N with 0 <= i < N, got {shard}.'
+    return shard_ind, shard_num
+
+
+def get_shard_dir(output_dir, shard_ind, shard_num):
+    return os.path.join(output_dir, 'shards', f'shard_{shard_ind}_of_{shard_num}')
+
+
+def shard_kilt_run(kilt_run, shard_ind, shard_num):
+    """
+    Return the KiltRun of only the queries of shard `shard_ind` of `shard_num`, and the indices of them in `kilt_run`.
+    The queries are dealt round robin, so the slices are deterministic and of balanced difficulty.
+    """
+    query_inds = list(range(shard_ind, len(kilt_run.id_list), shard_num))
+    return subset_kilt_run(kilt_run, query_inds), query_inds
+
+
+def subset_kilt_run(kilt_run, query_inds):
+    """Return the KiltRun of only the kilt_score queries of `query_inds` in `kilt_run`, in that order."""
+    return kilt_run._replace(input_list=[kilt_run.input_list[ind] for ind in query_inds],
+                             id_list=[kilt_run.id_list[ind] for ind in query_inds])
+
+
+def prepare_kilt_run(kilt_dataset_name='hotpotqa',
+                     kilt_wiki_mongo_domain='127.0.0.1',
+                     milvus_domain='127.0.0.1',
+                     parrot_service_address='http://127.0.0.1:8999',
+                     result_name='kilt_parrot_evaluation_res',
+                     rerank=None,
+                     pre_query_num=200,
+                     doc_gen_type='multi',
+                     use_snapshot=True,
+                     snapshot_dir=DEFAULT_SNAPSHOT_DIR,
+                     upsert_concurrency=8,
+                     force_reingest=False,
+                     search_cache_mode='read_write',
+                     knowledge_source=None,
+                     skip_ingestion=False,
+                     timer=None):
+    """
+    Download the kilt dataset, prepare its first `pre_query_num` queries, and sync their documents into parrot.
+    With `skip_ingestion` the corpus synced before into the same output dir is used as it is.
+    Return a KiltRun with everything the query stage needs.
+    """
+    assert search_cache_mode in SEARCH_CACHE_MODES, f'search_cache_mode should be one of {SEARCH_CACHE_MODES}.'
+    if timer is None:
+        timer = StageTimer()
+    project_name = result_name
+
+    mongo_connection_string = build_mongo_connection_string(kilt_wiki_mongo_domain)
+
+    output_dir = os.path.join('./outputs/kilt', project_name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    kilt_data_path = './datasets/kilt_data'
+    os.makedirs(kilt_data_path, exist_ok=True)
+    with timer.stage('download'):
+        download_kilt_jsonl(kilt_data_path, kilt_dataset_name)
+    data_jsonl_path = find_data_jsonl_path(kilt_dataset_name, 'dev', kilt_data_path)
+
+    if knowledge_source is not None:
+        print(f'use the given kilt page source {type(knowledge_source).__name__}.')
+    elif use_snapshot:
+        snapshot_path = get_snapshot_path(snapshot_dir, kilt_dataset_name, 'dev', pre_query_num)
+        if not os.path.exists(snapshot_path):
+            with timer.stage('page_fetch'):
+                materialize_kilt_snapshot(kilt_data_path, kilt_dataset_name, split='dev', pre_query_num=pre_query_num,
+                                          snapshot_dir=snapshot_dir, ks=get_page_store(mongo_connection_string))
+        knowledge_source = ParagraphSnapshot(snapshot_path)
+    else:
+        knowledge_source = get_page_store(mongo_connection_string)
+
+    # if pre_answer_dataset:
+    #     ds = Dataset.load_from_disk(pre_answer_dataset)
+    # else:
+
+    with timer.stage('prepare'):
+        if doc_gen_type == 'multi':
+            question_list, ground_truth_list, wikipedia_id_set, input_list, id_list = prepare_kilt_without_answer_with_multi_documents(
+                kilt_data_path,
+                kilt_dataset_name,
+                split='dev',
+                pre_query_num=pre_query_num,
+                ks=knowledge_source
+            )
+            documents = None
+        else:
+            question_list, ground_truth_list, documents, input_list, id_list = prepare_kilt_without_answer(
+                kilt_data_path,
+                kilt_dataset_name,
+                split='dev',
+                ks=knowledge_source,
+                pre_query_num=pre_query_num
+            )
+            wikipedia_id_set = None
+    if pre_query_num:
+        print(f'use only pre {pre_query_num} number of data for query question.')
+        question_list = question_list[:pre_query_num]
+        ground_truth_list = ground_truth_list[:pre_query_num]
+        input_list = input_list[:pre_query_num]
+        id_list = id_list[:pre_query_num]
+    else:
+        print(f'use all data for query question.')
+
+    offline = search_cache_mode == 'offline'
+    if offline:
+        print('offline mode, skip the corpus ingestion, all search results are read from the search cache.')
+    elif skip_ingestion:
+        print(f'skip the corpus ingestion, use the corpus synced into {output_dir} before.')
+    else:
+        if doc_gen_type == 'multi':
+            temp_doc_path = os.path.join(kilt_data_path, 'kilt_temp_docs', project_name)
+        else:
+            temp_doc_path = os.path.join(kilt_data_path, f'kilt_temp_doc_{project_name}.txt')
+        with timer.stage('ingestion'):
+            ingestion_report = sync_corpus(
+                project_name=project_name,
+                output_dir=output_dir,
+                doc_gen_type=doc_gen_type,
+                ks=knowledge_source,
+                temp_doc_path=temp_doc_path,
+                kilt_dataset_name=kilt_dataset_name,
+                wikipedia_id_set=wikipedia_id_set,
+                documents=documents,
+                store_domain=milvus_domain,
+                parrot_domain=parrot_service_address,
+                rerank=rerank,
+                upsert_concurrency=upsert_concurrency,
+                force_reingest=force_reingest,
+                timer=timer
+            )
+        ingestion_report_path = os.path.join(output_dir, 'ingestion_report.json')
+        with open(ingestion_report_path, 'w') as fw:
+            fw.write(json.dumps(ingestion_report, indent=4))
+        if ingestion_report['failed']:
+            # the failed documents are not in the manifest, so the next run only upserts them again
+            raise RuntimeError(f'{len(ingestion_report["failed"])} documents failed to upsert, evaluating on a partial '
+                               f'corpus would lower the recall, see {ingestion_report_path} and run again.')
+
+    manifest = load_manifest(output_dir)
+    assert manifest is not None, f'no corpus has been ingested for {project_name}, ' \
+                                 f'sync it first and share {output_dir} with the runs skipping the ingestion.'
+    return KiltRun(project_name=project_name,
+                   output_dir=output_dir,
+                   kilt_data_path=kilt_data_path,
+                   data_jsonl_path=data_jsonl_path,
+                   knowledge_source=knowledge_source,
+                   question_list=question_list,
+                   ground_truth_list=ground_truth_list,
+                   input_list=input_list,
+                   id_list=id_list,
+                   manifest_hash=get_manifest_hash(manifest),
+                   offline=offline,
+                   doc_provenance=DocProvenanceStore.open(output_dir) if doc_gen_type == 'multi' else None)
+
+
+def open_search_cache(search_cache_mode='read_write', search_cache_path=None, search_cache_max_entries=200000):
+    if search_cache_mode == 'off':
+        return None
+    return SearchCache(search_cache_path or os.path.join('./outputs/kilt', 'search_cache.sqlite'),
+                       max_entries=search_cache_max_entries)
+
+
+def build_search_fn(kilt_run, parrot_client, search_cache, top_k=10, rerank=None, search_timeout=60, timer=None):
+    return partial(search_with_cache,
+                   parrot_client,
+                   search_cache,
+                   project_name=kilt_run.project_name,
+                   manifest_hash=kilt_run.manifest_hash,
+                   top_k=top_k,
+                   rerank=rerank,
+                   timeout=search_timeout,
+                   offline=kilt_run.offline,
+                   timer=timer)
+
+
+def iter_search_results(search_fn, queries, search_concurrency=8, search_retry_num=3, offline=False, timer=None):
+    """
+    Yield (answer, result_list, latency) of every query in order, a failed search yields the FAILED_ANSWER placeholder.
+    The latency is the seconds of all the search attempts of the query.
+    """
+    # a cache miss in offline mode will not succeed by retrying
+    search_results = concurrent_search(search_fn, queries, max_concurrency=search_concurrency,
+                                       retry_num=1 if offline else search_retry_num, timer=timer)
+    for search_result in tqdm(search_results, total=len(queries)):
+        if search_result.error is None:
+            answer = 'no answer.'  # mock answer
+            result_list = search_result.result
+        else:
+            print(f'search failed after {search_result.attempts} attempts: {search_result.error}')
+            answer = FAILED_ANSWER
+            result_list = [{'chunk_text': FAILED_ANSWER}]
+        yield answer, result_list, search_result.latency
+
+
+def resolve_result_provenance(result_list, doc_provenance=None):
+    """The provenance dict of every search result resolved exactly by `doc_provenance`, None for the unresolved."""
+    if doc_provenance is None:
+        return [None] * len(result_list)
+    return [doc_provenance.resolve(res.get('doc_name'), res['chunk_text']) for res in result_list]
+
+
+def assemble_guess_record(id_, input_, answer, result_list, resolved_list, ind_2_match):
+    """
+    Build the kilt guess record from the exact provenance of `resolved_list`,
+    and the (wikipedia_id, src_context, score) of `ind_2_match` for the results matched fuzzily.
+    A chunk is only referred to by the hash of its text, the text is kept once in the result store.
+    """
+    provenance = []
+    for ind, (res, resolved) in enumerate(zip(result_list, resolved_list)):
+        if resolved is not None:
+            wikipedia_id, title = resolved['wikipedia_id'], resolved['title']
+            start_paragraph_id, end_paragraph_id = resolved['start_paragraph_id'], resolved['end_paragraph_id']
+        else:
+            wikipedia_id, _, _ = ind_2_match[ind]
+            title, start_paragraph_id, end_paragraph_id = None, None, None
+        provenance_dict = {
+            "wikipedia_id": str(wikipedia_id),
+            "title": title,
+            "section": None,
+            "start_paragraph_id": start_paragraph_id,
+            "start_character": None,
+            "end_paragraph_id": end_paragraph_id,
+            "end_character": None,
+            "bleu_score": None,
+            'meta': {
+                'chunk_hash': hash_chunk(res['chunk_text']),
+                'doc_name': res.get('doc_name'),
+                'chunk_id': res.get('chunk_id'),
+                'match': 'doc_name' if resolved is not None else 'fuzzy',
+            }
+        }
+        provenance.append(provenance_dict)
+    output = [{
+        'answer': answer,
+        "provenance": provenance
+    }]
+    return {
+        'id': id_,
+        'input': input_,
+        'output': output,
+    }
+
+
+def build_guess_record(id_, input_, answer, result_list, gold_record, knowledge_source, doc_provenance=None):
+    """
+    Build the kilt guess record of the search results of one query.
+    The provenance of a result is resolved exactly from its `doc_name` by `doc_provenance` when it is given,
+    and the fuzzy matching against the gold paragraphs is only the fallback, e.g. in the 'single' doc_gen_type.
+    """
+    resolved_list = resolve_result_provenance(result_list, doc_provenance)
+    fuzzy_inds = [ind for ind, resolved in enumerate(resolved_list) if resolved is None]
+    ind_2_match = dict()
+    if fuzzy_inds:
+        matches = match_chunks(get_src_context_2_id(gold_record, ks=knowledge_source),
+                               [result_list[ind]['chunk_text'].strip() for ind in fuzzy_inds])
+        ind_2_match = dict(zip(fuzzy_inds, matches))
+    return assemble_guess_record(id_, input_, answer, result_list, resolved_list, ind_2_match)
+
+
+def _timed_match_chunks(content_2_wikipedia_id, chunk_contexts):
+    start = time.perf_counter()
+    matches = match_chunks(content_2_wikipedia_id, chunk_contexts)
+    return matches, time.perf_counter() - start
+
+
+def get_match_mp_context():
+    """The start method of the matching processes, which does not fork the threads of this process."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def open_kilt_query_writers(guess_output_path, run_config, store_dir, ks=(1, 5), resume=True, checkpoint_every=20,
+                            timer=None):
+    """Open the guess record writer of `guess_output_path` and the result store writer of `store_dir`."""
+    guess_writer = ResumableJsonlWriter(guess_output_path, run_config, is_valid=is_search_succeeded,
+                                        fsync_every=checkpoint_every, resume=resume)
+    store_writer = KiltResultStoreWriter(store_dir, ks=ks, resume=resume, timer=timer)
+    return guess_writer, store_writer
+
+
+def search_kilt_queries(kilt_run, search_fn, gold_index, guess_writer, store_writer, query_inds=None,
+                        search_concurrency=8, search_retry_num=3, checkpoint_every=20, match_workers=None,
+                        pipeline_depth=64, timer=None):
+    """
+    Search the queries of `kilt_run` through the pipeline of `run_kilt_queries`, into the writers of
+    `open_kilt_query_writers`, which are left open, so that several calls only write their own queries.
+    The completed queries of `guess_writer` are written into the store instead of searched again.
+    """
+    if timer is None:
+        timer = StageTimer()
+    if match_workers is None:
+        # leave one core to the search threads and the writer thread
+        match_workers = (os.cpu_count() or 1) - 1
+    input_list = kilt_run.input_list
+    id_list = kilt_run.id_list
+    if query_inds is None:
+        query_inds = range(len(id_list))
+    # the completed queries are written into the store again, and the ones whose chunk text is lost are searched again
+    completed_inds = [ind for ind, id_ in enumerate(id_list) if id_ in guess_writer.completed_keys]
+    resumed_inds = set()
+    for ind, guess_record in zip(completed_inds, guess_writer.iter_records([id_list[ind] for ind in completed_inds])):
+        if store_writer.has_chunks(guess_record):
+            store_writer.append(query_inds[ind], guess_record, gold_index.get(id_list[ind]))
+            resumed_inds.add(ind)
+    todo_inds = [ind for ind in range(len(id_list)) if ind not in resumed_inds]
+    search_results = iter_search_results(search_fn, [input_list[ind] for ind in todo_inds],
+                                         search_concurrency=search_concurrency, search_retry_num=search_retry_num,
+                                         offline=kilt_run.offline, timer=timer)
+    written_num = 0
+
+    def write_record(item):
+        nonlocal written_num
+        ind, guess_record, chunk_texts = item
+        store_writer.append(query_inds[ind], guess_record, gold_index.get(id_list[ind]), chunk_texts)
+        written_num += 1
+        if written_num % checkpoint_every == 0:
+            # the chunks are synced before the guess records referring to them
+            store_writer.sync()
+        guess_writer.write(guess_record)
+
+    record_writer = BackgroundWriter(write_record, max_queue_size=pipeline_depth, timer=timer)
+    match_pool = None
+    # the queries waiting for their fuzzy matches, in the query order
+    pending = deque()
+
+    def is_matched(item):
+        return not isinstance(item[-1], Future) or item[-1].done()
+
+    def write_oldest():
+        ind, answer, result_list, latency, resolved_list, fuzzy_inds, matches, match_seconds = pending.popleft()
+        if isinstance(matches, Future):
+            if not matches.done():
+                with timer.stage('match_wait'):
+                    matches.result()
+            matches, worker_seconds = matches.result()
+            match_seconds += worker_seconds
+        # one span per query, the provenance resolving and the fuzzy matching in this thread or in a worker
+        timer.add_stage_time('matching', match_seconds)
+        guess_record = assemble_guess_record(id_list[ind], input_list[ind], answer, result_list, resolved_list,
+                                             dict(zip(fuzzy_inds, matches)))
+        guess_record['search_latency'] = latency
+        record_writer.put((ind, guess_record, [res['chunk_text'] for res in result_list]))
+
+    try:
+        with timer.stage('query'):
+            for ind, (answer, result_list, latency) in zip(todo_inds, search_results):
+                match_start = time.perf_counter()
+                resolved_list = resolve_result_provenance(result_list, kilt_run.doc_provenance)
+                fuzzy_inds = [result_ind for result_ind, resolved in enumerate(resolved_list) if resolved is None]
+                matches = []
+                if fuzzy_inds:
+                    content_2_wikipedia_id = get_src_context_2_id(gold_index.get(id_list[ind]),
+                                                                  ks=kilt_run.knowledge_source)
+                    chunk_contexts = [result_list[fuzzy_ind]['chunk_text'].strip() for fuzzy_ind in fuzzy_inds]
+                    if match_workers <= 0:
+                        matches = match_chunks(content_2_wikipedia_id, chunk_contexts)
+                match_seconds = time.perf_counter() - match_start
+                if fuzzy_inds and match_workers > 0:
+                    if match_pool is None:
+                        # the search threads are already running, and forking them could copy a held lock
+                        match_pool = ProcessPoolExecutor(max_workers=match_workers, mp_context=get_match_mp_context())
+                    matches = match_pool.submit(_timed_match_chunks, content_2_wikipedia_id, chunk_contexts)
+                pending.append((ind, answer, result_list, latency, resolved_list, fuzzy_inds, matches, match_seconds))
+                timer.record_depth('match_queue', len(pending))
+                while pending and (len(pending) >= pipeline_depth or is_matched(pending[0])):
+                    write_oldest()
+            while pending:
+                write_oldest()
+    finally:
+        if match_pool is not None:
+            match_pool.shutdown(cancel_futures=True)
+        # the records already put are still written, so an interrupted run resumes from them
+        record_writer.close()
+    timer.add_count('queries', len(todo_inds))
+
+
+def run_kilt_queries(kilt_run, search_fn, gold_index, guess_output_path, run_config, store_dir, ks=(1, 5),
+                     query_inds=None, search_concurrency=8, search_retry_num=3, resume=True, checkpoint_every=20,
+                     match_workers=None, pipeline_depth=64, timer=None):
+    """
+    Search all the queries of `kilt_run`, write their guess records into `guess_output_path`,
+    and stream their hits, chunks and metrics of `ks` into the result store `store_dir`, return `store_dir`.
+    `query_inds` is the query_ind of every query of `kilt_run` in the store, default is its index in `kilt_run`.
+    The queries flow through a bounded pipeline: the search threads, the fuzzy provenance matching in a pool of
+    `match_workers` processes, and a single writer thread of the guess records and the result store.
+    At most `pipeline_depth` queries wait in the matching and in the writing stage,
+    so a slow stage holds back the stages before it instead of buffering in memory,
+    and the depth of every queue is sampled into the timer.
+    `match_workers=None` uses all the cores but one, and 0 matches in this thread.
+    """
+    if timer is None:
+        timer = StageTimer()
+    guess_writer, store_writer = open_kilt_query_writers(guess_output_path, run_config, store_dir, ks=ks,
+                                                         resume=resume, checkpoint_every=checkpoint_every, timer=timer)
+    try:
+        search_kilt_queries(kilt_run, search_fn, gold_index, guess_writer, store_writer, query_inds=query_inds,
+                            search_concurrency=search_concurrency, search_retry_num=search_retry_num,
+                            checkpoint_every=checkpoint_every, match_workers=match_workers,
+                            pipeline_depth=pipeline_depth, timer=timer)
+    finally:
+        store_writer.close()
+    guess_writer.finalize(kilt_run.id_list)
+    return store_dir
+
+
+def get_adaptive_metric_names(ks=(1, 5)):
+    """The metrics tracked by the adaptive mode, recall@k and success_rate@k of every k > 1."""
+    return [f'{name}@{k}' for k in sorted(int(k) for k in ks) if k > 1 for name in ['recall', 'success_rate']]
+
+
+def run_adaptive_kilt_queries(kilt_run, search_fn, gold_index, guess_output_path, run_config, store_dir, ks=(1, 5),
+                              target_width=0.05, batch_size=50, min_queries=100, confidence=0.95, seed=0,
+                              resume=True, checkpoint_every=20, timer=None, **query_kwargs):
+    """
+    Search the queries of `kilt_run` in shuffled batches of `batch_size`, until the confidence interval of every
+    metric of `get_adaptive_metric_names(ks)` is not wider than `target_width`, or all the queries are searched.
+    The intervals are only checked from `min_queries` queries on, so a few easy queries can not stop the run.
+    The writers stay open across the batches, so every batch only writes its own queries into `guess_output_path`
+    and the result store `store_dir`, and the intervals are computed from the metrics of the store.
+    Return the indices of the searched queries in `kilt_run`, the intervals and the report.
+    The other kwargs are passed to `search_kilt_queries`.
+    """
+    metric_names = get_adaptive_metric_names(ks)
+    assert metric_names, f'the adaptive mode tracks recall@k and success_rate@k, so ks {ks} needs a k > 1.'
+    if timer is None:
+        timer = StageTimer()
+    query_order = list(range(len(kilt_run.id_list)))
+    random.Random(seed).shuffle(query_order)
+    query_num = 0
+    history = []
+    guess_writer, store_writer = open_kilt_query_writers(guess_output_path, run_config, store_dir, ks=ks,
+                                                         resume=resume, checkpoint_every=checkpoint_every, timer=timer)
+    try:
+        while True:
+            batch_inds = query_order[query_num: query_num + batch_size]
+            query_num += len(batch_inds)
+            search_kilt_queries(subset_kilt_run(kilt_run, batch_inds), search_fn, gold_index, guess_writer,
+                                store_writer, query_inds=batch_inds, checkpoint_every=checkpoint_every, timer=timer,
+                                **query_kwargs)
+            store_writer.flush_queries()
+            name_2_values = read_kilt_metric_values(store_dir, metric_names)
+            intervals = {name: metric_interval(name_2_values[name], confidence, seed=seed) for name in metric_names}
+            widest_name = max(metric_names, key=lambda name: intervals[name]['width'])
+            converged = query_num >= min_queries and intervals[widest_name]['width'] <= target_width
+            history.append({'query_num': query_num,
+                            'widths': {name: intervals[name]['width'] for name in metric_names}})
+            print(f'adaptive: {query_num}/{len(query_order)} queries, the widest interval is {widest_name} = '
+                  f'{round(intervals[widest_name]["estimate"], 4)} [{round(intervals[widest_name]["lower"], 4)}, '
+                  f'{round(intervals[widest_name]["upper"], 4)}], target width {target_width}.')
+            if converged or query_num == len(query_order):
+                break
+    finally:
+        store_writer.close()
+    query_inds = query_order[:query_num]
+    guess_writer.finalize([kilt_run.id_list[ind] for ind in query_inds])
+    if not converged:
+        print(f'adaptive: the query budget of {len(query_order)} is used up before the intervals converge.')
+    adaptive_report = {
+        'query_num': query_num,
+        'query_budget': len(query_order),
+        'converged': converged,
+        'target_width': target_width,
+        'confidence': confidence,
+        'seed': seed,
+        'history': history,
+    }
+    return query_inds, intervals, adaptive_report
+
+
+def build_timing_report(timer, knowledge_source=None, search_cache=None, judge_cache=None, doc_provenance=None):
+    """The report of `timer`, with the stats of the page source, the search, judge and doc provenance stores of the run."""
+    timing = timer.report()
+    if knowledge_source is not None:
+        timing['page_source'] = knowledge_source.stats()
+    if search_cache is not None:
+        timing['search_cache'] = search_cache.stats()
+    if doc_provenance is not None:
+        timing['doc_provenance'] = doc_provenance.stats()
+    if judge_cache is not None:
+        timing['judge_cache'] = judge_cache.stats()
+    return timing
+
 
 def eval_parrot_kilt(kilt_dataset_name: str = 'hotpotqa',
                      kilt_wiki_mongo_domain: str = '127.0.0.1',
@@ -27,7 +545,35 @@ def eval_parrot_kilt(kilt_dataset_name: str = 'hotpotqa',
                      rerank: bool = False,
                      pre_query_num: int = 200,
                      metric_type: str = 'kilt_score',
-                     doc_gen_type: str = 'multi'
+                     doc_gen_type: str = 'multi',
+                     use_snapshot: bool = True,
+                     snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+                     search_concurrency: int = 8,
+                     search_timeout: float = 60,
+                     search_retry_num: int = 3,
+                     upsert_concurrency: int = 8,
+                     force_reingest: bool = False,
+                     resume: bool = True,
+                     checkpoint_every: int = 20,
+                     match_workers: int = None,
+                     pipeline_depth: int = 64,
+                     search_cache_mode: str = 'read_write',
+                     search_cache_path: str = None,
+                     search_cache_max_entries: int = 200000,
+                     ks: list = (1, 5),
+                     knowledge_source=None,
+                     ragas_concurrency: int = 8,
+                     ragas_requests_per_minute: int = None,
+                     ragas_tokens_per_minute: int = None,
+                     judge_cache_path: str = DEFAULT_JUDGE_CACHE_PATH,
+                     judge_cache_bypass: bool = False,
+                     shard: str = None,
+                     skip_ingestion: bool = False,
+                     adaptive_target_width: float = None,
+                     adaptive_batch_size: int = 50,
+                     adaptive_min_queries: int = 100,
+                     adaptive_confidence: float = 0.95,
+                     adaptive_seed: int = 0,
                      ):
     """
     Under the condition that the parrot service and the kilt mongo service are started,
@@ -63,188 +609,534 @@ def eval_parrot_kilt(kilt_dataset_name: str = 'hotpotqa',
             'multi' is closer to the actual document settings,
             and the 'single' method comes from the baseline of ragas doc:
             https://github.com/explodinggradients/ragas/blob/main/experiments/baselines/fiqa/dataset-exploration-and-baseline.ipynb.
+            In 'multi', a retrieved chunk is attributed exactly to the wikipedia page of its document and the paragraphs
+            it is cut from, which are recorded at ingestion, while 'single' falls back to fuzzy matching the gold paragraphs.
             Default is 'multi'.
+        use_snapshot (`bool`):
+            Whether to read the kilt pages from a local paragraph snapshot instead of the kilt mongo service.
+            The snapshot only contains the pages needed by this dataset and pre_query_num,
+            it is materialized from mongo at the first run, and later runs do not need mongo any more.
+            Default is True.
+        snapshot_dir (`str`):
+            The directory of the paragraph snapshots, default is './datasets/kilt_snapshot'.
+        search_concurrency (`int`):
+            The max number of parrot search requests in flight, default is 8.
+        search_timeout (`float`):
+            The timeout seconds of each parrot search request, default is 60.
+        search_retry_num (`int`):
+            The number of attempts of each search request, retried with exponential backoff.
+            A query still failed after all the attempts gets 'failed. please retry.' as its result.
+            Default is 3.
+        upsert_concurrency (`int`):
+            The max number of document upsert requests in flight when doc_gen_type is 'multi', default is 8.
+            A document still failing after the retries fails the run, and the next run only upserts the failed ones.
+        force_reingest (`bool`):
+            The documents ingested into parrot are recorded in `corpus_manifest.json` of the output dir,
+            and a later run only upserts or deletes the changed documents.
+            Set True to delete and recreate the parrot kb and ingest all the documents again.
+            Default is False.
+        resume (`bool`):
+            Whether to resume the queries of an interrupted kilt_score run with the same config.
+            The queries already in `guess_output.jsonl` are skipped, and only the failed ones are searched again.
+            Default is True.
+        checkpoint_every (`int`):
+            The number of query results appended to `guess_output.jsonl` between two fsync, default is 20.
+        match_workers (`int`):
+            The number of processes matching the search results to the gold paragraphs fuzzily,
+            which is only needed for the results without a recorded doc provenance, e.g. in the 'single' doc_gen_type.
+            Default is None, which uses all the cores but one, and 0 matches in the main process.
+            The processes are started by forkserver, or spawn where it is unavailable, so they do not fork the search threads.
+        pipeline_depth (`int`):
+            The max number of queries waiting in the matching and in the writing stage of the kilt_score queries,
+            a stage that falls behind holds back the searches, so the memory stays bounded. Default is 64.
+        search_cache_mode (`str`):
+            Available options include ['read_write', 'offline', 'off'].
+            'read_write' serves repeated searches of the same query, kb, corpus and search config from a local cache,
+            and saves new search results into it.
+            'offline' never requests parrot: the corpus ingestion is skipped and all search results must be cached,
+            so the scores of a previous run can be recomputed without parrot running.
+            'off' disables the cache. Default is 'read_write'.
+        search_cache_path (`str`):
+            The sqlite file of the search cache, default is './outputs/kilt/search_cache.sqlite'.
+        search_cache_max_entries (`int`):
+            The max number of cached search results, the least recently used ones are evicted. Default is 200000.
+        ks (`list`):
+            The k list of the kilt_score metrics, Rprec, precision@k, recall@k, success_rate@k, MRR and nDCG@k
+            are computed for every k in it. Default is (1, 5).
+        knowledge_source:
+            The kilt page source used instead of the snapshot or the kilt mongo service, e.g. an
+            `evalparrot.testing.InMemoryKnowledgeSource`. It must provide `get_page_by_id()` and `stats()`.
+            Default is None.
+        ragas_concurrency (`int`):
+            The max number of ragas metric batches scored concurrently when metric_type is 'ragas_score', default is 8.
+        ragas_requests_per_minute (`int`):
+            The budget of openai requests per minute of the ragas evaluation, default is None, which is unlimited.
+        ragas_tokens_per_minute (`int`):
+            The budget of openai tokens per minute of the ragas evaluation, default is None, which is unlimited.
+            A batch answered with 429 is retried with exponential backoff, and holds the other batches meanwhile.
+        judge_cache_path (`str`):
+            The sqlite file of the ragas judge cache, the llm judgements of the ragas metrics are saved into it,
+            and the same judgement asked again by a later run is served from it without calling openai.
+            Set None to disable it. Default is './outputs/kilt/judge_cache.sqlite'.
+        judge_cache_bypass (`bool`):
+            Whether to call openai for every judgement without reading or writing the judge cache,
+            e.g. to study the variance of the ragas scores between the runs. Default is False.
+        shard (`str`):
+            'i/N' to only search and score the i-th of N deterministic slices of the queries, 0 <= i < N,
+            only for the 'kilt_score' metric_type. The partial result is saved in `shards/shard_i_of_N` of the output
+            dir, and `merge_parrot_kilt_shards()` merges the partials of all the shards into `eval_result.json`.
+            A shard implies `skip_ingestion`, the corpus has to be synced into the output dir before.
+            Default is None, which runs all the queries.
+        skip_ingestion (`bool`):
+            Whether to skip the corpus ingestion and use the corpus synced into the output dir before,
+            e.g. by `python -m evalparrot sync`. It is always True for a shard, so that only the sync ingests the corpus.
+            Default is False.
+        adaptive_target_width (`float`):
+            Set it to run the kilt_score queries in the adaptive mode: the queries are searched in shuffled batches,
+            until the confidence interval of every recall@k and success_rate@k (k > 1) is not wider than it,
+            e.g. 0.05, or all the `pre_query_num` queries, the query budget, are searched.
+            The estimate and interval of them are reported in `confidence_intervals` of `adaptive` of the result,
+            Wilson for success_rate@k and bootstrap for recall@k. Default is None, which searches all the queries.
+        adaptive_batch_size (`int`):
+            The number of queries searched between two checks of the intervals, default is 50.
+        adaptive_min_queries (`int`):
+            The number of queries searched before the intervals can stop the run, default is 100.
+        adaptive_confidence (`float`):
+            The confidence level of the intervals, default is 0.95.
+        adaptive_seed (`int`):
+            The seed of the query shuffle and the bootstrap, default is 0.
 
     """
     if rerank is False:
         rerank = None
-    project_name = result_name
-
-    mongo_connection_string = f"mongodb://{kilt_wiki_mongo_domain}:27017/admin"
-    knowledge_source = KnowledgeSource(mongo_connection_string=mongo_connection_string)
-
-    output_dir = os.path.join('./outputs/kilt', project_name)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    kilt_data_path = './datasets/kilt_data'
-    if not os.path.exists(kilt_data_path):
-        os.makedirs(kilt_data_path)
-    download_kilt_jsonl(kilt_data_path, kilt_dataset_name)
+    if shard is not None:
+        assert metric_type == 'kilt_score', 'shard is only supported by the kilt_score metric_type.'
+        shard_ind, shard_num = parse_shard(shard)
+        # the shards share the kb, so only the sync ingests the corpus, and a shard checks its manifest
+        skip_ingestion = True
+    if adaptive_target_width is not None:
+        assert metric_type == 'kilt_score', 'the adaptive mode is only supported by the kilt_score metric_type.'
+        assert shard is None, 'the adaptive mode can not be sharded, its stop depends on all the searched queries.'
+    timer = StageTimer()
+    kilt_run = prepare_kilt_run(kilt_dataset_name=kilt_dataset_name,
+                                kilt_wiki_mongo_domain=kilt_wiki_mongo_domain,
+                                milvus_domain=milvus_domain,
+                                parrot_service_address=parrot_service_address,
+                                result_name=result_name,
+                                rerank=rerank,
+                                pre_query_num=pre_query_num,
+                                doc_gen_type=doc_gen_type,
+                                use_snapshot=use_snapshot,
+                                snapshot_dir=snapshot_dir,
+                                upsert_concurrency=upsert_concurrency,
+                                force_reingest=force_reingest,
+                                search_cache_mode=search_cache_mode,
+                                knowledge_source=knowledge_source,
+                                skip_ingestion=skip_ingestion,
+                                timer=timer)
+    project_name = kilt_run.project_name
+    output_dir = kilt_run.output_dir
+    knowledge_source = kilt_run.knowledge_source
 
-    # if pre_answer_dataset:
-    #     ds = Dataset.load_from_disk(pre_answer_dataset)
-    # else:
-
-    if doc_gen_type == 'multi':
-        question_list, ground_truth_list, wikipedia_id_set, input_list, id_list = prepare_kilt_without_answer_with_multi_documents(
-            kilt_data_path,
-            kilt_dataset_name,
-            split='dev',
-            pre_query_num=pre_query_num,
-            ks=knowledge_source
-        )
-    else:
-        question_list, ground_truth_list, documents, input_list, id_list = prepare_kilt_without_answer(
-            kilt_data_path,
-            kilt_dataset_name,
-            split='dev',
-            ks=knowledge_source
-        )
-    if pre_query_num:
-        print(f'use only pre {pre_query_num} number of data for query question.')
-        question_list = question_list[:pre_query_num]
-        ground_truth_list = ground_truth_list[:pre_query_num]
-        input_list = input_list[:pre_query_num]
-        id_list = id_list[:pre_query_num]
-    else:
-        print(f'use all data for query question.')
-    temp_file_path = os.path.join(kilt_data_path, 'kilt_temp_doc.txt')
-
-    try:
-        post_delete(project_name=project_name, store_domain=milvus_domain,
-                    parrot_domain=parrot_service_address, rerank=rerank)
-    except:
-        pass  # collection not exist, first time delete
-    post_create(project_name=project_name, store_domain=milvus_domain, parrot_domain=parrot_service_address,
-                rerank=rerank)
-    if doc_gen_type == 'multi':
-        post_upsert_kilt_with_multi_doc(project_name=project_name,
-                                        ks=knowledge_source,
-                                        wikipedia_id_set=wikipedia_id_set,
-                                        temp_file_path=temp_file_path,
-                                        store_domain=milvus_domain,
-                                        parrot_domain=parrot_service_address,
-                                        rerank=rerank)
-    else:
-        post_upsert_kilt(project_name=project_name,
-                         kilt_dataset_name=kilt_dataset_name,
-                         documents=documents,
-                         temp_file_path=temp_file_path,
-                         store_domain=milvus_domain,
-                         parrot_domain=parrot_service_address,
-                         rerank=rerank)
-
-    contexts_list = []
-    answer_list = []
+    search_cache = open_search_cache(search_cache_mode, search_cache_path, search_cache_max_entries)
+    parrot_client = get_parrot_client(parrot_service_address, milvus_domain)
+    search_fn = build_search_fn(kilt_run, parrot_client, search_cache, top_k=top_k, rerank=rerank,
+                                search_timeout=search_timeout, timer=timer)
 
     if metric_type == 'ragas_score':
-        for question in tqdm(question_list):
-            try:
-                answer, contexts = post_search(
-                    question,
-                    project_name,
-                    store_domain=milvus_domain,
-                    parrot_domain=parrot_service_address,
-                    top_k=top_k,
-                    rerank=rerank
-                )
-
-            except Exception as e:
-                print(e)
-                answer = 'failed. please retry.'
-                contexts = ['failed. please retry.']
-                print('failed. please retry')
-            contexts_list.append(contexts)
-            answer_list.append(answer)
-        ds = Dataset.from_dict({"question": question_list,
+        contexts_list = []
+        answer_list = []
+        with timer.stage('query'):
+            for answer, result_list, _ in iter_search_results(search_fn, kilt_run.question_list,
+                                                           search_concurrency=search_concurrency,
+                                                           search_retry_num=search_retry_num,
+                                                           offline=kilt_run.offline):
+                contexts = [res['chunk_text'] for res in result_list]
+                contexts_list.append(contexts)
+                answer_list.append(answer)
+        timer.add_count('queries', len(kilt_run.question_list))
+        if search_cache is not None:
+            print(f'search cache stats: {search_cache.stats()}')
+            search_cache.close()
+        ds = Dataset.from_dict({"question": kilt_run.question_list,
                                 "contexts": contexts_list,
                                 "answer": answer_list,
-                                "ground_truths": ground_truth_list})
+                                "ground_truths": kilt_run.ground_truth_list})
 
         # to huggingface dataset
-        save_dataset_with_timestamp(ds, output_dir, pre_name='kilt_res', save_csv=True)
-
-        result_list, multi_run_result = multi_evaluate_one_dataset(
-            ds,
-            metrics=[
-                context_precision,
-                context_recall,
-            ],
-            run_num=1,
-        )
-        save_results(output_dir, project_name, result_list, multi_run_result)
+        save_dataset_with_timestamp(ds, output_dir, pre_name='kilt_res', save_csv=False, save_json=False)
+
+        judge_cache = JudgeCache(judge_cache_path, bypass=judge_cache_bypass) if judge_cache_path else None
+        with timer.stage('ragas_evaluation'):
+            result_list, multi_run_result = multi_evaluate_one_dataset(
+                ds,
+                metrics=[
+                    context_precision,
+                    context_recall,
+                ],
+                run_num=1,
+                concurrency=ragas_concurrency,
+                requests_per_minute=ragas_requests_per_minute,
+                tokens_per_minute=ragas_tokens_per_minute,
+                judge_cache=judge_cache,
+            )
+        if judge_cache is not None:
+            print(f'judge cache stats: {judge_cache.stats()}')
+            judge_cache.close()
+        save_results(output_dir, project_name, result_list, multi_run_result,
+                     timing=build_timing_report(timer, knowledge_source, search_cache, judge_cache), save_csv=False)
         return result_list
     else:
-        data_jsonl_path = find_data_jsonl_path(kilt_dataset_name, 'dev', kilt_data_path)
-        gold_id_2_dict = dict()
-        with open(data_jsonl_path, 'r') as f:
-            for line in f:
-                gold_line_dict = json.loads(line)
-                gold_id_2_dict[gold_line_dict['id']] = gold_line_dict
-        guess_output_path = os.path.join(output_dir, 'guess_output.jsonl')
-        with open(guess_output_path, 'w') as f:
-            for ind, (input_, id_) in enumerate(tqdm(list(zip(input_list, id_list)))):
-                if pre_query_num and ind > pre_query_num:
-                    break
-                try:
-                    answer, contexts = post_search(
-                        input_,
-                        project_name,
-                        store_domain=milvus_domain,
-                        parrot_domain=parrot_service_address,
-                        top_k=top_k,
-                        rerank=rerank
-                    )
-                except Exception as e:
-                    print(e)
-                    answer = 'failed. please retry.'
-                    contexts = ['failed. please retry.']
-                    print('failed. please retry')
-                id_ = id_list[ind]
-                provenance = []
-                for ctx_ind, chunk_context in enumerate(contexts):
-                    wikipedia_id, src_context = find_wikipedia_id_by_gold(chunk_context.strip(), gold_id_2_dict[id_],
-                                                                          ks=knowledge_source)
-                    provenance_dict = {
-                        "wikipedia_id": str(wikipedia_id),
-                        "title": None,
-                        "section": None,
-                        "start_paragraph_id": None,  # int(paragraph_id),
-                        "start_character": None,
-                        "end_paragraph_id": None,  # int(paragraph_id),
-                        "end_character": None,
-                        "bleu_score": None,
-                        'meta': {
-                            'src_context': src_context,
-                            'chunk_context': chunk_context
-                        }
-                    }
-                    provenance.append(provenance_dict)
-                output = [{
-                    'answer': answer,
-                    "provenance": provenance
-                }]
-                output_dict = {
-                    'id': id_,
-                    'input': input_,
-                    'output': output,
-                }
-                one_line_res = json.dumps(output_dict)
-                f.write(one_line_res + '\n')
-
-        filtered_data_jsonl_path = os.path.join(output_dir, 'filtered_gold.jsonl')
-        filter_jsonl(data_jsonl_path, guess_output_path, filtered_data_jsonl_path, ks=knowledge_source)
-        eval_result = evaluate(gold=os.path.abspath(filtered_data_jsonl_path),
-                               guess=os.path.abspath(guess_output_path),
-                               ks=[1, 5],
-                               rank_keys=['wikipedia_id']
-                               )
-
-        useful_keys = ['Rprec', 'precision@1', 'precision@5', 'recall@5', 'success_rate@5']
-        eval_result = {key: value for key, value in eval_result.items() if key in useful_keys}
-        output_json_path = os.path.join(output_dir, 'eval_result.json')
+        gold_index = JsonlIndex(kilt_run.data_jsonl_path)
+        run_config = {
+            'kilt_dataset_name': kilt_dataset_name,
+            'pre_query_num': pre_query_num,
+            'top_k': top_k,
+            'rerank': rerank,
+            'corpus_manifest_hash': kilt_run.manifest_hash,
+            'provenance_match': 'doc_name' if kilt_run.doc_provenance is not None else 'fuzzy',
+        }
+        result_dir = output_dir
+        writer_run_config = run_config
+        query_inds = None
+        if shard is not None:
+            kilt_run, query_inds = shard_kilt_run(kilt_run, shard_ind, shard_num)
+            result_dir = get_shard_dir(output_dir, shard_ind, shard_num)
+            os.makedirs(result_dir, exist_ok=True)
+            writer_run_config = dict(run_config, shard=f'{shard_ind}/{shard_num}')
+            print(f'shard {shard_ind}/{shard_num}: {len(query_inds)} queries.')
+        guess_output_path = os.path.join(result_dir, 'guess_output.jsonl')
+        store_dir = os.path.join(result_dir, 'results')
+        query_kwargs = dict(search_concurrency=search_concurrency, search_retry_num=search_retry_num,
+                            checkpoint_every=checkpoint_every, match_workers=match_workers,
+                            pipeline_depth=pipeline_depth)
+        if adaptive_target_width is None:
+            run_kilt_queries(kilt_run, search_fn, gold_index, guess_output_path, writer_run_config, store_dir, ks=ks,
+                             query_inds=query_inds, resume=resume, timer=timer, **query_kwargs)
+        else:
+            query_inds, intervals, adaptive_report = run_adaptive_kilt_queries(
+                kilt_run, search_fn, gold_index, guess_output_path, writer_run_config, store_dir, ks=ks,
+                target_width=adaptive_target_width, batch_size=adaptive_batch_size,
+                min_queries=adaptive_min_queries, confidence=adaptive_confidence, seed=adaptive_seed,
+                resume=resume, timer=timer, **query_kwargs)
+        with timer.stage('scoring'):
+            eval_result = dict(summarize_kilt_result_store(store_dir))
+        gold_index.close()
+        if adaptive_target_width is not None:
+            # only the metrics are at the top level, the consumers of the result skip the 'adaptive' report
+            eval_result['adaptive'] = dict(adaptive_report, confidence_intervals=intervals)
+            print(confidence_intervals_2_md_table(intervals))
+        eval_result['timing'] = build_timing_report(timer, knowledge_source, search_cache,
+                                                    doc_provenance=kilt_run.doc_provenance)
+        if search_cache is not None:
+            search_cache.close()
+        print(timing_2_md_table(eval_result['timing']))
+        if shard is None:
+            output_json_path = os.path.join(output_dir, 'eval_result.json')
+        else:
+            # the metrics of one shard are only for monitoring, the merge scores the guess records of all the shards
+            eval_result['shard'] = {
+                'shard': f'{shard_ind}/{shard_num}',
+                'run_config': run_config,
+                'ks': list(ks),
+                'query_inds': query_inds,
+                'ids': kilt_run.id_list,
+            }
+            output_json_path = os.path.join(result_dir, 'partial_result.json')
         with open(output_json_path, 'w') as fw:
             fw.write(json.dumps(eval_result, indent=4))
             print(f'save result to {output_json_path}')
-        return eval_result
\ No newline at end of file
+        return eval_result
+
+
+def load_shard_partials(output_dir, shard_num=None):
+    """Return the list of (shard_dir, partial result) of the shards of `shard_num` in `output_dir`, sorted by shard."""
+    shard_root = os.path.join(output_dir, 'shards')
+    partials = []
+    for shard_dir_name in sorted(os.listdir(shard_root)) if os.path.isdir(shard_root) else []:
+        partial_path = os.path.join(shard_root, shard_dir_name, 'partial_result.json')
+        if os.path.exists(partial_path):
+            with open(partial_path, 'r') as f:
+                partials.append((os.path.join(shard_root, shard_dir_name), json.load(f)))
+    assert partials, f'no partial result of any shard found in {shard_root}.'
+    shard_num_set = {parse_shard(partial['shard']['shard'])[1] for _, partial in partials}
+    if shard_num is None:
+        assert len(shard_num_set) == 1, f'partials of several shard numbers {sorted(shard_num_set)} found, ' \
+                                        f'set shard_num to choose one.'
+        shard_num = shard_num_set.pop()
+    partials = [(shard_dir, partial) for shard_dir, partial in partials
+                if parse_shard(partial['shard']['shard'])[1] == shard_num]
+    partials.sort(key=lambda item: parse_shard(item[1]['shard']['shard'])[0])
+    shard_inds = [parse_shard(partial['shard']['shard'])[0] for _, partial in partials]
+    missing_shard_inds = sorted(set(range(shard_num)) - set(shard_inds))
+    assert not missing_shard_inds, f'the partial results of shards {missing_shard_inds} of {shard_num} are missing.'
+    return partials
+
+
+def merge_parrot_kilt_shards(result_name: str = 'kilt_parrot_evaluation_res',
+                             shard_num: int = None,
+                             ks: list = None,
+                             ):
+    """
+    Merge the partial results of all the shards of a sharded kilt_score run into `eval_result.json` of the output dir.
+    The guess records and the chunks of the shards are streamed into the result store of the output dir
+    and scored again, so the metrics are exactly the same as an unsharded run of the same config.
+
+    Args:
+        result_name (`str`):
+            The result_name of the sharded runs, default is 'kilt_parrot_evaluation_res'.
+        shard_num (`int`):
+            The N of the shards to merge, default is None, which requires partials of only one N in the output dir.
+        ks (`list`):
+            The k list of the metrics, default is None, which uses the ks of the shard runs.
+    """
+    output_dir = os.path.join('./outputs/kilt', result_name)
+    partials = load_shard_partials(output_dir, shard_num)
+    run_config = partials[0][1]['shard']['run_config']
+    for _, partial in partials:
+        assert partial['shard']['run_config'] == run_config, \
+            f'shard {partial["shard"]["shard"]} has a different run config {partial["shard"]["run_config"]}, ' \
+            f'expect {run_config}.'
+    if ks is None:
+        ks = partials[0][1]['shard']['ks']
+
+    kilt_data_path = './datasets/kilt_data'
+    os.makedirs(kilt_data_path, exist_ok=True)
+    download_kilt_jsonl(kilt_data_path, run_config['kilt_dataset_name'])
+    gold_index = JsonlIndex(find_data_jsonl_path(run_config['kilt_dataset_name'], 'dev', kilt_data_path))
+    store_dir = os.path.join(output_dir, 'results')
+    store_writer = KiltResultStoreWriter(store_dir, ks=ks)
+    covered_inds = set()
+    try:
+        # the guess records and the chunks of the shards are streamed into the store, the metrics are scored again
+        for shard_dir, partial in partials:
+            for batch in iter_record_batches(os.path.join(shard_dir, 'results', CHUNKS_NAME)):
+                store_writer.add_chunk_batch(batch)
+            id_2_ind = dict(zip(partial['shard']['ids'], partial['shard']['query_inds']))
+            record_num = 0
+            with open(os.path.join(shard_dir, 'guess_output.jsonl'), 'r') as f:
+                for guess_record in map(json.loads, f):
+                    ind = id_2_ind[guess_record['id']]
+                    assert ind not in covered_inds, f'query {guess_record["id"]} is in more than one shard.'
+                    assert store_writer.has_chunks(guess_record), \
+                        f'the chunks of query {guess_record["id"]} are missing in the store of {shard_dir}.'
+                    store_writer.append(ind, guess_record, gold_index.get(guess_record['id']))
+                    covered_inds.add(ind)
+                    record_num += 1
+            assert record_num == len(id_2_ind), \
+                f'{len(id_2_ind) - record_num} queries of shard {partial["shard"]["shard"]} have no guess record.'
+    finally:
+        store_writer.close()
+        gold_index.close()
+    assert covered_inds == set(range(len(covered_inds))), 'the shards do not cover the queries exactly.'
+    eval_result = dict(summarize_kilt_result_store(store_dir))
+    print(f'merge {len(partials)} shards of {len(covered_inds)} queries: {eval_result}')
+    eval_result['timing'] = {'shards': {partial['shard']['shard']: partial['timing'] for _, partial in partials}}
+    output_json_path = os.path.join(output_dir, 'eval_result.json')
+    with open(output_json_path, 'w') as fw:
+        fw.write(json.dumps(eval_result, indent=4))
+        print(f'save result to {output_json_path}')
+    return eval_result
+
+
+def eval_parrot_kilt_top_k_sweep(kilt_dataset_name: str = 'hotpotqa',
+                                 kilt_wiki_mongo_domain: str = '127.0.0.1',
+                                 milvus_domain: str = '127.0.0.1',
+                                 parrot_service_address: str = 'http://127.0.0.1:8999',
+                                 result_name: str = 'kilt_parrot_evaluation_res',
+                                 top_k_list: list = (1, 3, 5, 10, 20, 50),
+                                 rerank_list: list = (False,),
+                                 pre_query_num: int = 200,
+                                 doc_gen_type: str = 'multi',
+                                 use_snapshot: bool = True,
+                                 snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+                                 search_concurrency: int = 8,
+                                 search_timeout: float = 60,
+                                 search_retry_num: int = 3,
+                                 upsert_concurrency: int = 8,
+                                 force_reingest: bool = False,
+                                 resume: bool = True,
+                                 checkpoint_every: int = 20,
+                                 match_workers: int = None,
+                                 pipeline_depth: int = 64,
+                                 search_cache_mode: str = 'read_write',
+                                 search_cache_path: str = None,
+                                 search_cache_max_entries: int = 200000,
+                                 ks: list = (1, 5),
+                                 knowledge_source=None,
+                                 ):
+    """
+    Evaluate the kilt_score metrics of parrot for every top_k of `top_k_list` in one pass.
+    The corpus is ingested once, and every query is searched once per rerank option with the max top_k
+    into the result store `sweep_results_{rerank_name}_top{max_top_k}` of the output dir,
+    then the metrics of a smaller top_k are computed on the hits of the store ranked before it,
+    which is the same as a separate run with that top_k, as long as parrot returns the top_k results as a prefix.
+
+    The other args are the same as `eval_parrot_kilt`, with `metric_type` fixed to 'kilt_score'.
+
+    Args:
+        top_k_list (`list`):
+            The top_k values to evaluate, default is (1, 3, 5, 10, 20, 50).
+        rerank_list (`list`):
+            The rerank options to evaluate, (False, True) compares searching without and with rerank,
+            default is (False,).
+    """
+    assert top_k_list, 'top_k_list should not be empty.'
+    top_k_list = sorted(set(int(top_k) for top_k in top_k_list))
+    max_top_k = top_k_list[-1]
+    timer = StageTimer()
+    kilt_run = prepare_kilt_run(kilt_dataset_name=kilt_dataset_name,
+                                kilt_wiki_mongo_domain=kilt_wiki_mongo_domain,
+                                milvus_domain=milvus_domain,
+                                parrot_service_address=parrot_service_address,
+                                result_name=result_name,
+                                pre_query_num=pre_query_num,
+                                doc_gen_type=doc_gen_type,
+                                use_snapshot=use_snapshot,
+                                snapshot_dir=snapshot_dir,
+                                upsert_concurrency=upsert_concurrency,
+                                force_reingest=force_reingest,
+                                search_cache_mode=search_cache_mode,
+                                knowledge_source=knowledge_source,
+                                timer=timer)
+    output_dir = kilt_run.output_dir
+    search_cache = open_search_cache(search_cache_mode, search_cache_path, search_cache_max_entries)
+    parrot_client = get_parrot_client(parrot_service_address, milvus_domain)
+    gold_index = JsonlIndex(kilt_run.data_jsonl_path)
+
+    sweep_result = dict()
+    for rerank in rerank_list:
+        rerank = rerank or None
+        rerank_name = f'rerank_{rerank}' if rerank else 'no_rerank'
+        print(f'search {len(kilt_run.id_list)} queries with top_k = {max_top_k}, {rerank_name}.')
+        search_fn = build_search_fn(kilt_run, parrot_client, search_cache, top_k=max_top_k, rerank=rerank,
+                                    search_timeout=search_timeout, timer=timer)
+        guess_output_path = os.path.join(output_dir, f'sweep_guess_output_{rerank_name}_top{max_top_k}.jsonl')
+        run_config = {
+            'kilt_dataset_name': kilt_dataset_name,
+            'pre_query_num': pre_query_num,
+            'top_k': max_top_k,
+            'rerank': rerank,
+            'corpus_manifest_hash': kilt_run.manifest_hash,
+            'provenance_match': 'doc_name' if kilt_run.doc_provenance is not None else 'fuzzy',
+        }
+        store_dir = os.path.join(output_dir, f'sweep_results_{rerank_name}_top{max_top_k}')
+        run_kilt_queries(kilt_run, search_fn, gold_index, guess_output_path, run_config, store_dir, ks=ks,
+                         search_concurrency=search_concurrency, search_retry_num=search_retry_num,
+                         resume=resume, checkpoint_every=checkpoint_every,
+                         match_workers=match_workers, pipeline_depth=pipeline_depth, timer=timer)
+        with timer.stage('scoring'):
+            sweep_result[rerank_name] = {
+                f'top_{top_k}': dict(summarize_kilt_hits(store_dir, gold_index.get, ks=ks, top_k=top_k))
+                for top_k in top_k_list
+            }
+    print(timing_2_md_table(build_timing_report(timer, kilt_run.knowledge_source, search_cache,
+                                                doc_provenance=kilt_run.doc_provenance)))
+    if search_cache is not None:
+        search_cache.close()
+    gold_index.close()
+
+    print(sweep_results_2_md_table(sweep_result))
+    output_json_path = os.path.join(output_dir, 'top_k_sweep_result.json')
+    with open(output_json_path, 'w') as fw:
+        fw.write(json.dumps(sweep_result, indent=4))
+        print(f'save result to {output_json_path}')
+    return sweep_result
+
+
+KILT_DATASET_NAMES = ['fever', 'triviaqa', 'wow', 'eli5', 'hotpotqa', 'nq', 'structured_zeroshot', 'trex']
+
+
+def eval_parrot_kilt_multi_dataset(kilt_dataset_name_list: list = KILT_DATASET_NAMES,
+                                   kilt_wiki_mongo_domain: str = '127.0.0.1',
+                                   milvus_domain: str = '127.0.0.1',
+                                   parrot_service_address: str = 'http://127.0.0.1:8999',
+                                   result_name: str = 'kilt_parrot_evaluation_res',
+                                   dataset_concurrency: int = 4,
+                                   max_in_flight: int = 32,
+                                   **kwargs,
+                                   ):
+    """
+    Evaluate the kilt_score metrics of parrot on several kilt datasets in one process.
+    The datasets are prepared, ingested and queried concurrently, and share the kilt page cache,
+    the mongo client and the HTTP connection pool of parrot.
+    The result of each dataset is saved in its own output dir named `{result_name}_{kilt_dataset_name}` as usual,
+    and the combined report of all datasets is saved as `combined_eval_result.json` in the output dir `result_name`.
+
+    Args:
+        kilt_dataset_name_list (`list`):
+            The kilt datasets to evaluate, default is all of ['fever', 'triviaqa', 'wow', 'eli5', 'hotpotqa', 'nq',
+            'structured_zeroshot', 'trex'].
+        dataset_concurrency (`int`):
+            The max number of datasets evaluated at the same time, default is 4.
+        max_in_flight (`int`):
+            The global max number of parrot requests in flight of all the datasets, upserts and searches included.
+            Set None for no global limit, then each dataset is only limited by its own
+            `search_concurrency` and `upsert_concurrency`. Default is 32.
+        The other args are passed to `eval_parrot_kilt`, except `metric_type`, which is always 'kilt_score',
+        and `shard`, which is not supported.
+    """
+    assert kwargs.get('metric_type', 'kilt_score') == 'kilt_score', 'only kilt_score is supported for multi datasets.'
+    assert kwargs.get('shard') is None, 'shard is not supported for multi datasets, shard each dataset on its own.'
+    kwargs.pop('metric_type', None)
+    kwargs.pop('shard', None)
+    kilt_dataset_name_list = list(dict.fromkeys(kilt_dataset_name_list))
+    get_parrot_client(parrot_service_address, milvus_domain).set_max_in_flight(max_in_flight)
+
+    def eval_one(kilt_dataset_name):
+        return eval_parrot_kilt(kilt_dataset_name=kilt_dataset_name,
+                                kilt_wiki_mongo_domain=kilt_wiki_mongo_domain,
+                                milvus_domain=milvus_domain,
+                                parrot_service_address=parrot_service_address,
+                                result_name=f'{result_name}_{kilt_dataset_name}',
+                                metric_type='kilt_score',
+                                **kwargs)
+
+    dataset_2_result = dict()
+    dataset_2_error = dict()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, dataset_concurrency)) as executor:
+            future_2_name = {executor.submit(eval_one, name): name for name in kilt_dataset_name_list}
+            for future in as_completed(future_2_name):
+                kilt_dataset_name = future_2_name[future]
+                try:
+                    dataset_2_result[kilt_dataset_name] = future.result()
+                    print(f'finish evaluating {kilt_dataset_name}.')
+                except Exception as e:
+                    print(f'failed to evaluate {kilt_dataset_name}: {e!r}')
+                    dataset_2_error[kilt_dataset_name] = repr(e)
+    finally:
+        get_parrot_client(parrot_service_address, milvus_domain).set_max_in_flight(None)
+
+    dataset_2_timing = {name: dataset_2_result[name].pop('timing') for name in kilt_dataset_name_list
+                        if name in dataset_2_result}
+    dataset_2_result = {name: dataset_2_result[name] for name in kilt_dataset_name_list if name in dataset_2_result}
+    # the metrics of every dataset are read from its result store, which only has the numeric metrics
+    dataset_2_metrics = {
+        name: dict(summarize_kilt_result_store(os.path.join('./outputs/kilt', f'{result_name}_{name}', 'results')))
+        for name in dataset_2_result
+    }
+    metric_names = []
+    for metrics in dataset_2_metrics.values():
+        metric_names += [name for name in metrics if name not in metric_names]
+    macro_average = dict()
+    for name in metric_names:
+        values = [metrics[name] for metrics in dataset_2_metrics.values() if name in metrics]
+        macro_average[name] = sum(values) / len(values)
+    combined_result = {
+        'datasets': dataset_2_result,
+        'macro_average': macro_average,
+        'failed': dataset_2_error,
+        'timing': dataset_2_timing,
+    }
+    print(multi_dataset_results_2_md_table(dict(dataset_2_metrics, macro_average=macro_average)))
+    if dataset_2_error:
+        print(f'{len(dataset_2_error)} datasets failed: {list(dataset_2_error)}')
+
+    output_dir = os.path.join('./outputs/kilt', result_name)
+    os.makedirs(output_dir, exist_ok=True)
+    output_json_path = os.path.join(output_dir, 'combined_eval_result.json')
+    with open(output_json_path, 'w') as fw:
+        fw.write(json.dumps(combined_result, indent=4))
+        print(f'save combined result to {output_json_path}')
+    return combined_result
@@ -0,0 +1,124 @@
+import json
+import os
+
+import numpy as np
+
+from evalparrot.evaluate_parrot_kilt import prepare_kilt_run, build_guess_record
+from evalparrot.metric.utils.dataset.jsonl_index import JsonlIndex
+from evalparrot.metric.utils.dataset.paragraph_snapshot import DEFAULT_SNAPSHOT_DIR
+from evalparrot.metric.utils.io import load_test_results_2_md_table
+from evalparrot.metric.utils.parrot_utils.http_utils import ParrotClient
+from evalparrot.metric.utils.parrot_utils.load_generator import run_open_loop_level, summarize_level
+from evalparrot.metric.utils.result_store import KiltResultStoreWriter, summarize_kilt_result_store
+
+
+def load_test_parrot_kilt(kilt_dataset_name: str = 'hotpotqa',
+                          kilt_wiki_mongo_domain: str = '127.0.0.1',
+                          milvus_domain: str = '127.0.0.1',
+                          parrot_service_address: str = 'http://127.0.0.1:8999',
+                          result_name: str = 'kilt_parrot_evaluation_res',
+                          qps_list: list = (1, 2, 5, 10, 20, 50),
+                          level_duration: float = 30,
+                          arrival: str = 'poisson',
+                          max_workers: int = 256,
+                          max_error_rate: float = None,
+                          top_k: int = 10,
+                          rerank: bool = False,
+                          pre_query_num: int = 200,
+                          doc_gen_type: str = 'multi',
+                          use_snapshot: bool = True,
+                          snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+                          search_timeout: float = 60,
+                          upsert_concurrency: int = 8,
+                          force_reingest: bool = False,
+                          ks: list = (1, 5),
+                          seed: int = 0,
+                          knowledge_source=None,
+                          ):
+    """
+    Load test the parrot search api with the prepared kilt queries, ramping through the target QPS of `qps_list`.
+    The requests are sent open loop, at the scheduled arrival times regardless of the responses,
+    so the latency percentiles include the queueing of an overloaded parrot instead of hiding it.
+    Every level reports the throughput, error rate and latency percentiles,
+    and the kilt_score metrics of the responses got under that load, where a failed request counts as a miss.
+    The responses of every level are saved in the result store `load_test_results/qps_{target_qps}` of the output dir,
+    and the metrics of the level are summarized from it.
+    The search cache is never used. The result is saved as `load_test_result.json` in the output dir.
+
+    Args:
+        qps_list (`list`):
+            The target QPS of each load level, in the order to run, default is (1, 2, 5, 10, 20, 50).
+        level_duration (`float`):
+            The seconds of each load level, the queries are cycled if there are fewer than QPS * duration.
+            Default is 30.
+        arrival (`str`):
+            Available options include ['poisson', 'uniform'], the distribution of the request arrivals.
+            Default is 'poisson'.
+        max_workers (`int`):
+            The max number of requests in flight, it should be large enough to never delay a scheduled request,
+            a delayed request is reported in `send_lag` and its delay is counted in the latency. Default is 256.
+        max_error_rate (`float`):
+            Stop ramping after a level with a higher error rate, default is None, which runs all the levels.
+        seed (`int`):
+            The random seed of the poisson arrivals, default is 0.
+        The other args are the same as `eval_parrot_kilt`.
+    """
+    if rerank is False:
+        rerank = None
+    kilt_run = prepare_kilt_run(kilt_dataset_name=kilt_dataset_name,
+                                kilt_wiki_mongo_domain=kilt_wiki_mongo_domain,
+                                milvus_domain=milvus_domain,
+                                parrot_service_address=parrot_service_address,
+                                result_name=result_name,
+                                rerank=rerank,
+                                pre_query_num=pre_query_num,
+                                doc_gen_type=doc_gen_type,
+                                use_snapshot=use_snapshot,
+                                snapshot_dir=snapshot_dir,
+                                upsert_concurrency=upsert_concurrency,
+                                force_reingest=force_reingest,
+                                search_cache_mode='off',
+                                knowledge_source=knowledge_source)
+    # a dedicated client, so that the connection pool is as large as the requests in flight
+    parrot_client = ParrotClient(parrot_service_address, milvus_domain, pool_size=max_workers)
+    gold_index = JsonlIndex(kilt_run.data_jsonl_path)
+    rng = np.random.default_rng(seed)
+
+    def request_fn(query):
+        return parrot_client.search(query, kilt_run.project_name, top_k=top_k, rerank=rerank,
+                                    timeout=search_timeout)
+
+    level_results = []
+    for target_qps in qps_list:
+        print(f'load test at {target_qps} QPS for {level_duration} s.')
+        samples = run_open_loop_level(request_fn, kilt_run.input_list, target_qps, level_duration,
+                                      max_workers=max_workers, arrival=arrival, rng=rng)
+        level_result = summarize_level(samples, target_qps)
+        store_dir = os.path.join(kilt_run.output_dir, 'load_test_results', f'qps_{target_qps}')
+        store_writer = KiltResultStoreWriter(store_dir, ks=ks)
+        for sample in samples:
+            id_ = kilt_run.id_list[sample.query_ind]
+            result_list = sample.result or []
+            gold_record = gold_index.get(id_)
+            guess_record = build_guess_record(id_, kilt_run.input_list[sample.query_ind], 'no answer.', result_list,
+                                              gold_record, kilt_run.knowledge_source, kilt_run.doc_provenance)
+            guess_record['search_latency'] = sample.end_time - sample.scheduled_time
+            store_writer.append(sample.query_ind, guess_record, gold_record,
+                                [res['chunk_text'] for res in result_list])
+        store_writer.close()
+        level_result['metrics'] = dict(summarize_kilt_result_store(store_dir))
+        level_results.append(level_result)
+        print(f'level {target_qps} QPS: throughput = {level_result["throughput"]}, '
+              f'error_rate = {level_result["error_rate"]}, latency = {level_result["latency"]}')
+        if max_error_rate is not None and level_result['error_rate'] > max_error_rate:
+            print(f'error rate {level_result["error_rate"]} > {max_error_rate}, stop ramping.')
+            break
+    gold_index.close()
+    parrot_client.close()
+
+    print(load_test_results_2_md_table(level_results))
+    output_json_path = os.path.join(kilt_run.output_dir, 'load_test_result.json')
+    with open(output_json_path, 'w') as fw:
+        fw.write(json.dumps(level_results, indent=4))
+        print(f'save result to {output_json_path}')
+    return level_results
@@ -0,0 +1,56 @@
+import math
+from statistics import NormalDist
+
+import numpy as np
+
+
+def z_score(confidence=0.95):
+    return NormalDist().inv_cdf(0.5 + confidence / 2)
+
+
+def wilson_interval(success_num, total_num, confidence=0.95):
+    """The Wilson score interval of a proportion, which stays inside [0, 1] and is sound for a proportion near 0 or 1."""
+    if total_num == 0:
+        return 0.0, 1.0
+    z = z_score(confidence)
+    p = success_num / total_num
+    denominator = 1 + z ** 2 / total_num
+    center = (p + z ** 2 / (2 * total_num)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / total_num + z ** 2 / (4 * total_num ** 2)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def bootstrap_interval(values, confidence=0.95, resample_num=1000, seed=0, block_size=100):
+    """The percentile bootstrap interval of the mean of `values`, resampled in blocks to bound the memory."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return 0.0, 1.0
+    rng = np.random.default_rng(seed)
+    means = []
+    for block_start in range(0, resample_num, block_size):
+        block_num = min(block_size, resample_num - block_start)
+        means.append(values[rng.integers(0, len(values), size=(block_num, len(values)))].mean(axis=1))
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(np.concatenate(means), [alpha, 1 - alpha])
+    return float(lower), float(upper)
+
+
+def metric_interval(values, confidence=0.95, resample_num=1000, seed=0):
+    """
+    Return the estimate and the confidence interval of the mean of the per-query values of a metric.
+    A 0/1 metric like success_rate@k uses the Wilson interval, and the others like recall@k the bootstrap interval.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if np.all((values == 0) | (values == 1)):
+        method = 'wilson'
+        lower, upper = wilson_interval(float(values.sum()), len(values), confidence)
+    else:
+        method = 'bootstrap'
+        lower, upper = bootstrap_interval(values, confidence, resample_num, seed)
+    return {
+        'estimate': float(values.mean()) if len(values) else 0.0,
+        'lower': lower,
+        'upper': upper,
+        'width': upper - lower,
+        'method': method,
+    }
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# The rank and Rprec computation follows kilt.eval_retrieval, so that the metrics are the same as KILT's,
+# while all the metrics of all k are computed together over numpy arrays of per-query rank hits.
+
+
+def _join_rank_keys(provenance, rank_keys):
+    return '+'.join([str(provenance[rank_key]).strip() for rank_key in rank_keys])
+
+
+def _remove_duplicates(ids):
+    return list(dict.fromkeys(ids))
+
+
+def get_gold_ids_list(gold_item, rank_keys=('wikipedia_id',)):
+    ids_list = []
+    for output in gold_item['output']:
+        current_ids_list = []
+        for provenance in output.get('provenance', []):
+            if any(rank_key not in provenance for rank_key in rank_keys):
+                continue
+            current_ids_list.append(_join_rank_keys(provenance, rank_keys))
+        ids_list.append(_remove_duplicates(current_ids_list))
+    return ids_list
+
+
+def get_guess_ids(guess_item, rank_keys=('wikipedia_id',)):
+    return [_join_rank_keys(provenance, rank_keys) for provenance in guess_item['output'][0].get('provenance', [])
+            if all(rank_key in provenance for rank_key in rank_keys)]
+
+
+def get_rank(guess_ids, gold_item, rank_keys=('wikipedia_id',)):
+    """
+    Every evidence set of the gold item counts as a single point in the rank,
+    and its position is given by the last of its pages in the guess ids.
+    Return the rank, a list of True (a complete evidence set), False or a partial evidence set marker,
+    and the number of distinct evidence sets.
+    """
+    guess_ids = _remove_duplicates(str(guess_id).strip() for guess_id in guess_ids)
+    if not guess_ids:
+        return [], 0
+    evidence_sets = []
+    for output in gold_item['output']:
+        if 'provenance' in output:
+            e_set = {_join_rank_keys(provenance, rank_keys) for provenance in output['provenance']}
+            if e_set not in evidence_sets:
+                evidence_sets.append(e_set)
+
+    rank = []
+    for guess_id in guess_ids:
+        found = False
+        for idx, e_set in enumerate(evidence_sets):
+            e_set_id = f'evidence_set:{idx}'
+            if guess_id in e_set:
+                found = True
+                if e_set_id in rank:
+                    rank.remove(e_set_id)
+                e_set.remove(guess_id)
+                if len(e_set) == 0:
+                    rank.append(True)
+                else:
+                    rank.append(e_set_id)
+        if not found:
+            rank.append(False)
+    return rank, len(evidence_sets)
+
+
+def rprecision(guess_ids, gold_item, rank_keys=('wikipedia_id',)):
+    guess_ids = _remove_duplicates(str(guess_id).strip() for guess_id in guess_ids)
+    rprec_list = []
+    for gold_ids in get_gold_ids_list(gold_item, rank_keys):
+        r = len(gold_ids)
+        num = sum(1 for prediction in guess_ids[:r] if prediction in gold_ids)
+        rprec_list.append(num / r if r > 0 else 0)
+    return max(rprec_list)
+
+
+def build_rank_hits(guess_ids_list, gold_item_list, rank_keys=('wikipedia_id',), min_width=1):
+    """
+    Return the bool array of rank hits with shape (query_num, width),
+    the array of the number of distinct evidence sets, and the array of Rprec of each query.
+    """
+    assert len(guess_ids_list) == len(gold_item_list), \
+        f'different size gold: {len(gold_item_list)} guess: {len(guess_ids_list)}'
+    rank_list = []
+    num_evidence_sets = np.zeros(len(gold_item_list), dtype=np.int64)
+    rprec = np.zeros(len(gold_item_list), dtype=np.float64)
+    for ind, (guess_ids, gold_item) in enumerate(zip(guess_ids_list, gold_item_list)):
+        rank, num_evidence_sets[ind] = get_rank(guess_ids, gold_item, rank_keys)
+        rank_list.append(rank)
+        rprec[ind] = rprecision(guess_ids, gold_item, rank_keys)
+    width = max([min_width] + [len(rank) for rank in rank_list])
+    hits = np.zeros((len(rank_list), width), dtype=bool)
+    for ind, rank in enumerate(rank_list):
+        hits[ind, :len(rank)] = [point is True for point in rank]
+    return hits, num_evidence_sets, rprec
+
+
+def compute_per_query_metrics(hits, num_evidence_sets, rprec, ks=(1, 5)):
+    """Return the ordered dict of metric name to the array of its value of each query."""
+    ks = sorted(int(k) for k in ks)
+    if hits.shape[1] < max(ks):
+        hits = np.pad(hits, ((0, 0), (0, max(ks) - hits.shape[1])))
+    has_evidence = num_evidence_sets > 0
+    safe_num_evidence_sets = np.maximum(num_evidence_sets, 1)
+    cum_hits = np.cumsum(hits, axis=1)
+    discounts = 1.0 / np.log2(np.arange(hits.shape[1]) + 2)
+    cum_dcg = np.cumsum(hits * discounts, axis=1)
+    cum_discounts = np.cumsum(discounts)
+
+    metrics = OrderedDict()
+    metrics['Rprec'] = rprec
+    for k in ks:
+        if k > 0:
+            metrics[f'precision@{k}'] = np.where(has_evidence, cum_hits[:, k - 1] / k, 0.0)
+        if k > 1:
+            metrics[f'recall@{k}'] = np.where(has_evidence, cum_hits[:, k - 1] / safe_num_evidence_sets, 0.0)
+            metrics[f'success_rate@{k}'] = np.where(has_evidence, cum_hits[:, k - 1] > 0, 0.0).astype(np.float64)
+    first_hit = np.argmax(hits, axis=1)
+    metrics['MRR'] = np.where(hits.any(axis=1), 1.0 / (first_hit + 1), 0.0)
+    for k in ks:
+        if k > 0:
+            ideal_num = np.minimum(num_evidence_sets, k)
+            idcg = np.where(ideal_num > 0, cum_discounts[np.maximum(ideal_num, 1) - 1], 1.0)
+            metrics[f'nDCG@{k}'] = np.where(has_evidence, cum_dcg[:, k - 1] / idcg, 0.0)
+    return metrics
+
+
+def aggregate_metrics(per_query_metrics):
+    return OrderedDict((name, float(np.mean(values)) if len(values) else 0.0)
+                       for name, values in per_query_metrics.items())
+
+
+def compute_per_query_retrieval_metrics(guess_ids_list, gold_item_list, ks=(1, 5), rank_keys=('wikipedia_id',)):
+    """The per-query values of the metrics of `compute_retrieval_metrics`."""
+    hits, num_evidence_sets, rprec = build_rank_hits(guess_ids_list, gold_item_list, rank_keys)
+    return compute_per_query_metrics(hits, num_evidence_sets, rprec, ks)
+
+
+def compute_retrieval_metrics(guess_ids_list, gold_item_list, ks=(1, 5), rank_keys=('wikipedia_id',)):
+    """
+    Compute Rprec, precision@k, recall@k, success_rate@k as KILT does, plus MRR and nDCG@k, for every k of `ks`.
+    `guess_ids_list` is the ranked guess ids of each query, and `gold_item_list` the kilt gold record of each query.
+    """
+    return aggregate_metrics(compute_per_query_retrieval_metrics(guess_ids_list, gold_item_list, ks, rank_keys))
@@ -0,0 +1,157 @@
+import json
+import os
+import queue
+import threading
+
+
+def _fsync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class ResumableJsonlWriter:
+    """
+    Append-only jsonl writer which can resume an interrupted run.
+    Records are appended and fsync'd in batches of `fsync_every`.
+    When the file is reopened with the same `run_config`, the records already written are kept,
+    and the keys of the valid ones are in `completed_keys`, so only the other records need to be produced again.
+    A different `run_config` or `resume=False` starts the file from scratch.
+    Only the byte span of the latest record of every key is kept in memory, the records are read back from the file.
+    """
+
+    def __init__(self, path, run_config, key='id', is_valid=None, fsync_every=20, resume=True):
+        self.path = path
+        self.meta_path = path + '.meta.json'
+        self.run_config = run_config
+        self.key = key
+        self.is_valid = is_valid if is_valid is not None else (lambda record: True)
+        self.fsync_every = fsync_every
+        self.key_2_span = dict()
+        self.completed_keys = set()
+
+        if resume and self._load_meta() == run_config and os.path.exists(path):
+            self._load_records()
+        else:
+            with open(path, 'w') as f:
+                _fsync_file(f)
+            with open(self.meta_path, 'w') as f:
+                f.write(json.dumps(run_config, indent=4))
+                _fsync_file(f)
+        if self.key_2_span:
+            print(f'resume from {path}: {len(self.completed_keys)} completed, '
+                  f'{len(self.key_2_span) - len(self.completed_keys)} to redo.')
+        self._f = open(path, 'ab')
+        self._size = os.path.getsize(path)
+        self._unsynced_num = 0
+
+    def _load_meta(self):
+        if not os.path.exists(self.meta_path):
+            return None
+        with open(self.meta_path, 'r') as f:
+            return json.load(f)
+
+    def _load_records(self):
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                # a line without newline is the half-written tail of an interrupted run
+                if not line.endswith(b'\n'):
+                    break
+                record = json.loads(line)
+                self._add_span(record, valid_size, len(line))
+                valid_size += len(line)
+        with open(self.path, 'r+b') as f:
+            f.truncate(valid_size)
+
+    def _add_span(self, record, offset, length):
+        key_ = record[self.key]
+        self.key_2_span[key_] = (offset, length)
+        if self.is_valid(record):
+            self.completed_keys.add(key_)
+        else:
+            self.completed_keys.discard(key_)
+
+    def write(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        self._f.write(line)
+        self._add_span(record, self._size, len(line))
+        self._size += len(line)
+        self._unsynced_num += 1
+        if self._unsynced_num >= self.fsync_every:
+            self.flush()
+
+    def flush(self):
+        _fsync_file(self._f)
+        self._unsynced_num = 0
+
+    def iter_records(self, keys):
+        """Yield the latest record of every key of `keys` which has one, in that order."""
+        self._f.flush()
+        with open(self.path, 'rb') as f:
+            for key_ in keys:
+                span = self.key_2_span.get(key_)
+                if span is not None:
+                    f.seek(span[0])
+                    yield json.loads(f.read(span[1]))
+
+    def finalize(self, key_order):
+        """Rewrite the file with exactly one record per key in `key_order`, the latest one, and return the number."""
+        self.flush()
+        temp_path = self.path + '.tmp'
+        record_num = 0
+        with open(temp_path, 'w') as f:
+            for record in self.iter_records(key_order):
+                f.write(json.dumps(record) + '\n')
+                record_num += 1
+            _fsync_file(f)
+        self._f.close()
+        os.replace(temp_path, self.path)
+        return record_num
+
+
+class BackgroundWriter:
+    """
+    Serialize the calls of `write_fn` in one writer thread, fed by a queue of at most `max_queue_size` records.
+    `put()` blocks while the queue is full, so a slow disk holds back the producer instead of buffering in memory.
+    With a `timer`, the queue depth is sampled as the 'write_queue' and the blocked time as the 'write_wait' stage.
+    """
+
+    def __init__(self, write_fn, max_queue_size=64, timer=None):
+        self.write_fn = write_fn
+        self.timer = timer
+        self._queue = queue.Queue(maxsize=max(1, max_queue_size))
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            if self._error is None:
+                try:
+                    self.write_fn(record)
+                except Exception as e:
+                    # keep draining the queue, so the producer is not blocked, and raise the error on its side
+                    self._error = e
+
+    def put(self, record):
+        if self._error is not None:
+            raise self._error
+        if self.timer is None:
+            self._queue.put(record)
+            return
+        self.timer.record_depth('write_queue', self._queue.qsize())
+        if self._queue.full():
+            with self.timer.stage('write_wait'):
+                self._queue.put(record)
+        else:
+            self._queue.put(record)
+
+    def close(self):
+        """Wait until all the records put are written, and raise the error of the writer thread if any."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
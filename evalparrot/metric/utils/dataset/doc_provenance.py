@@ -0,0 +1,132 @@
+import json
+import os
+import sqlite3
+import threading
+from functools import lru_cache
+
+DOC_PROVENANCE_NAME = 'doc_provenance.sqlite'
+
+
+def build_doc_paragraphs(page):
+    """The paragraphs of the document text of `build_wiki_doc_text(page)`, in the same order."""
+    return [('\n' if '::::' in page_text else '') + page_text for page_text in page['text']]
+
+
+def _find_paragraph(paragraphs, text, start_ind=0):
+    for paragraph_id in range(start_ind, len(paragraphs)):
+        if text in paragraphs[paragraph_id]:
+            return paragraph_id
+    return None
+
+
+def locate_chunk(paragraphs, chunk_text, probe_size=64):
+    """
+    Return the (start_paragraph_id, end_paragraph_id) of the paragraphs a chunk of the document is cut from,
+    found by the exact position of its first and last line, or (None, None) if the chunk can not be found.
+    """
+    lines = [line.strip() for line in chunk_text.strip().split('\n') if line.strip()]
+    if not lines:
+        return None, None
+    start_paragraph_id = _find_paragraph(paragraphs, lines[0][:probe_size])
+    if start_paragraph_id is None:
+        return None, None
+    end_paragraph_id = _find_paragraph(paragraphs, lines[-1][-probe_size:], start_paragraph_id)
+    if end_paragraph_id is None:
+        end_paragraph_id = start_paragraph_id
+    return start_paragraph_id, end_paragraph_id
+
+
+class DocProvenanceStore:
+    """
+    The provenance of every document ingested into a parrot kb, its wikipedia_id, title and paragraphs,
+    recorded in a sqlite file of the output dir at ingestion time.
+    A search result is attributed exactly by its `doc_name` and localized to paragraphs inside that document,
+    without any page lookup or fuzzy matching at query time.
+    """
+
+    def __init__(self, store_path, cache_size=4096):
+        self.store_path = store_path
+        self._conn = sqlite3.connect(store_path, timeout=60, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS docs '
+                           '(doc_name TEXT PRIMARY KEY, wikipedia_id TEXT, title TEXT, paragraphs TEXT)')
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._get_doc = lru_cache(maxsize=cache_size)(self._load_doc)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, output_dir):
+        """Open the store of the kb ingested into `output_dir`, or return None if it has never been recorded."""
+        store_path = os.path.join(output_dir, DOC_PROVENANCE_NAME)
+        if not os.path.exists(store_path):
+            return None
+        return cls(store_path)
+
+    def doc_names(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute('SELECT doc_name FROM docs')}
+
+    def record_pages(self, doc_name_2_page):
+        rows = [(str(doc_name), str(page['wikipedia_id']), page.get('wikipedia_title'),
+                 json.dumps(build_doc_paragraphs(page))) for doc_name, page in doc_name_2_page.items()]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)', rows)
+            self._conn.commit()
+        self._get_doc.cache_clear()
+
+    def delete(self, doc_names):
+        with self._lock:
+            self._conn.executemany('DELETE FROM docs WHERE doc_name = ?', [(str(doc_name),) for doc_name in doc_names])
+            self._conn.commit()
+        self._get_doc.cache_clear()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM docs')
+            self._conn.commit()
+        self._get_doc.cache_clear()
+
+    def _load_doc(self, doc_name):
+        with self._lock:
+            row = self._conn.execute('SELECT wikipedia_id, title, paragraphs FROM docs WHERE doc_name = ?',
+                                     (doc_name,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def resolve(self, doc_name, chunk_text):
+        """
+        Return the provenance dict of a search result of document `doc_name`,
+        or None if the document has no recorded provenance.
+        """
+        doc = self._get_doc(str(doc_name)) if doc_name is not None else None
+        with self._lock:
+            if doc is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if doc is None:
+            return None
+        wikipedia_id, title, paragraphs = doc
+        start_paragraph_id, end_paragraph_id = locate_chunk(paragraphs, chunk_text)
+        return {
+            'wikipedia_id': wikipedia_id,
+            'title': title,
+            'start_paragraph_id': start_paragraph_id,
+            'end_paragraph_id': end_paragraph_id,
+            'src_context': paragraphs[start_paragraph_id] if start_paragraph_id is not None else None,
+        }
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
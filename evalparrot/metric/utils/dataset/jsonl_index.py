@@ -0,0 +1,123 @@
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+# magic, jsonl size, jsonl mtime_ns, sha1 of id_key, id width, entry num
+HEADER = struct.Struct('<8sqq20sIQ')
+MAGIC = b'JSONLIDX'
+SPAN = struct.Struct('<qq')
+
+
+class _SortedIds:
+    """The sorted fixed-width ids of the sidecar index as a sequence, so it can be bisected in place on the mmap."""
+
+    def __init__(self, mm, id_width, entry_num):
+        self._mm = mm
+        self._id_width = id_width
+        self._entry_size = id_width + SPAN.size
+        self._entry_num = entry_num
+
+    def __len__(self):
+        return self._entry_num
+
+    def __getitem__(self, ind):
+        start = HEADER.size + ind * self._entry_size
+        return self._mm[start: start + self._id_width]
+
+    def span(self, ind):
+        return SPAN.unpack_from(self._mm, HEADER.size + ind * self._entry_size + self._id_width)
+
+
+class JsonlIndex:
+    """
+    Random access by id to the records of a jsonl file.
+    The byte offset and length of every line are kept in a sidecar index file next to the jsonl file,
+    it is built once and rebuilt when the size or mtime of the jsonl file changes.
+    The sidecar is a binary file of fixed-width entries sorted by id, an id is looked up by bisecting a mmap of it,
+    and records are parsed on demand from a mmap of the jsonl file, so memory does not grow with the file size.
+    """
+
+    def __init__(self, jsonl_path, id_key='id'):
+        self.jsonl_path = jsonl_path
+        self.index_path = jsonl_path + '.idx'
+        self.id_key = id_key
+        self._file, self._mm = self._open_mmap(jsonl_path)
+        self._index_file, self._index_mm = self._load_or_build()
+        _, _, _, _, self._id_width, entry_num = HEADER.unpack_from(self._index_mm, 0)
+        self._ids = _SortedIds(self._index_mm, self._id_width, entry_num)
+
+    @staticmethod
+    def _open_mmap(path):
+        f = open(path, 'rb')
+        if os.path.getsize(path) > 0:
+            return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f, b''
+
+    def _file_signature(self):
+        stat = os.stat(self.jsonl_path)
+        return stat.st_size, stat.st_mtime_ns, hashlib.sha1(self.id_key.encode('utf-8')).digest()
+
+    def _load_or_build(self):
+        signature = self._file_signature()
+        if os.path.exists(self.index_path) and os.path.getsize(self.index_path) >= HEADER.size:
+            index_file, index_mm = self._open_mmap(self.index_path)
+            magic, size, mtime_ns, id_key_hash, _, _ = HEADER.unpack_from(index_mm, 0)
+            if magic == MAGIC and (size, mtime_ns, id_key_hash) == signature:
+                return index_file, index_mm
+            index_mm.close()
+            index_file.close()
+
+        entries = []
+        offset = 0
+        with open(self.jsonl_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    entries.append((str(json.loads(line)[self.id_key]).encode('utf-8'), offset, len(line)))
+                offset += len(line)
+        id_width = max([len(id_) for id_, _, _ in entries], default=1)
+        # a later line of a duplicated id wins, the same as the last write of a dict
+        id_2_entry = {id_.ljust(id_width, b'\0'): (offset, length) for id_, offset, length in entries}
+        temp_index_path = self.index_path + '.tmp'
+        with open(temp_index_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, *signature, id_width, len(id_2_entry)))
+            for id_ in sorted(id_2_entry):
+                f.write(id_ + SPAN.pack(*id_2_entry[id_]))
+        os.replace(temp_index_path, self.index_path)
+        return self._open_mmap(self.index_path)
+
+    def _find(self, id_):
+        key = str(id_).encode('utf-8')
+        if len(key) > self._id_width:
+            return None
+        key = key.ljust(self._id_width, b'\0')
+        ind = bisect.bisect_left(self._ids, key)
+        if ind < len(self._ids) and self._ids[ind] == key:
+            return ind
+        return None
+
+    def __contains__(self, id_):
+        return self._find(id_) is not None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ids(self):
+        """Iterate the ids in sorted order."""
+        for ind in range(len(self._ids)):
+            yield self._ids[ind].rstrip(b'\0').decode('utf-8')
+
+    def get(self, id_):
+        ind = self._find(id_)
+        if ind is None:
+            raise KeyError(id_)
+        offset, length = self._ids.span(ind)
+        return json.loads(self._mm[offset: offset + length])
+
+    def close(self):
+        for mm, f in [(self._index_mm, self._index_file), (self._mm, self._file)]:
+            if isinstance(mm, mmap.mmap):
+                mm.close()
+            f.close()
@@ -1,17 +1,15 @@
+import itertools
 import json
 import os
+from collections import namedtuple
 
 import requests
 from langchain.schema import Document
 from tqdm import tqdm
-import difflib
 
-try:
-    from kilt.knowledge_source import KnowledgeSource
-except:
-    print('If you need to use KILT metric, please refer https://github.com/facebookresearch/KILT to setup KILT env.')
-
-global_ks = KnowledgeSource()
+from .jsonl_index import JsonlIndex
+from .knowledge_source import get_page_store, prefetch_pages
+from .provenance_matcher import ProvenanceMatcher, SuffixAutomaton
 
 # urls infos are from https://github.com/facebookresearch/KILT/tree/main
 # exclude training jsonl
@@ -82,52 +80,87 @@ def _hash_provenance(wikipedia_id, start_paragraph_id, end_paragraph_id):
     return f'{wikipedia_id}_{start_paragraph_id}_{end_paragraph_id}'
 
 
-def prepare_kilt_without_answer(kilt_data_path, kilt_dataset_name, split='dev', ks=global_ks):
+def collect_provenance_wikipedia_ids(line_dict_list):
+    wikipedia_ids = []
+    for line_dict in line_dict_list:
+        for one_of_output in line_dict['output']:
+            for one_of_provenance in one_of_output.get('provenance', []):
+                wikipedia_ids.append(one_of_provenance['wikipedia_id'])
+    return wikipedia_ids
+
+
+KiltQuery = namedtuple('KiltQuery', ['id', 'input', 'gt_contexts_list', 'provenance_list'])
+
+
+def _build_kilt_query(line_dict, ks):
+    gt_contexts_list = []
+    provenance_list = []
+    for one_of_output in line_dict['output']:
+        if 'provenance' not in one_of_output:  # or 'answer' not in one_of_output:
+            continue
+        # gt_answer_list.append(one_of_output['answer'])
+        gt_contexts = []
+        for one_of_provenance in one_of_output['provenance']:
+            wikipedia_id = one_of_provenance['wikipedia_id']
+            page = ks.get_page_by_id(int(wikipedia_id))
+            assert page['wikipedia_id'] == page['_id']
+            start_paragraph_id = one_of_provenance['start_paragraph_id']
+            end_paragraph_id = one_of_provenance['end_paragraph_id']
+            start_character = one_of_provenance['start_character']
+            end_character = one_of_provenance['end_character']
+            assert start_paragraph_id == end_paragraph_id  # In KILT dataset, all start_paragraph_id equal end_paragraph_id
+            gt_contexts.append(page['text'][start_paragraph_id][start_character: end_character])
+            provenance_list.append((wikipedia_id, start_paragraph_id))
+        gt_contexts_list.append(gt_contexts)
+    return KiltQuery(line_dict['id'], line_dict['input'], gt_contexts_list, provenance_list)
+
+
+def iter_kilt_queries(data_jsonl_path, pre_query_num=None, ks=None, batch_size=256):
+    """
+    Lazily parse the first `pre_query_num` lines of a kilt jsonl file, and yield a KiltQuery for each line.
+    The lines are parsed in batches, the pages of each batch are prefetched together,
+    and the file is not read any further once enough queries are yielded.
+    """
+    if ks is None:
+        ks = get_page_store()
+    with open(data_jsonl_path, 'r', encoding="utf-8") as f:
+        lines = itertools.islice(f, pre_query_num or None)
+        while True:
+            line_dict_list = [json.loads(line) for line in itertools.islice(lines, batch_size)]
+            if not line_dict_list:
+                break
+            prefetch_pages(ks, collect_provenance_wikipedia_ids(line_dict_list))
+            for line_dict in line_dict_list:
+                yield _build_kilt_query(line_dict, ks)
+
+
+def prepare_kilt_without_answer(kilt_data_path, kilt_dataset_name, split='dev', ks=None, pre_query_num=None):
+    if ks is None:
+        ks = get_page_store()
     data_jsonl_path = find_data_jsonl_path(kilt_dataset_name, split, kilt_data_path)
 
     question_list = []
     id_list = []
     input_list = []
-    # gt_answer_list = []  # no use, todo
     gt_contexts_list = []
     documents = []
-    # all_datas = []
-    wikipedia_id_set = set()
     provenance_hash_set = set()
-    with open(data_jsonl_path, 'r', encoding="utf-8") as f:
-        for line in tqdm(list(f)):
-            line_dict = json.loads(line)
-            # all_datas.append(line_dict)
-            id_list.append(line_dict['id'])
-            input_list.append(line_dict['input'])
-            for one_of_output in line_dict['output']:
-                if 'provenance' not in one_of_output:  # or 'answer' not in one_of_output:
-                    continue
-                question_list.append(line_dict['input'])
-                # gt_answer_list.append(one_of_output['answer'])
-                gt_contexts = []
-                for one_of_provenance in one_of_output['provenance']:
-                    wikipedia_id = one_of_provenance['wikipedia_id']
-                    wikipedia_id_set.add(wikipedia_id)
-                    page = ks.get_page_by_id(int(wikipedia_id))
-                    assert page['wikipedia_id'] == page['_id']
-                    start_paragraph_id = one_of_provenance['start_paragraph_id']
-                    end_paragraph_id = one_of_provenance['end_paragraph_id']
-                    start_character = one_of_provenance['start_character']
-                    end_character = one_of_provenance['end_character']
-                    assert start_paragraph_id == end_paragraph_id  # In KILT dataset, all start_paragraph_id equal end_paragraph_id
-                    gt_contexts.append(page['text'][start_paragraph_id][start_character: end_character])
-                    provenance_hash = _hash_provenance(wikipedia_id, start_paragraph_id, end_paragraph_id)
-                    if provenance_hash in provenance_hash_set:
-                        continue
-                    else:
-                        document = Document(page_content=page['text'][start_paragraph_id],
-                                            metadata={'wikipedia_id': wikipedia_id,
-                                                      'paragraph_id': start_paragraph_id,
-                                                      })
-                        documents.append(document)
-                        provenance_hash_set.add(provenance_hash)
-                gt_contexts_list.append(gt_contexts)
+    for kilt_query in tqdm(iter_kilt_queries(data_jsonl_path, pre_query_num, ks=ks), total=pre_query_num):
+        id_list.append(kilt_query.id)
+        input_list.append(kilt_query.input)
+        question_list.extend([kilt_query.input] * len(kilt_query.gt_contexts_list))
+        gt_contexts_list.extend(kilt_query.gt_contexts_list)
+        for wikipedia_id, paragraph_id in kilt_query.provenance_list:
+            provenance_hash = _hash_provenance(wikipedia_id, paragraph_id, paragraph_id)
+            if provenance_hash in provenance_hash_set:
+                continue
+            page = ks.get_page_by_id(int(wikipedia_id))
+            document = Document(page_content=page['text'][paragraph_id],
+                                metadata={'wikipedia_id': wikipedia_id,
+                                          'paragraph_id': paragraph_id,
+                                          })
+            documents.append(document)
+            provenance_hash_set.add(provenance_hash)
     documents.sort(key=lambda x: (int(x.metadata['wikipedia_id']),
                                   int(x.metadata['paragraph_id']),
                                   ))
@@ -144,50 +177,26 @@ def prepare_kilt_without_answer(kilt_data_path, kilt_dataset_name, split='dev',
 
 
 def prepare_kilt_without_answer_with_multi_documents(kilt_data_path, kilt_dataset_name, split='dev', pre_query_num=None,
-                                                     ks=global_ks):
+                                                     ks=None):
+    if ks is None:
+        ks = get_page_store()
     data_jsonl_path = find_data_jsonl_path(kilt_dataset_name, split, kilt_data_path)
 
     question_list = []
     id_list = []
     input_list = []
-    # gt_answer_list = []  # no use, todo
     gt_contexts_list = []
-    documents = []
-    # all_datas = []
     wikipedia_id_set = set()
-    provenance_hash_set = set()
-    if not pre_query_num:
-        with open(data_jsonl_path, 'r', encoding="utf-8") as f:
-            pre_query_num = len(list(f))
-    with open(data_jsonl_path, 'r', encoding="utf-8") as f:
-        for line in tqdm(list(f)[:pre_query_num]):
-            line_dict = json.loads(line)
-            # all_datas.append(line_dict)
-            id_list.append(line_dict['id'])
-            input_list.append(line_dict['input'])
-            for one_of_output in line_dict['output']:
-                if 'provenance' not in one_of_output:  # or 'answer' not in one_of_output:
-                    continue
-                question_list.append(line_dict['input'])
-                # gt_answer_list.append(one_of_output['answer'])
-                gt_contexts = []
-                for one_of_provenance in one_of_output['provenance']:
-                    wikipedia_id = one_of_provenance['wikipedia_id']
-                    wikipedia_id_set.add(wikipedia_id)
-                    page = ks.get_page_by_id(int(wikipedia_id))
-                    assert page['wikipedia_id'] == page['_id']
-                    start_paragraph_id = one_of_provenance['start_paragraph_id']
-                    end_paragraph_id = one_of_provenance['end_paragraph_id']
-                    start_character = one_of_provenance['start_character']
-                    end_character = one_of_provenance['end_character']
-                    assert start_paragraph_id == end_paragraph_id  # In KILT dataset, all start_paragraph_id equal end_paragraph_id
-                    gt_contexts.append(page['text'][start_paragraph_id][start_character: end_character])
-
-                gt_contexts_list.append(gt_contexts)
+    for kilt_query in tqdm(iter_kilt_queries(data_jsonl_path, pre_query_num, ks=ks), total=pre_query_num):
+        id_list.append(kilt_query.id)
+        input_list.append(kilt_query.input)
+        question_list.extend([kilt_query.input] * len(kilt_query.gt_contexts_list))
+        gt_contexts_list.extend(kilt_query.gt_contexts_list)
+        wikipedia_id_set.update(wikipedia_id for wikipedia_id, _ in kilt_query.provenance_list)
 
     # question_list, gt_contexts_list are used for ragas
     # input_list, id_list are used for kilt
-    # documents is used for insert docs into database
+    # wikipedia_id_set is used for insert docs into database
     assert len(question_list) == len(gt_contexts_list)
     assert len(input_list) == len(id_list)
     print(f'len(question_list) = len(gt_contexts_list) = {len(question_list)}')
@@ -196,29 +205,33 @@ def prepare_kilt_without_answer_with_multi_documents(kilt_data_path, kilt_datase
     return question_list, gt_contexts_list, wikipedia_id_set, input_list, id_list
 
 
-def filter_jsonl(data_jsonl_path, guess_output_path, filtered_data_jsonl_path, ks=global_ks):
-    ids = set()
+def filter_jsonl(data_jsonl_path, guess_output_path, filtered_data_jsonl_path, ks=None):
+    if ks is None:
+        ks = get_page_store()
+    ids = []
     with open(guess_output_path, 'r') as f1:
         for line in f1:
             data = json.loads(line)
-            ids.add(data['id'])
-
-    with open(data_jsonl_path, 'r') as f2, open(filtered_data_jsonl_path, 'w') as f3:
-        for line in f2:
-            data = json.loads(line)
-            if data['id'] in ids:
-                for one_of_output in data['output']:
-                    if 'provenance' not in one_of_output:  # or 'answer' not in one_of_output:
-                        continue
-                    for one_of_provenance in one_of_output['provenance']:
-                        wikipedia_id = one_of_provenance['wikipedia_id']
-                        page = ks.get_page_by_id(int(wikipedia_id))
-                        start_paragraph_id = one_of_provenance['start_paragraph_id']
-                        src_context = page['text'][start_paragraph_id]
-                        if 'meta' not in one_of_provenance:
-                            one_of_provenance['meta'] = {}
-                        one_of_provenance['meta']['src_context'] = src_context
-                f3.write(json.dumps(data) + '\n')
+            ids.append(data['id'])
+
+    gold_index = JsonlIndex(data_jsonl_path)
+    data_list = [gold_index.get(id_) for id_ in ids if id_ in gold_index]
+    gold_index.close()
+    prefetch_pages(ks, collect_provenance_wikipedia_ids(data_list))
+    with open(filtered_data_jsonl_path, 'w') as f3:
+        for data in data_list:
+            for one_of_output in data['output']:
+                if 'provenance' not in one_of_output:  # or 'answer' not in one_of_output:
+                    continue
+                for one_of_provenance in one_of_output['provenance']:
+                    wikipedia_id = one_of_provenance['wikipedia_id']
+                    page = ks.get_page_by_id(int(wikipedia_id))
+                    start_paragraph_id = one_of_provenance['start_paragraph_id']
+                    src_context = page['text'][start_paragraph_id]
+                    if 'meta' not in one_of_provenance:
+                        one_of_provenance['meta'] = {}
+                    one_of_provenance['meta']['src_context'] = src_context
+            f3.write(json.dumps(data) + '\n')
 
 
 # def find_common_substring_length(str1, str2):
@@ -249,9 +262,7 @@ def filter_jsonl(data_jsonl_path, guess_output_path, filtered_data_jsonl_path, k
 
 
 def find_common_substring_length(str1, str2):
-    matcher = difflib.SequenceMatcher(None, str1, str2)
-    match = matcher.find_longest_match(0, len(str1), 0, len(str2))
-    return match.size
+    return SuffixAutomaton(str1).longest_common_substring(str2)
 
 
 def find_wikipedia_id_by_context(chunk_context, content_2_wikipedia_id):
@@ -267,7 +278,9 @@ def find_wikipedia_id_by_context(chunk_context, content_2_wikipedia_id):
     return best_wikipedia_id, best_context
 
 
-def get_src_context_2_id(line_dict, ks=global_ks):
+def get_src_context_2_id(line_dict, ks=None):
+    if ks is None:
+        ks = get_page_store()
     context_2_id = dict()
     for one_of_output in line_dict['output']:
         for one_of_provenance in one_of_output['provenance']:
@@ -281,24 +294,25 @@ def get_src_context_2_id(line_dict, ks=global_ks):
     return context_2_id
 
 
-def find_wikipedia_id_by_gold(chunk_context, gold_line_dict, score_threshold=30, ks=global_ks):
+def find_wikipedia_id_by_gold(chunk_context, gold_line_dict, score_threshold=30, ks=None):
     content_2_wikipedia_id = get_src_context_2_id(gold_line_dict, ks=ks)
-    best_wikipedia_id = None
-    max_score = 0
-    best_context = None
-    for context, wikipedia_id in content_2_wikipedia_id.items():
-        score = find_common_substring_length(context, chunk_context)
-        if score > max_score and score > score_threshold:
-            max_score = score
-            best_wikipedia_id = wikipedia_id
-            best_context = context
+    matcher = ProvenanceMatcher(content_2_wikipedia_id, score_threshold=score_threshold)
+    best_wikipedia_id, best_context, _ = matcher.match(chunk_context)
     return best_wikipedia_id, best_context
 
 
-def dump_wiki_doc(wikipedia_id, dst_path, ks=global_ks):
+def build_wiki_doc_text(page):
+    doc_text_list = []
+    for page_text in page['text']:
+        if '::::' in page_text:
+            doc_text_list.append('\n')
+        doc_text_list.append(page_text)
+    return ''.join(doc_text_list)
+
+
+def dump_wiki_doc(wikipedia_id, dst_path, ks=None):
+    if ks is None:
+        ks = get_page_store()
     page = ks.get_page_by_id(int(wikipedia_id))
     with open(dst_path, 'w') as f:
-        for page_text in page['text']:
-            if '::::' in page_text:
-                f.write('\n')
-            f.write(page_text)
+        f.write(build_wiki_doc_text(page))
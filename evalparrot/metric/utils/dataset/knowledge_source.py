@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict
+
+try:
+    from kilt.knowledge_source import KnowledgeSource
+except:
+    KnowledgeSource = None
+    print('If you need to use KILT metric, please refer https://github.com/facebookresearch/KILT to setup KILT env.')
+
+DEFAULT_MONGO_CONNECTION_STRING = 'mongodb://127.0.0.1:27017/admin'
+
+_ks_lock = threading.Lock()
+_connection_string_2_ks = dict()
+
+
+def build_mongo_connection_string(kilt_wiki_mongo_domain='127.0.0.1'):
+    return f"mongodb://{kilt_wiki_mongo_domain}:27017/admin"
+
+
+def get_knowledge_source(mongo_connection_string=None):
+    """
+    Return the process-wide KnowledgeSource of `mongo_connection_string`.
+    The mongo client is only created on the first call, and every later call with the same connection string
+    shares the same pooled client.
+    """
+    if not mongo_connection_string:
+        mongo_connection_string = DEFAULT_MONGO_CONNECTION_STRING
+    ks = _connection_string_2_ks.get(mongo_connection_string)
+    if ks is not None:
+        return ks
+    with _ks_lock:
+        ks = _connection_string_2_ks.get(mongo_connection_string)
+        if ks is None:
+            assert KnowledgeSource is not None, 'kilt is not installed, can not connect to the kilt knowledge source.'
+            ks = KnowledgeSource(mongo_connection_string=mongo_connection_string)
+            _connection_string_2_ks[mongo_connection_string] = ks
+    return ks
+
+
+DEFAULT_PAGE_CACHE_SIZE = 20000
+DEFAULT_FETCH_BATCH_SIZE = 500
+PAGE_PROJECTION = {'_id': 1, 'wikipedia_id': 1, 'wikipedia_title': 1, 'text': 1}
+
+
+class PageStore:
+    """
+    Page access layer in front of a KnowledgeSource.
+    Pages are fetched from mongo in bulk `$in` batches and kept in a bounded LRU cache,
+    it can be used everywhere a KnowledgeSource is expected, since it also provides `get_page_by_id()`.
+    """
+
+    def __init__(self, ks, cache_size=DEFAULT_PAGE_CACHE_SIZE, fetch_batch_size=DEFAULT_FETCH_BATCH_SIZE):
+        self.ks = ks
+        self.cache_size = cache_size
+        self.fetch_batch_size = fetch_batch_size
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.fetched_pages = 0
+        self.round_trips = 0
+
+    def _put(self, wikipedia_id, page):
+        self._cache[wikipedia_id] = page
+        self._cache.move_to_end(wikipedia_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _fetch(self, wikipedia_ids):
+        # called without the lock, so that the threads of different datasets can fetch from mongo concurrently
+        id_2_page = dict()
+        round_trips = 0
+        for start in range(0, len(wikipedia_ids), self.fetch_batch_size):
+            batch = wikipedia_ids[start: start + self.fetch_batch_size]
+            cursor = self.ks.db.find({'_id': {'$in': batch}}, PAGE_PROJECTION)
+            round_trips += 1
+            for page in cursor:
+                id_2_page[str(page['_id'])] = page
+        with self._lock:
+            self.round_trips += round_trips
+            self.fetched_pages += len(id_2_page)
+            for wikipedia_id, page in id_2_page.items():
+                self._put(wikipedia_id, page)
+        return id_2_page
+
+    def prefetch(self, wikipedia_ids):
+        """Fetch all pages of `wikipedia_ids` which are not cached yet, with as few round trips as possible."""
+        with self._lock:
+            missing_ids = []
+            for wikipedia_id in dict.fromkeys(str(wikipedia_id) for wikipedia_id in wikipedia_ids):
+                if wikipedia_id not in self._cache:
+                    missing_ids.append(wikipedia_id)
+        if len(missing_ids) > self.cache_size:
+            print(f'prefetch {len(missing_ids)} pages, more than the page cache size {self.cache_size}.')
+        self._fetch(missing_ids)
+
+    def get_page_by_id(self, wikipedia_id):
+        wikipedia_id = str(wikipedia_id)
+        with self._lock:
+            page = self._cache.get(wikipedia_id)
+            if page is not None:
+                self.hits += 1
+                self._cache.move_to_end(wikipedia_id)
+                return page
+            self.misses += 1
+        return self._fetch([wikipedia_id]).get(wikipedia_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'cached_pages': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'fetched_pages': self.fetched_pages,
+                'round_trips': self.round_trips,
+            }
+
+
+_page_store_lock = threading.Lock()
+_connection_string_2_page_store = dict()
+
+
+def get_page_store(mongo_connection_string=None):
+    """Return the process-wide PageStore of `mongo_connection_string`, sharing the client of `get_knowledge_source()`."""
+    if not mongo_connection_string:
+        mongo_connection_string = DEFAULT_MONGO_CONNECTION_STRING
+    with _page_store_lock:
+        page_store = _connection_string_2_page_store.get(mongo_connection_string)
+        if page_store is None:
+            page_store = PageStore(get_knowledge_source(mongo_connection_string))
+            _connection_string_2_page_store[mongo_connection_string] = page_store
+    return page_store
+
+
+def prefetch_pages(ks, wikipedia_ids):
+    # A plain KnowledgeSource has no bulk api, its pages are still fetched one by one.
+    if hasattr(ks, 'prefetch'):
+        ks.prefetch(wikipedia_ids)
+
+
+def close_knowledge_sources():
+    with _page_store_lock:
+        _connection_string_2_page_store.clear()
+    with _ks_lock:
+        for ks in _connection_string_2_ks.values():
+            ks.client.close()
+        _connection_string_2_ks.clear()
@@ -0,0 +1,108 @@
+import itertools
+import json
+import os
+import sqlite3
+import threading
+from functools import lru_cache
+
+from tqdm import tqdm
+
+from .kilt_data import find_data_jsonl_path, collect_provenance_wikipedia_ids
+from .knowledge_source import get_page_store, prefetch_pages
+
+DEFAULT_SNAPSHOT_DIR = './datasets/kilt_snapshot'
+
+
+def get_snapshot_path(snapshot_dir, kilt_dataset_name, split='dev', pre_query_num=None):
+    query_num_str = pre_query_num if pre_query_num else 'all'
+    return os.path.join(snapshot_dir, f'{kilt_dataset_name}-{split}-{query_num_str}.sqlite')
+
+
+def materialize_kilt_snapshot(kilt_data_path, kilt_dataset_name, split='dev', pre_query_num=None,
+                              snapshot_dir=DEFAULT_SNAPSHOT_DIR, ks=None, overwrite=False, batch_size=1000):
+    """
+    Write the paragraphs of all the provenance pages of the first `pre_query_num` queries into a local sqlite snapshot,
+    so that later runs of the same dataset can read them without the kilt mongo service.
+    Return the snapshot path.
+    """
+    snapshot_path = get_snapshot_path(snapshot_dir, kilt_dataset_name, split, pre_query_num)
+    if os.path.exists(snapshot_path) and not overwrite:
+        return snapshot_path
+    if ks is None:
+        ks = get_page_store()
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    data_jsonl_path = find_data_jsonl_path(kilt_dataset_name, split, kilt_data_path)
+    with open(data_jsonl_path, 'r', encoding="utf-8") as f:
+        line_dict_list = [json.loads(line) for line in itertools.islice(f, pre_query_num or None)]
+    wikipedia_ids = list(dict.fromkeys(str(wikipedia_id) for wikipedia_id in
+                                       collect_provenance_wikipedia_ids(line_dict_list)))
+
+    temp_snapshot_path = snapshot_path + '.tmp'
+    if os.path.exists(temp_snapshot_path):
+        os.remove(temp_snapshot_path)
+    conn = sqlite3.connect(temp_snapshot_path)
+    conn.execute('CREATE TABLE pages (wikipedia_id TEXT PRIMARY KEY, wikipedia_title TEXT, text TEXT)')
+    missing_num = 0
+    for start in tqdm(range(0, len(wikipedia_ids), batch_size), desc='materialize kilt snapshot'):
+        batch = wikipedia_ids[start: start + batch_size]
+        prefetch_pages(ks, batch)
+        rows = []
+        for wikipedia_id in batch:
+            page = ks.get_page_by_id(int(wikipedia_id))
+            if page is None:
+                missing_num += 1
+                continue
+            rows.append((wikipedia_id, page.get('wikipedia_title'), json.dumps(page['text'])))
+        conn.executemany('INSERT INTO pages VALUES (?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+    os.replace(temp_snapshot_path, snapshot_path)
+    print(f'materialize {len(wikipedia_ids) - missing_num} pages into {snapshot_path}, {missing_num} pages not found.')
+    return snapshot_path
+
+
+class ParagraphSnapshot:
+    """
+    Read-only page source backed by a snapshot of `materialize_kilt_snapshot()`,
+    it provides the same `get_page_by_id()` as KnowledgeSource.
+    """
+
+    def __init__(self, snapshot_path, cache_size=4096):
+        self.snapshot_path = snapshot_path
+        self._conn = sqlite3.connect(f'file:{os.path.abspath(snapshot_path)}?mode=ro', uri=True,
+                                     check_same_thread=False)
+        self._lock = threading.Lock()
+        self._get_page = lru_cache(maxsize=cache_size)(self._load_page)
+
+    def _load_page(self, wikipedia_id):
+        with self._lock:
+            row = self._conn.execute('SELECT wikipedia_title, text FROM pages WHERE wikipedia_id = ?',
+                                     (wikipedia_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            '_id': wikipedia_id,
+            'wikipedia_id': wikipedia_id,
+            'wikipedia_title': row[0],
+            'text': json.loads(row[1]),
+        }
+
+    def get_page_by_id(self, wikipedia_id):
+        return self._get_page(str(wikipedia_id))
+
+    def prefetch(self, wikipedia_ids):
+        pass  # all pages are already local
+
+    def stats(self):
+        cache_info = self._get_page.cache_info()
+        lookups = cache_info.hits + cache_info.misses
+        return {
+            'snapshot_path': self.snapshot_path,
+            'hits': cache_info.hits,
+            'misses': cache_info.misses,
+            'hit_rate': cache_info.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import threading
+
+
+class SuffixAutomaton:
+    """
+    Suffix automaton of a source text.
+    Building it is linear in the length of the text,
+    and the longest common substring with any other text is found in one linear scan of that text.
+    """
+    __slots__ = ('text', 'next', 'link', 'length')
+
+    def __init__(self, text):
+        self.text = text
+        next_ = [{}]
+        link = [-1]
+        length = [0]
+        last = 0
+        for ch in text:
+            cur = len(length)
+            next_.append({})
+            length.append(length[last] + 1)
+            link.append(0)
+            p = last
+            while p != -1 and ch not in next_[p]:
+                next_[p][ch] = cur
+                p = link[p]
+            if p != -1:
+                q = next_[p][ch]
+                if length[p] + 1 == length[q]:
+                    link[cur] = q
+                else:
+                    clone = len(length)
+                    next_.append(next_[q].copy())
+                    length.append(length[p] + 1)
+                    link.append(link[q])
+                    while p != -1 and next_[p].get(ch) == q:
+                        next_[p][ch] = clone
+                        p = link[p]
+                    link[q] = clone
+                    link[cur] = clone
+            last = cur
+        self.next = next_
+        self.link = link
+        self.length = length
+
+    def longest_common_substring(self, other):
+        next_ = self.next
+        link = self.link
+        length = self.length
+        state = 0
+        cur_len = 0
+        best = 0
+        for ch in other:
+            while state and ch not in next_[state]:
+                state = link[state]
+                cur_len = length[state]
+            state = next_[state].get(ch, 0)
+            if state:
+                cur_len += 1
+                if cur_len > best:
+                    best = cur_len
+            else:
+                cur_len = 0
+        return best
+
+
+class _SourceContext:
+    __slots__ = ('context', 'gram_size', 'grams', '_automaton')
+
+    def __init__(self, context, gram_size):
+        self.context = context
+        self.gram_size = gram_size
+        self.grams = {context[i: i + gram_size] for i in range(len(context) - gram_size + 1)}
+        self._automaton = None
+
+    def may_exceed(self, chunk_context):
+        # A common substring longer than the threshold must contain a shared gram of (threshold + 1) chars.
+        grams = self.grams
+        gram_size = self.gram_size
+        for i in range(len(chunk_context) - gram_size + 1):
+            if chunk_context[i: i + gram_size] in grams:
+                return True
+        return False
+
+    @property
+    def automaton(self):
+        if self._automaton is None:
+            self._automaton = SuffixAutomaton(self.context)
+        return self._automaton
+
+
+_source_cache_lock = threading.Lock()
+_source_cache = OrderedDict()
+SOURCE_CACHE_SIZE = 256
+
+
+def _get_source_context(context, gram_size):
+    key = (context, gram_size)
+    with _source_cache_lock:
+        source = _source_cache.get(key)
+        if source is not None:
+            _source_cache.move_to_end(key)
+            return source
+    source = _SourceContext(context, gram_size)
+    with _source_cache_lock:
+        _source_cache[key] = source
+        while len(_source_cache) > SOURCE_CACHE_SIZE:
+            _source_cache.popitem(last=False)
+    return source
+
+
+class ProvenanceMatcher:
+    """
+    Find which source paragraph a retrieved chunk comes from.
+    The score of a paragraph is the length of its longest common substring with the chunk,
+    and like `find_wikipedia_id_by_gold()`, only a score greater than `score_threshold` is a match.
+    The index of the source paragraphs is built once, then each chunk is matched in near-linear time.
+    """
+
+    def __init__(self, content_2_wikipedia_id, score_threshold=30):
+        self.score_threshold = score_threshold
+        gram_size = max(score_threshold + 1, 1)
+        self.sources = [(_get_source_context(context, gram_size), wikipedia_id)
+                        for context, wikipedia_id in content_2_wikipedia_id.items()]
+
+    def match(self, chunk_context):
+        """Return (wikipedia_id, src_context, score) of the best source paragraph, or (None, None, 0)."""
+        best_wikipedia_id = None
+        max_score = 0
+        best_context = None
+        for source, wikipedia_id in self.sources:
+            if not source.may_exceed(chunk_context):
+                continue
+            score = source.automaton.longest_common_substring(chunk_context)
+            if score > max_score and score > self.score_threshold:
+                max_score = score
+                best_wikipedia_id = wikipedia_id
+                best_context = source.context
+        return best_wikipedia_id, best_context, max_score
+
+
+def match_chunks(content_2_wikipedia_id, chunk_contexts, score_threshold=30):
+    """
+    Return the (wikipedia_id, src_context, score) of the best source paragraph of every chunk,
+    a top level function so that the matching can run in a process pool.
+    """
+    matcher = ProvenanceMatcher(content_2_wikipedia_id, score_threshold=score_threshold)
+    return [matcher.match(chunk_context) for chunk_context in chunk_contexts]
@@ -5,13 +5,15 @@ from typing import Union, List, Dict
 
 from ragas.evaluation import Result
 
+from evalparrot.metric.utils.result_store import write_ragas_scores, summarize_ragas_scores
+
 
 def save_result_to_csv(result: Result, csv_path: str):
     df = result.to_pandas()
     df.to_csv(csv_path)
 
 
-def results_2_md_table(multi_run_result: Dict, method_name=None):
+def results_2_md_table(multi_run_result: Dict, method_name=None, timing: Dict = None):
     table_head_str = f'''
 | Metric              | {method_name}  |
 |---------------------|----------------|
@@ -25,23 +27,68 @@ def results_2_md_table(multi_run_result: Dict, method_name=None):
         else:
             table_body_str = table_body_str + now_line
     table_str = table_head_str + table_body_str + last_line
+    if timing:
+        table_str = table_str + timing_2_md_table(timing)
+    return table_str
+
+
+def timing_2_md_table(timing: Dict):
+    table_str = '''
+| Stage               | Wall time (s)  | Count  |
+|---------------------|----------------|--------|
+'''
+    for stage_name, stage in timing.get('stages', {}).items():
+        table_str += f'|{stage_name} | {round(stage["wall_time"], 2)} | {stage["count"]} |\n'
+    table_str += '''
+| Call                | Count  | Mean (s) | p50 (s) | p90 (s) | p99 (s) | Max (s) |
+|---------------------|--------|----------|---------|---------|---------|---------|
+'''
+    for call_name, latency in timing.get('latency', {}).items():
+        values = [str(round(latency[name], 4)) if name in latency else ''
+                  for name in ['mean', 'p50', 'p90', 'p99', 'max']]
+        table_str += f'|{call_name} | {latency["count"]} | ' + ' | '.join(values) + ' |\n'
+    if timing.get('queue_depth'):
+        table_str += '''
+| Queue               | Samples | Mean   | p50    | p90    | p99    | Max    |
+|---------------------|---------|--------|--------|--------|--------|--------|
+'''
+        for queue_name, depth in timing['queue_depth'].items():
+            values = [str(round(depth[name], 2)) if name in depth else ''
+                      for name in ['mean', 'p50', 'p90', 'p99', 'max']]
+            table_str += f'|{queue_name} | {depth["count"]} | ' + ' | '.join(values) + ' |\n'
+    if timing.get('counters'):
+        table_str += '''
+| Counter             | Value          |
+|---------------------|----------------|
+'''
+        for counter_name, value in timing['counters'].items():
+            table_str += f'|{counter_name} | {value} |\n'
     return table_str
 
 
-def save_results(output_dir, result_name, result_list: Union[List[Result], Result], multi_run_result: Dict):
+def save_results(output_dir, result_name, result_list: Union[List[Result], Result], multi_run_result: Dict,
+                 timing: Dict = None, save_csv=True):
+    """
+    Save the per-row scores of all the runs into the columnar `ragas_scores.arrow` of the result dir,
+    and the total result json, the report table is summarized from the arrow file.
+    The csv of every run is only a copy for reading, `save_csv=False` skips it.
+    """
     if not isinstance(result_list, list):
         result_list = [result_list]
     result_dir = os.path.join(output_dir, result_name)
-    for ind, result in enumerate(result_list):
-        if not os.path.exists(result_dir):
-            os.mkdir(result_dir)
-        output_csv_path = os.path.join(result_dir, f'{result_name}_{ind}.csv')
-        save_result_to_csv(result, output_csv_path)
+    os.makedirs(result_dir, exist_ok=True)
+    write_ragas_scores(result_dir, result_list)
+    if save_csv:
+        for ind, result in enumerate(result_list):
+            output_csv_path = os.path.join(result_dir, f'{result_name}_{ind}.csv')
+            save_result_to_csv(result, output_csv_path)
     total_result_json_path = os.path.join(result_dir, f'{result_name}_total_result.json')
     total_result_dict = dict()
     total_result_dict['each_run_results'] = result_list
     total_result_dict['total_result'] = multi_run_result
-    md_table_str = results_2_md_table(multi_run_result)
+    if timing:
+        total_result_dict['timing'] = timing
+    md_table_str = results_2_md_table(summarize_ragas_scores(result_dir), timing=timing)
     print(md_table_str)
     with open(total_result_json_path, 'w') as f:
         f.write(json.dumps(total_result_dict, indent=2))
@@ -55,4 +102,54 @@ def save_dataset_with_timestamp(dataset, output_dir, pre_name, save_csv=True, sa
     if save_csv:
         dataset.to_csv(os.path.join(output_dir, f'{pre_name}_{time_str}.csv'))
     if save_json:
-        dataset.to_json(os.path.join(output_dir, f'{pre_name}_{time_str}.jsonl'))
\ No newline at end of file
+        dataset.to_json(os.path.join(output_dir, f'{pre_name}_{time_str}.jsonl'))
+
+def _metric_rows_2_md_table(head_names, row_list):
+    """`row_list` is a list of (row head values, metric dict), one column per numeric metric of any row."""
+    metric_names = []
+    for _, eval_result in row_list:
+        metric_names += [name for name, value in eval_result.items()
+                         if isinstance(value, (int, float)) and name not in metric_names]
+    names = list(head_names) + metric_names
+    table_str = '\n| ' + ' | '.join(names) + ' |\n'
+    table_str += '|' + '|'.join(['-' * (len(name) + 2) for name in names]) + '|\n'
+    for row_heads, eval_result in row_list:
+        values = [str(round(eval_result[name], 4)) if name in eval_result else '' for name in metric_names]
+        table_str += '| ' + ' | '.join([str(row_head) for row_head in row_heads] + values) + ' |\n'
+    return table_str
+
+
+def sweep_results_2_md_table(sweep_result: Dict):
+    return _metric_rows_2_md_table(['Rerank', 'Top k'], [
+        ((rerank_name, top_k_name), eval_result)
+        for rerank_name, top_k_2_result in sweep_result.items()
+        for top_k_name, eval_result in top_k_2_result.items()
+    ])
+
+
+def multi_dataset_results_2_md_table(dataset_2_result: Dict):
+    return _metric_rows_2_md_table(['Dataset'], [
+        ((dataset_name,), eval_result) for dataset_name, eval_result in dataset_2_result.items()
+    ])
+
+
+def confidence_intervals_2_md_table(intervals: Dict):
+    return _metric_rows_2_md_table(['Metric', 'Method'], [
+        ((metric_name, interval['method']), {name: interval[name] for name in ['estimate', 'lower', 'upper', 'width']})
+        for metric_name, interval in intervals.items()
+    ])
+
+
+def load_test_results_2_md_table(level_results: List[Dict]):
+    row_list = []
+    for level_result in level_results:
+        row = {
+            'throughput': level_result['throughput'],
+            'error_rate': level_result['error_rate'],
+        }
+        for name in ['p50', 'p90', 'p99', 'max']:
+            if name in level_result['latency']:
+                row[f'latency_{name}'] = level_result['latency'][name]
+        row.update(level_result['metrics'])
+        row_list.append(((level_result['target_qps'],), row))
+    return _metric_rows_2_md_table(['Target QPS'], row_list)
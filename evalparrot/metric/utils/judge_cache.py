@@ -0,0 +1,228 @@
+import contextvars
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import tiktoken
+from langchain.callbacks.openai_info import get_openai_token_cost_for_model
+from langchain.globals import get_llm_cache, set_llm_cache
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from langchain.schema.cache import BaseCache
+
+DEFAULT_JUDGE_CACHE_PATH = './outputs/kilt/judge_cache.sqlite'
+
+_current_metric = contextvars.ContextVar('judge_cache_metric', default='')
+
+MODEL_NAME_PATTERN = re.compile(r'''["']model(?:_name)?["']\s*[:,]\s*["']([\w.\-:]+)["']''')
+
+
+@contextmanager
+def judge_metric(metric_name):
+    """Tag the llm calls made in this context (of the current thread) with the metric name in the judge cache."""
+    token = _current_metric.set(metric_name)
+    try:
+        yield
+    finally:
+        _current_metric.reset(token)
+
+
+def _prompt_text(prompt):
+    # a chat prompt is the json dump of the messages, only their contents are sent as tokens
+    try:
+        messages = json.loads(prompt)
+    except ValueError:
+        return prompt
+    if not isinstance(messages, list):
+        return prompt
+    return '\n'.join(str(message.get('kwargs', {}).get('content', '')) for message in messages
+                     if isinstance(message, dict))
+
+
+class JudgeCache(BaseCache):
+    """
+    Persistent langchain llm cache of the judgements of the ragas metrics in a sqlite file.
+    A judgement is keyed by the hash of the metric, the prompt and the llm string (model and its params),
+    so the same row judged again, by another repetition or another run, does not call openai again.
+    With `bypass` every call goes to openai and nothing is read or written, for studying the variance of the judge.
+    The tokens and cost of every entry are counted with tiktoken when it is written,
+    so that `stats()` reports the usage saved by the hits next to the usage of the misses.
+    Concurrent lookups of the same key wait for the first one, instead of all calling openai.
+    """
+
+    def __init__(self, cache_path=DEFAULT_JUDGE_CACHE_PATH, bypass=False, in_flight_timeout=120):
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_path = cache_path
+        self.bypass = bypass
+        self.in_flight_timeout = in_flight_timeout
+        self._conn = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS judge_cache (key TEXT PRIMARY KEY, metric TEXT, model TEXT, '
+                           'generations TEXT, prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL, '
+                           'created REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS metric_index ON judge_cache (metric)')
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._key_2_event = dict()
+        self._claimed = threading.local()
+        self._usage = {'hits': [0, 0, 0, 0.0], 'misses': [0, 0, 0, 0.0]}
+
+    @staticmethod
+    def build_key(metric, prompt, llm_string):
+        key_str = json.dumps([metric, prompt, llm_string])
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def parse_model_name(llm_string):
+        match = MODEL_NAME_PATTERN.search(llm_string)
+        return match.group(1) if match else ''
+
+    def _claimed_keys(self):
+        if not hasattr(self._claimed, 'keys'):
+            self._claimed.keys = set()
+        return self._claimed.keys
+
+    def _add_usage(self, kind, prompt_tokens, completion_tokens, cost):
+        usage = self._usage[kind]
+        usage[0] += 1
+        usage[1] += prompt_tokens
+        usage[2] += completion_tokens
+        usage[3] += cost
+
+    def lookup(self, prompt, llm_string):
+        if self.bypass:
+            return None
+        key = self.build_key(_current_metric.get(), prompt, llm_string)
+        while True:
+            with self._lock:
+                row = self._conn.execute('SELECT generations, prompt_tokens, completion_tokens, cost '
+                                         'FROM judge_cache WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._add_usage('hits', row[1], row[2], row[3])
+                    break
+                event = self._key_2_event.get(key)
+                if event is None:
+                    # this thread calls openai for the key, the others wait for its update()
+                    self._key_2_event[key] = threading.Event()
+                    self._claimed_keys().add(key)
+                    return None
+            if not event.wait(self.in_flight_timeout):
+                with self._lock:
+                    if self._key_2_event.get(key) is event:
+                        self._key_2_event.pop(key)
+        return [loads(generation) for generation in json.loads(row[0])]
+
+    def _count_tokens(self, model, text):
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            # the encoding can not be downloaded, fall back to about 4 characters per token
+            return len(text) // 4
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def _cost(self, model, prompt_tokens, completion_tokens):
+        try:
+            return (get_openai_token_cost_for_model(model, prompt_tokens)
+                    + get_openai_token_cost_for_model(model, completion_tokens, is_completion=True))
+        except ValueError:
+            return 0.0
+
+    def update(self, prompt, llm_string, return_val):
+        if self.bypass:
+            return
+        metric = _current_metric.get()
+        key = self.build_key(metric, prompt, llm_string)
+        try:
+            model = self.parse_model_name(llm_string)
+            prompt_tokens = self._count_tokens(model, _prompt_text(prompt))
+            completion_tokens = sum(self._count_tokens(model, generation.text) for generation in return_val)
+            cost = self._cost(model, prompt_tokens, completion_tokens)
+            generations = json.dumps([dumps(generation) for generation in return_val])
+            with self._lock:
+                self._conn.execute('INSERT OR REPLACE INTO judge_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (key, metric, model, generations, prompt_tokens, completion_tokens, cost,
+                                    time.time()))
+                self._conn.commit()
+                self._add_usage('misses', prompt_tokens, completion_tokens, cost)
+        finally:
+            with self._lock:
+                self._release(key)
+
+    def _release(self, key):
+        event = self._key_2_event.pop(key, None)
+        if event is not None:
+            event.set()
+        self._claimed_keys().discard(key)
+
+    def abandon(self):
+        """Release the keys claimed by the lookups of this thread whose llm calls failed, so the waiters retry them."""
+        with self._lock:
+            for key in list(self._claimed_keys()):
+                self._release(key)
+
+    def clear(self, metric=None, model=None, **kwargs):
+        """Invalidate the cached judgements of `metric` and `model`, or all of them if both are None."""
+        conditions, params = [], []
+        if metric is not None:
+            conditions.append('metric = ?')
+            params.append(metric)
+        if model is not None:
+            conditions.append('model = ?')
+            params.append(model)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+        with self._lock:
+            deleted = self._conn.execute(f'DELETE FROM judge_cache{where}', params).rowcount
+            self._conn.commit()
+        return deleted
+
+    def stats(self):
+        with self._lock:
+            stats = dict()
+            for kind, (calls, prompt_tokens, completion_tokens, cost) in self._usage.items():
+                stats[kind] = {
+                    'calls': calls,
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'total_tokens': prompt_tokens + completion_tokens,
+                    'cost': cost,
+                }
+            lookups = stats['hits']['calls'] + stats['misses']['calls']
+            stats['hit_rate'] = stats['hits']['calls'] / lookups if lookups else 0.0
+            stats['bypass'] = self.bypass
+            return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@contextmanager
+def use_judge_cache(judge_cache):
+    """Install `judge_cache` as the global langchain llm cache in this context, no-op if it is None."""
+    if judge_cache is None:
+        yield
+        return
+    old_cache = get_llm_cache()
+    set_llm_cache(judge_cache)
+    try:
+        yield
+    finally:
+        set_llm_cache(old_cache)
+
+
+def judge_cache_usage_str(judge_cache):
+    if judge_cache is None:
+        return ''
+    stats = judge_cache.stats()
+    return (f' judge cache: {stats["hits"]["calls"]} hits saved about {stats["hits"]["total_tokens"]} token = '
+            f'${stats["hits"]["cost"]}, {stats["misses"]["calls"]} misses cost about '
+            f'{stats["misses"]["total_tokens"]} token = ${stats["misses"]["cost"]}.')
@@ -1,17 +1,271 @@
 from __future__ import annotations
 
-from collections import defaultdict
+import copy
+import random
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Tuple
 
 import numpy as np
 from ragas.metrics.base import Metric
 
 import time
-from ragas import evaluate
 
-from datasets import Dataset
+from datasets import Dataset, concatenate_datasets
 from langchain.callbacks import get_openai_callback
 from ragas.evaluation import Result
+from ragas.metrics.critique import AspectCritique
+from ragas.validation import remap_column_names, validate_column_dtypes, validate_evaluation_modes
+
+from .judge_cache import judge_cache_usage_str, judge_metric, use_judge_cache
+
+
+def is_rate_limit_error(e):
+    """Whether the exception is a rate limit (429) response of the llm api."""
+    status = getattr(e, 'http_status', None) or getattr(e, 'status_code', None)
+    return status == 429 or 'RateLimit' in type(e).__name__ or '429' in str(e)
+
+
+def backoff_seconds(attempt, retry_backoff=2.0, retry_interval=60 * 2):
+    """Exponential backoff with jitter of the `attempt`-th retry, starting from 1 and capped at `retry_interval`."""
+    return min(retry_interval, retry_backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class RateLimiter:
+    """
+    Client side budget of the llm requests and tokens per minute, shared by all the evaluation threads.
+    `acquire()` blocks until the estimated usage of a task fits into the sliding one minute window,
+    and `update()` corrects the estimation with the actual usage once the task is done.
+    A task larger than the whole budget is still let through when the window is empty.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, window=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._entries = deque()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _fits(self, requests, tokens):
+        if not self._entries:
+            return True
+        used_requests = sum(entry[1] for entry in self._entries)
+        used_tokens = sum(entry[2] for entry in self._entries)
+        return ((self.requests_per_minute is None or used_requests + requests <= self.requests_per_minute)
+                and (self.tokens_per_minute is None or used_tokens + tokens <= self.tokens_per_minute))
+
+    def acquire(self, requests=1, tokens=0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    while self._entries and self._entries[0][0] <= now - self.window:
+                        self._entries.popleft()
+                    if self._fits(requests, tokens):
+                        entry = [now, requests, tokens]
+                        self._entries.append(entry)
+                        return entry
+                    wait = self._entries[0][0] + self.window - now
+            time.sleep(min(max(wait, 0.05), self.window))
+
+    def update(self, entry, requests, tokens):
+        with self._lock:
+            entry[1] = requests
+            entry[2] = tokens
+
+    def pause(self, seconds):
+        """Hold all the tasks for `seconds`, after the llm api has answered 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class _UsageStats:
+    """The llm usage of the finished tasks, and the average usage per row of each metric to estimate the next tasks."""
+
+    def __init__(self):
+        self.total_tokens = 0
+        self.total_cost = 0.0
+        self.total_requests = 0
+        self._metric_2_usage = defaultdict(lambda: [0, 0, 0])
+        self._lock = threading.Lock()
+
+    def estimate(self, metric_name, row_num):
+        with self._lock:
+            rows, requests, tokens = self._metric_2_usage[metric_name]
+        if rows == 0:
+            return row_num, 0
+        return max(1, round(requests / rows * row_num)), round(tokens / rows * row_num)
+
+    def add(self, metric_name, row_num, cb):
+        with self._lock:
+            usage = self._metric_2_usage[metric_name]
+            usage[0] += row_num
+            usage[1] += cb.successful_requests
+            usage[2] += cb.total_tokens
+            self.total_requests += cb.successful_requests
+            self.total_tokens += cb.total_tokens
+            self.total_cost += cb.total_cost
+
+
+class _ThreadMetrics:
+    """
+    Each worker thread scores with its own deep copy of a metric,
+    because ragas sets `n` and `temperature` on the llm of the metric while generating.
+    A metric that can not be deep copied is shared and scored by one thread at a time.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._metric_id_2_lock = dict()
+
+    @contextmanager
+    def checkout(self, metric):
+        metric_id_2_copy = getattr(self._local, 'metric_id_2_copy', None)
+        if metric_id_2_copy is None:
+            metric_id_2_copy = self._local.metric_id_2_copy = dict()
+        if id(metric) not in metric_id_2_copy and id(metric) not in self._metric_id_2_lock:
+            try:
+                metric_id_2_copy[id(metric)] = copy.deepcopy(metric)
+            except Exception as e:
+                with self._lock:
+                    if id(metric) not in self._metric_id_2_lock:
+                        print(f'can not copy {metric.name} for each thread: {e!r}, its batches are scored one by one.')
+                        self._metric_id_2_lock[id(metric)] = threading.Lock()
+        thread_metric = metric_id_2_copy.get(id(metric))
+        if thread_metric is not None:
+            yield thread_metric
+            return
+        with self._metric_id_2_lock[id(metric)]:
+            yield metric
+
+
+def _prepare_dataset(dataset, metrics, column_map):
+    dataset = remap_column_names(dataset, column_map)
+    validate_evaluation_modes(dataset, metrics)
+    validate_column_dtypes(dataset)
+    return dataset
+
+
+def _row_batches(metric, row_num, batch_rows=None):
+    if batch_rows is None:
+        return metric.get_batches(row_num)
+    return [range(start, min(start + batch_rows, row_num)) for start in range(0, row_num, batch_rows)]
+
+
+def _score_rows(dataset, metric, rows, dataset_ind, limiter, usage_stats, retry_num, retry_backoff, retry_interval,
+                judge_cache=None, thread_metrics=None):
+    """Score `rows` of the dataset with the metric, only these rows are retried when it fails."""
+    if thread_metrics is None:
+        thread_metrics = _ThreadMetrics()
+    error = None
+    for attempt in range(1, retry_num + 1):
+        requests, tokens = usage_stats.estimate(metric.name, len(rows))
+        entry = limiter.acquire(requests, tokens)
+        # the openai callback is a context variable, so it must be opened in the worker thread
+        with get_openai_callback() as cb, judge_metric(metric.name), thread_metrics.checkout(metric) as thread_metric:
+            try:
+                scores = thread_metric.score(dataset.select(rows))[metric.name]
+            except Exception as e:
+                error = e
+                if judge_cache is not None:
+                    judge_cache.abandon()
+            else:
+                error = None
+        limiter.update(entry, cb.successful_requests, cb.total_tokens)
+        usage_stats.add(metric.name, len(rows), cb)
+        if error is None:
+            return scores
+        if attempt < retry_num:
+            backoff = backoff_seconds(attempt, retry_backoff, retry_interval)
+            if is_rate_limit_error(error):
+                limiter.pause(backoff)
+            print(f'{metric.name} of rows {rows.start}-{rows.stop - 1} of dataset {dataset_ind} failed: {error!r}, '
+                  f'retry in {backoff:.1f} s...')
+            time.sleep(backoff)
+    raise RuntimeError(f'ragas evaluation of {metric.name} on rows {rows.start}-{rows.stop - 1} of dataset '
+                       f'{dataset_ind} still failed after {retry_num} attempts, last error: {error!r}') from error
+
+
+def concurrent_evaluate(
+        dataset_list: List[Dataset],
+        metrics: list[Metric] | None = None,
+        column_map: dict[str, str] = {
+            "question": "question",
+            "contexts": "contexts",
+            "answer": "answer",
+            "ground_truths": "ground_truths",
+        },
+        concurrency=8,
+        batch_rows=None,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        retry_num=3,
+        retry_backoff=2.0,
+        retry_interval=60 * 2,
+        judge_cache=None,
+) -> List[Result]:
+    """
+    Evaluate every dataset of `dataset_list` with the ragas metrics, the same as `ragas.evaluate()` one by one,
+    but all the datasets, metrics and row batches are scored concurrently in `concurrency` threads,
+    each thread with its own copy of the metrics.
+    The llm requests and tokens are kept under `requests_per_minute` and `tokens_per_minute` if set,
+    a failed batch of `batch_rows` rows (default is the batch size of the metric) is retried alone
+    with exponential backoff and jitter, and a 429 response holds all the threads for the backoff.
+    Raise RuntimeError if a batch still fails after `retry_num` attempts.
+    The llm judgements are served from and saved into `judge_cache` if given, see `JudgeCache`.
+    """
+    if metrics is None:
+        from ragas.metrics import (
+            answer_relevancy,
+            context_precision,
+            context_recall,
+            faithfulness,
+        )
+
+        metrics = [answer_relevancy, context_precision, faithfulness, context_recall]
+    dataset_list = [_prepare_dataset(dataset, metrics, column_map) for dataset in dataset_list]
+    [m.init_model() for m in metrics]
+
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    usage_stats = _UsageStats()
+    thread_metrics = _ThreadMetrics()
+    future_2_key = dict()
+    key_2_scores = dict()
+    with use_judge_cache(judge_cache), ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for dataset_ind, dataset in enumerate(dataset_list):
+            for metric in metrics:
+                for rows in _row_batches(metric, len(dataset), batch_rows):
+                    future = executor.submit(_score_rows, dataset, metric, rows, dataset_ind, limiter, usage_stats,
+                                             retry_num, retry_backoff, retry_interval, judge_cache, thread_metrics)
+                    future_2_key[future] = (dataset_ind, metric.name, rows.start)
+        try:
+            for future in as_completed(future_2_key):
+                key_2_scores[future_2_key[future]] = future.result()
+        except Exception:
+            for future in future_2_key:
+                future.cancel()
+            raise
+    print(f' this running token = {usage_stats.total_tokens}, requests = {usage_stats.total_requests}, '
+          f'cost about = ${usage_stats.total_cost}.' + judge_cache_usage_str(judge_cache))
+
+    binary_columns = [metric.name for metric in metrics if isinstance(metric, AspectCritique)]
+    result_list = []
+    for dataset_ind, dataset in enumerate(dataset_list):
+        scores = []
+        for metric in metrics:
+            metric_scores = []
+            for key in sorted(key for key in key_2_scores if key[:2] == (dataset_ind, metric.name)):
+                metric_scores.extend(key_2_scores[key])
+            scores.append(Dataset.from_dict({metric.name: metric_scores}))
+        result = Result(scores=concatenate_datasets(scores, axis=1), dataset=dataset, binary_columns=binary_columns)
+        print(result)
+        result_list.append(result)
+    return result_list
 
 
 def retry_evaluate(
@@ -24,23 +278,51 @@ def retry_evaluate(
             "ground_truths": "ground_truths",
         },
         retry_num=3,
-        retry_interval=60 * 2
+        retry_interval=60 * 2,
+        retry_backoff=2.0,
+        judge_cache=None,
 ) -> Result:
-    with get_openai_callback() as cb:
-        for _ in range(retry_num):
-            try:
-                result = evaluate(
-                    dataset,
-                    metrics=metrics,
-                    column_map=column_map
-                )
-                break
-            except Exception as e:
-                time.sleep(retry_interval)
-                print(e)
-                print('failed, retry...')
-                continue
-        print(f' this running token = {cb.total_tokens}, cost about = ${cb.total_cost}.')
+    """
+    The same as `ragas.evaluate()`, but each metric is scored on its own and retried with exponential backoff
+    when it fails, under its name in `judge_cache` if given.
+    Raise RuntimeError if a metric still fails after `retry_num` attempts.
+    """
+    if metrics is None:
+        from ragas.metrics import (
+            answer_relevancy,
+            context_precision,
+            context_recall,
+            faithfulness,
+        )
+
+        metrics = [answer_relevancy, context_precision, faithfulness, context_recall]
+    dataset = _prepare_dataset(dataset, metrics, column_map)
+    [m.init_model() for m in metrics]
+
+    scores = []
+    with get_openai_callback() as cb, use_judge_cache(judge_cache):
+        for metric in metrics:
+            error = None
+            for attempt in range(1, retry_num + 1):
+                try:
+                    with judge_metric(metric.name):
+                        scores.append(metric.score(dataset).select_columns(metric.name))
+                    break
+                except Exception as e:
+                    error = e
+                    if judge_cache is not None:
+                        judge_cache.abandon()
+                    print(e)
+                    if attempt < retry_num:
+                        print(f'{metric.name} failed, retry...')
+                        time.sleep(backoff_seconds(attempt, retry_backoff, retry_interval))
+            else:
+                raise RuntimeError(f'ragas evaluation of {metric.name} still failed after {retry_num} attempts, '
+                                   f'last error: {error!r}') from error
+        print(f' this running token = {cb.total_tokens}, cost about = ${cb.total_cost}.'
+              + judge_cache_usage_str(judge_cache))
+    binary_columns = [metric.name for metric in metrics if isinstance(metric, AspectCritique)]
+    result = Result(scores=concatenate_datasets(scores, axis=1), dataset=dataset, binary_columns=binary_columns)
     print(result)
     return result
 
@@ -72,14 +354,18 @@ def multi_evaluate_one_dataset(
         run_num=4,
         retry_num=3,
         retry_interval=60 * 2,
+        concurrency=8,
+        batch_rows=None,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        judge_cache=None,
 ) -> Tuple[List[Result], Dict]:
     print('run multi_evaluate_one_dataset()')
     t0 = time.time()
-    result_list = []
-    for run_ind in range(run_num):
-        print(f'\n[run_ind={run_ind}]')
-        result = retry_evaluate(dataset, metrics, column_map, retry_num=retry_num, retry_interval=retry_interval)
-        result_list.append(result)
+    result_list = concurrent_evaluate([dataset] * run_num, metrics, column_map, concurrency=concurrency,
+                                      batch_rows=batch_rows, requests_per_minute=requests_per_minute,
+                                      tokens_per_minute=tokens_per_minute, retry_num=retry_num,
+                                      retry_interval=retry_interval, judge_cache=judge_cache)
 
     multi_run_result = calcu_mean_var(result_list)
     t1 = time.time()
@@ -98,14 +384,18 @@ def multi_evaluate_multi_dataset(
         },
         retry_num=3,
         retry_interval=60 * 2,
+        concurrency=8,
+        batch_rows=None,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        judge_cache=None,
 ) -> Tuple[List[Result], Dict]:
     print('run multi_evaluate_multi_dataset()')
     t0 = time.time()
-    result_list = []
-    for run_ind, dataset in enumerate(dataset_list):
-        print(f'\n[run_ind={run_ind}]')
-        result = retry_evaluate(dataset, metrics, column_map, retry_num=retry_num, retry_interval=retry_interval)
-        result_list.append(result)
+    result_list = concurrent_evaluate(list(dataset_list), metrics, column_map, concurrency=concurrency,
+                                      batch_rows=batch_rows, requests_per_minute=requests_per_minute,
+                                      tokens_per_minute=tokens_per_minute, retry_num=retry_num,
+                                      retry_interval=retry_interval, judge_cache=judge_cache)
 
     multi_run_result = calcu_mean_var(result_list)
     t1 = time.time()
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+
+from .http_utils import build_db_config, get_parrot_client, post_upsert_kilt, post_upsert_kilt_with_multi_doc, \
+    STORE_DOMAIN, PARROT_DOMAIN
+from ..dataset.doc_provenance import DocProvenanceStore, DOC_PROVENANCE_NAME
+from ..dataset.kilt_data import build_wiki_doc_text
+from ..dataset.knowledge_source import prefetch_pages
+
+MANIFEST_NAME = 'corpus_manifest.json'
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def build_corpus_config(kb_id, doc_gen_type, store_domain):
+    # rerank only affects searching, so it is not part of the ingested corpus
+    db_config = build_db_config(kb_id, None, store_domain)
+    return {
+        'kb_id': kb_id,
+        'doc_gen_type': doc_gen_type,
+        'lang': db_config['lang'],
+        'chunk_limit': db_config['chunk_limit'],
+        'embedding': db_config['embedding'],
+        'milvus_uri': db_config['milvus']['uri'],
+    }
+
+
+def get_manifest_hash(manifest):
+    return hash_text(json.dumps(manifest, sort_keys=True))
+
+
+def load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir, manifest):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    temp_manifest_path = manifest_path + '.tmp'
+    with open(temp_manifest_path, 'w') as f:
+        f.write(json.dumps(manifest, indent=4))
+    os.replace(temp_manifest_path, manifest_path)
+
+
+def remove_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+def sync_doc_provenance(output_dir, doc_name_2_page, synced_doc_names, upserted_doc_names):
+    """Record the provenance of the synced documents of a 'multi' kb, and forget the documents not in it any more."""
+    store = DocProvenanceStore(os.path.join(output_dir, DOC_PROVENANCE_NAME))
+    recorded_doc_names = store.doc_names()
+    store.delete(recorded_doc_names - set(synced_doc_names))
+    store.record_pages({doc_name: doc_name_2_page[doc_name] for doc_name in synced_doc_names
+                        if doc_name in upserted_doc_names or doc_name not in recorded_doc_names})
+    store.close()
+
+
+def sync_corpus(project_name, output_dir, doc_gen_type, ks, temp_doc_path, kilt_dataset_name=None,
+                wikipedia_id_set=None, documents=None, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN,
+                rerank=None, upsert_concurrency=8, force_reingest=False, timer=None):
+    """
+    Make the parrot kb `project_name` contain exactly the desired documents, with as few requests as possible.
+    What has been ingested into the kb is recorded in a manifest of content hashes in `output_dir`,
+    the kb is only deleted and recreated when there is no manifest or the corpus config changed,
+    otherwise only the new or changed documents are upserted and the removed ones are deleted.
+    In 'multi' mode the provenance of every document is recorded too, see `DocProvenanceStore`.
+    Return the report dict of the ingestion.
+    """
+    client = get_parrot_client(parrot_domain, store_domain)
+    corpus_config = build_corpus_config(project_name, doc_gen_type, store_domain)
+    if doc_gen_type == 'multi':
+        prefetch_pages(ks, wikipedia_id_set)
+        doc_name_2_page = {str(wikipedia_id): ks.get_page_by_id(int(wikipedia_id)) for wikipedia_id in wikipedia_id_set}
+        doc_name_2_hash = {doc_name: hash_text(build_wiki_doc_text(page)) for doc_name, page in doc_name_2_page.items()}
+    else:
+        doc_name_2_hash = {kilt_dataset_name: hash_text(''.join(document.page_content for document in documents))}
+
+    manifest = load_manifest(output_dir)
+    rebuild = force_reingest or manifest is None or manifest['corpus_config'] != corpus_config
+    if rebuild:
+        # the manifest is removed before the kb, so that an interrupted rebuild never looks synced
+        remove_manifest(output_dir)
+        try:
+            client.delete(project_name, rerank=rerank)
+        except:
+            pass  # collection not exist, first time delete
+        client.create(project_name, rerank=rerank)
+        synced_doc_name_2_hash = dict()
+    else:
+        synced_doc_name_2_hash = dict(manifest['documents'])
+
+    delete_doc_names = [doc_name for doc_name in synced_doc_name_2_hash if doc_name not in doc_name_2_hash]
+    upsert_doc_names = [doc_name for doc_name, doc_hash in doc_name_2_hash.items()
+                        if synced_doc_name_2_hash.get(doc_name) != doc_hash]
+    print(f'corpus sync of {project_name}: rebuild = {rebuild}, {len(upsert_doc_names)} documents to upsert, '
+          f'{len(delete_doc_names)} documents to delete.')
+
+    for doc_name in delete_doc_names:
+        try:
+            client.delete_document(project_name, doc_name, rerank=rerank)
+        except Exception as e:
+            print(f'failed to delete document {doc_name}: {e}, rebuild the whole kb.')
+            return sync_corpus(project_name, output_dir, doc_gen_type, ks, temp_doc_path,
+                               kilt_dataset_name=kilt_dataset_name, wikipedia_id_set=wikipedia_id_set,
+                               documents=documents, store_domain=store_domain, parrot_domain=parrot_domain,
+                               rerank=rerank, upsert_concurrency=upsert_concurrency, force_reingest=True,
+                               timer=timer)
+        synced_doc_name_2_hash.pop(doc_name)
+
+    doc_name_2_token_used = dict()
+    doc_name_2_error = dict()
+    if upsert_doc_names and doc_gen_type == 'multi':
+        doc_name_2_token_used, doc_name_2_error = post_upsert_kilt_with_multi_doc(
+            project_name=project_name,
+            ks=ks,
+            wikipedia_id_set=set(upsert_doc_names),
+            temp_doc_dir=temp_doc_path,
+            store_domain=store_domain,
+            parrot_domain=parrot_domain,
+            rerank=rerank,
+            upsert_concurrency=upsert_concurrency,
+            timer=timer
+        )
+    elif upsert_doc_names:
+        post_upsert_kilt(project_name=project_name,
+                         kilt_dataset_name=kilt_dataset_name,
+                         documents=documents,
+                         temp_file_path=temp_doc_path,
+                         store_domain=store_domain,
+                         parrot_domain=parrot_domain,
+                         rerank=rerank,
+                         timer=timer)
+        doc_name_2_token_used[kilt_dataset_name] = None
+    for doc_name in doc_name_2_token_used:
+        synced_doc_name_2_hash[doc_name] = doc_name_2_hash[doc_name]
+    save_manifest(output_dir, {'corpus_config': corpus_config, 'documents': synced_doc_name_2_hash})
+    if doc_gen_type == 'multi':
+        sync_doc_provenance(output_dir, doc_name_2_page, synced_doc_name_2_hash, doc_name_2_token_used)
+    elif os.path.exists(os.path.join(output_dir, DOC_PROVENANCE_NAME)):
+        os.remove(os.path.join(output_dir, DOC_PROVENANCE_NAME))
+
+    return {
+        'rebuild': rebuild,
+        'upserted': len(doc_name_2_token_used),
+        'deleted': len(delete_doc_names),
+        'token_used': doc_name_2_token_used,
+        'failed': doc_name_2_error,
+    }
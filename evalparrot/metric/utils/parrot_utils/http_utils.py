@@ -1,13 +1,23 @@
 #### This py is used for new parrot version, main branch
 
+import copy
 import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
 
 # URL_DOMAIN = 'http://127.0.0.1:8998'
 from langchain.schema import Document
 from tqdm import tqdm
 
 from ..dataset.kilt_data import dump_wiki_doc
+from ..dataset.knowledge_source import prefetch_pages
+from ..timing import timed_call
 
 PARROT_DOMAIN = 'http://127.0.0.1:8999'
 STORE_DOMAIN = 'http://127.0.0.1'
@@ -23,7 +33,7 @@ DB_CONFIG = {
 }
 
 def build_db_config(kb_id, rerank, store_domain):
-    db_config = DB_CONFIG.copy()
+    db_config = copy.deepcopy(DB_CONFIG)
     db_config['kb_id'] = kb_id
     db_config['rerank'] = rerank
     db_config['milvus']['uri'] = f"http://{store_domain}:19530"
@@ -41,72 +51,195 @@ search_param = {
     "expr": None
 }
 
+def build_search_param(top_k):
+    search_param_ = copy.deepcopy(search_param)
+    search_param_['top_k'] = top_k
+    return search_param_
+
+
+class ParrotClient:
+    """
+    Thread-safe client of a parrot service.
+    All threads share one keep-alive connection pool, each thread uses its own requests session on top of it,
+    and every request body is built freshly from DB_CONFIG and search_param, so the module globals are never mutated.
+    With `max_in_flight`, at most that many requests are sent at the same time, whichever thread sends them.
+    """
+
+    def __init__(self, parrot_domain=PARROT_DOMAIN, store_domain=STORE_DOMAIN, pool_size=64, max_in_flight=None):
+        self.parrot_domain = parrot_domain
+        self.store_domain = store_domain
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._local = threading.local()
+        self._in_flight = None
+        self.set_max_in_flight(max_in_flight)
+
+    def set_max_in_flight(self, max_in_flight=None):
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def _post(self, api, post_json, timeout=None):
+        in_flight = self._in_flight
+        if in_flight is None:
+            response = self.session.post(self.parrot_domain + api, json=post_json, timeout=timeout)
+        else:
+            with in_flight:
+                response = self.session.post(self.parrot_domain + api, json=post_json, timeout=timeout)
+        assert response.status_code == 200, f'{api} failed, status_code = {response.status_code}'
+        return response
+
+    def delete(self, project_name, rerank=None):
+        db_config = build_db_config(project_name, rerank, self.store_domain)
+        self._post('/api/v1/db/delete', db_config)
+
+    def create(self, project_name, rerank=None):
+        db_config = build_db_config(project_name, rerank, self.store_domain)
+        self._post('/api/v1/db/create', {'db_config': db_config})
+
+    def upsert(self, project_name, doc_name, source, rerank=None, timeout=None, timer=None):
+        """Upsert the document file `source` as `doc_name`, and return the token used reported by parrot."""
+        db_config = build_db_config(project_name, rerank, self.store_domain)
+        with timed_call(timer, 'upsert'):
+            response = self._post('/api/v1/document/upsert', {
+                'doc_name': doc_name,
+                'source': source,
+                'db_config': db_config
+            }, timeout=timeout)
+        token_used = response.json()['data']
+        assert isinstance(token_used, int) and token_used > 0
+        if timer is not None:
+            timer.add_count('upsert_token_used', token_used)
+        return token_used
+
+    def delete_document(self, project_name, doc_name, rerank=None):
+        db_config = build_db_config(project_name, rerank, self.store_domain)
+        self._post('/api/v1/document/delete', {
+            'doc_name': doc_name,
+            'db_config': db_config
+        })
+
+    def search(self, query, project_name, top_k=None, rerank=None, timeout=None, timer=None):
+        """Return the list of search results, each of them has the fields of `search_param['output_fields']`."""
+        db_config = build_db_config(project_name, rerank, self.store_domain)
+        with timed_call(timer, 'search'):
+            response = self._post('/api/v1/search', {
+                'query': query,
+                'db_config': db_config,
+                'search_param': build_search_param(top_k)
+            }, timeout=timeout)
+        return response.json()['data']
+
+    def close(self):
+        self._adapter.close()
+
+
+_client_lock = threading.Lock()
+_domain_2_client = dict()
+
+
+def get_parrot_client(parrot_domain=PARROT_DOMAIN, store_domain=STORE_DOMAIN):
+    """Return the process-wide ParrotClient of the parrot service and store domain."""
+    key = (parrot_domain, store_domain)
+    with _client_lock:
+        client = _domain_2_client.get(key)
+        if client is None:
+            client = ParrotClient(parrot_domain=parrot_domain, store_domain=store_domain)
+            _domain_2_client[key] = client
+    return client
+
+
 def post_delete(project_name, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN, rerank=None):
-    url = parrot_domain + '/api/v1/db/delete'
-    db_config = build_db_config(project_name, rerank, store_domain)
-    response = requests.post(url, json=db_config)
-    assert response.status_code == 200
+    get_parrot_client(parrot_domain, store_domain).delete(project_name, rerank=rerank)
 
 
 def post_create(project_name, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN, rerank=None):
-    url = parrot_domain + '/api/v1/db/create'
-    db_config = build_db_config(project_name, rerank, store_domain)
-    response = requests.post(url, json={'db_config': db_config})
-    assert response.status_code == 200
-    # print(response)
+    get_parrot_client(parrot_domain, store_domain).create(project_name, rerank=rerank)
 
 
-def post_upsert_kilt(project_name, kilt_dataset_name, documents, temp_file_path, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN, rerank=None):
+def post_upsert_kilt(project_name, kilt_dataset_name, documents, temp_file_path, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN, rerank=None,
+                     timer=None):
     content_2_wikipedia_id = dict()
     with open(temp_file_path, 'w') as f:
         for document in tqdm(documents):
             content_2_wikipedia_id[document.page_content.strip()] = document.metadata['wikipedia_id']
             f.write(document.page_content)
     temp_file_path = os.path.abspath(temp_file_path)
-    url = parrot_domain + '/api/v1/document/upsert'
-    db_config = build_db_config(project_name, rerank, store_domain)
-    response = requests.post(url, json={
-        'doc_name': kilt_dataset_name,
-        'source': temp_file_path,
-        'db_config': db_config
-    })
-    assert response.status_code == 200
-    token_used = response.json()['data']
-    assert isinstance(token_used, int) and token_used > 0
+    get_parrot_client(parrot_domain, store_domain).upsert(project_name, kilt_dataset_name, temp_file_path,
+                                                          rerank=rerank, timer=timer)
     return content_2_wikipedia_id
 
-def post_upsert_kilt_with_multi_doc(project_name, ks, wikipedia_id_set, temp_file_path, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN, rerank=None):
-    for wikipedia_id in tqdm(list(wikipedia_id_set)):
-        dump_wiki_doc(wikipedia_id, temp_file_path, ks=ks)
-        temp_file_path = os.path.abspath(temp_file_path)
-        url = parrot_domain + '/api/v1/document/upsert'
-        db_config = build_db_config(project_name, rerank, store_domain)
-        response = requests.post(url, json={
-            'doc_name': wikipedia_id,
-            'source': temp_file_path,
-            'db_config': db_config
-        })
-        assert response.status_code == 200
-        token_used = response.json()['data']
-        assert isinstance(token_used, int) and token_used > 0
-
-
-def post_search(query, project_name, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN, top_k=None, rerank=None):
-    url = parrot_domain + '/api/v1/search'
-    db_config = build_db_config(project_name, rerank, store_domain)
-    search_param['top_k'] = top_k
-    post_json = {
-        'query': query,
-        'db_config': db_config,
-        'search_param': search_param
-    }
-    response = requests.post(url, json=post_json)
-    assert response.status_code == 200
-    result_list = response.json()['data']
+def post_upsert_kilt_with_multi_doc(project_name, ks, wikipedia_id_set, temp_doc_dir=None, store_domain=STORE_DOMAIN,
+                                    parrot_domain=PARROT_DOMAIN, rerank=None, upsert_concurrency=8, retry_num=3,
+                                    retry_interval=5, timer=None, temp_file_path=None):
+    """
+    Upsert every wikipedia page of `wikipedia_id_set` as a document named by its wikipedia_id.
+    Each page is dumped into its own file of `temp_doc_dir` and upserted in a pool of `upsert_concurrency` threads,
+    the failed pages are retried in at most `retry_num` rounds.
+    `temp_file_path` is the single temp file of the former signature, its directory is used as `temp_doc_dir`.
+    Without both, the pages are dumped into a new temp directory, which is removed at the end.
+    Return the dict of wikipedia_id to token used, and the dict of wikipedia_id to error of the still failed pages.
+    """
+    remove_temp_doc_dir = False
+    if temp_file_path is not None:
+        temp_doc_dir = os.path.dirname(os.path.abspath(temp_file_path))
+    elif temp_doc_dir is None:
+        temp_doc_dir = tempfile.mkdtemp()
+        remove_temp_doc_dir = True
+    prefetch_pages(ks, wikipedia_id_set)
+    client = get_parrot_client(parrot_domain, store_domain)
+    if not os.path.exists(temp_doc_dir):
+        os.makedirs(temp_doc_dir)
+
+    def upsert_one(wikipedia_id):
+        temp_file_path = os.path.abspath(os.path.join(temp_doc_dir, f'{wikipedia_id}.txt'))
+        try:
+            dump_wiki_doc(wikipedia_id, temp_file_path, ks=ks)
+            return client.upsert(project_name, wikipedia_id, temp_file_path, rerank=rerank, timer=timer)
+        finally:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+
+    wikipedia_id_2_token_used = dict()
+    wikipedia_id_2_error = dict()
+    pending_ids = sorted(wikipedia_id_set)
+    try:
+        for round_ind in range(retry_num):
+            if round_ind > 0:
+                print(f'retry {len(pending_ids)} failed documents, round {round_ind}.')
+                time.sleep(retry_interval * 2 ** (round_ind - 1))
+            wikipedia_id_2_error = dict()
+            with ThreadPoolExecutor(max_workers=max(1, upsert_concurrency)) as executor:
+                future_2_id = {executor.submit(upsert_one, wikipedia_id): wikipedia_id for wikipedia_id in pending_ids}
+                for future in tqdm(as_completed(future_2_id), total=len(future_2_id)):
+                    wikipedia_id = future_2_id[future]
+                    try:
+                        wikipedia_id_2_token_used[wikipedia_id] = future.result()
+                    except Exception as e:
+                        wikipedia_id_2_error[wikipedia_id] = repr(e)
+            pending_ids = sorted(wikipedia_id_2_error)
+            if not pending_ids:
+                break
+    finally:
+        if remove_temp_doc_dir:
+            shutil.rmtree(temp_doc_dir, ignore_errors=True)
+    print(f'upsert {len(wikipedia_id_2_token_used)} documents, token used = {sum(wikipedia_id_2_token_used.values())}.')
+    if wikipedia_id_2_error:
+        print(f'{len(wikipedia_id_2_error)} documents still failed to upsert: {list(wikipedia_id_2_error)[:10]} ...')
+    return wikipedia_id_2_token_used, wikipedia_id_2_error
+
+
+def post_search(query, project_name, store_domain=STORE_DOMAIN, parrot_domain=PARROT_DOMAIN, top_k=None, rerank=None,
+                timeout=None, timer=None):
+    result_list = get_parrot_client(parrot_domain, store_domain).search(query, project_name, top_k=top_k,
+                                                                        rerank=rerank, timeout=timeout, timer=timer)
     contexts = [res['chunk_text'] for res in result_list]
     answer = 'no answer.' # mock answer
     return answer, contexts
-
-
-
-
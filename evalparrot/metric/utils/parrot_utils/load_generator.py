@@ -0,0 +1,72 @@
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ..timing import summarize_latencies
+
+LoadSample = namedtuple('LoadSample', ['query_ind', 'scheduled_time', 'send_time', 'end_time', 'result', 'error'])
+
+ARRIVAL_TYPES = ['poisson', 'uniform']
+
+
+def build_arrival_offsets(target_qps, duration, arrival='poisson', rng=None):
+    """The send time offsets in seconds of the requests of one load level, starting from 0."""
+    assert arrival in ARRIVAL_TYPES, f'arrival should be one of {ARRIVAL_TYPES}.'
+    request_num = max(1, int(round(target_qps * duration)))
+    if arrival == 'poisson':
+        rng = rng if rng is not None else np.random.default_rng()
+        intervals = rng.exponential(1.0 / target_qps, request_num)
+    else:
+        intervals = np.full(request_num, 1.0 / target_qps)
+    return np.cumsum(intervals) - intervals[0]
+
+
+def _send(request_fn, query, query_ind, scheduled_time):
+    send_time = time.perf_counter()
+    try:
+        result, error = request_fn(query), None
+    except Exception as e:
+        result, error = None, repr(e)
+    return LoadSample(query_ind, scheduled_time, send_time, time.perf_counter(), result, error)
+
+
+def run_open_loop_level(request_fn, queries, target_qps, duration, max_workers=256, arrival='poisson', rng=None):
+    """
+    Send `request_fn(query)` at the arrival times of `target_qps` for `duration` seconds, cycling over `queries`,
+    and return the list of LoadSample of all the requests.
+    The requests are sent on schedule whether or not the earlier ones have returned (open loop),
+    and the latency of a sample is counted from its scheduled time, not from when it was actually sent,
+    so a saturated service or load generator shows up in the tail latency instead of lowering the sending rate.
+    """
+    offsets = build_arrival_offsets(target_qps, duration, arrival, rng)
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        start_time = time.perf_counter()
+        for request_ind, offset in enumerate(offsets):
+            scheduled_time = start_time + offset
+            delay = scheduled_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            query_ind = request_ind % len(queries)
+            futures.append(executor.submit(_send, request_fn, queries[query_ind], query_ind, scheduled_time))
+        samples = [future.result() for future in futures]
+    return samples
+
+
+def summarize_level(samples, target_qps):
+    """Throughput, error rate and latency percentiles of the samples of one load level."""
+    start_time = min(sample.scheduled_time for sample in samples)
+    end_time = max(sample.end_time for sample in samples)
+    succeeded = [sample for sample in samples if sample.error is None]
+    return {
+        'target_qps': target_qps,
+        'requests': len(samples),
+        'errors': len(samples) - len(succeeded),
+        'error_rate': (len(samples) - len(succeeded)) / len(samples),
+        'throughput': len(succeeded) / (end_time - start_time) if end_time > start_time else 0.0,
+        'latency': summarize_latencies([sample.end_time - sample.scheduled_time for sample in succeeded]),
+        'service_time': summarize_latencies([sample.end_time - sample.send_time for sample in succeeded]),
+        'send_lag': summarize_latencies([sample.send_time - sample.scheduled_time for sample in samples]),
+    }
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .http_utils import DB_CONFIG
+
+SEARCH_CACHE_MODES = ['read_write', 'offline', 'off']
+
+
+class SearchCacheMissError(KeyError):
+    pass
+
+
+class SearchCache:
+    """
+    Persistent, content-addressed cache of parrot search results in a sqlite file.
+    A result is keyed by the hash of the query and everything that affects it, see `build_key()`,
+    and the least recently used entries are evicted when there are more than `max_entries`.
+    The access times of the hits are written in batches of `evict_every`, so a read does not commit.
+    """
+
+    def __init__(self, cache_path, max_entries=200000, evict_every=1000):
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        # several runs of one process may share the cache file, each of them waits for the others' writes
+        self._conn = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        # readers do not wait for the writer, and a commit does not fsync the file
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS search_cache '
+                           '(key TEXT PRIMARY KEY, result TEXT, last_access REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS last_access_index ON search_cache (last_access)')
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._put_num = 0
+        self._key_2_access = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def build_key(query, kb_id, manifest_hash, top_k, rerank, embedding):
+        key_str = json.dumps([query, kb_id, manifest_hash, top_k, rerank, embedding])
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT result FROM search_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._key_2_access[key] = time.time()
+            if len(self._key_2_access) >= self.evict_every:
+                self._flush_access()
+                self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?)',
+                               (key, json.dumps(result), time.time()))
+            self._put_num += 1
+            if self._put_num % self.evict_every == 0:
+                self._evict()
+            self._conn.commit()
+
+    def _flush_access(self):
+        self._conn.executemany('UPDATE search_cache SET last_access = ? WHERE key = ?',
+                               [(access, key) for key, access in self._key_2_access.items()])
+        self._key_2_access = dict()
+
+    def _evict(self):
+        self._flush_access()
+        entry_num = self._conn.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0]
+        if entry_num > self.max_entries:
+            self._conn.execute('DELETE FROM search_cache WHERE key IN '
+                               '(SELECT key FROM search_cache ORDER BY last_access LIMIT ?)',
+                               (entry_num - self.max_entries,))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._conn.commit()
+            self._conn.close()
+
+
+def search_with_cache(client, search_cache, query, project_name, manifest_hash, top_k=None, rerank=None, timeout=None,
+                      offline=False, timer=None):
+    """
+    Return the parrot search result list of `query`, served from `search_cache` when it has been searched before.
+    In offline mode parrot is never requested, and a cache miss raises SearchCacheMissError.
+    """
+    key = None
+    if search_cache is not None:
+        key = SearchCache.build_key(query, project_name, manifest_hash, top_k, rerank, DB_CONFIG['embedding'])
+        result_list = search_cache.get(key)
+        if result_list is not None:
+            return result_list
+    if offline:
+        raise SearchCacheMissError(f'no cached search result in offline mode, query = {query}')
+    result_list = client.search(query, project_name, top_k=top_k, rerank=rerank, timeout=timeout, timer=timer)
+    if search_cache is not None:
+        search_cache.put(key, result_list)
+    return result_list
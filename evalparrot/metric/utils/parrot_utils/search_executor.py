@@ -0,0 +1,54 @@
+import random
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+SearchResult = namedtuple('SearchResult', ['query', 'result', 'error', 'attempts', 'latency'])
+
+
+def search_with_retry(search_fn, query, retry_num=3, retry_backoff=1.0, max_backoff=30.0):
+    """
+    Call `search_fn(query)` at most `retry_num` times, sleeping with exponential backoff and jitter between the attempts.
+    The error of the last attempt is returned in the SearchResult instead of raised,
+    and the latency is the seconds of all the attempts.
+    """
+    error = None
+    start_time = time.perf_counter()
+    for attempt in range(1, retry_num + 1):
+        try:
+            result = search_fn(query)
+            return SearchResult(query, result, None, attempt, time.perf_counter() - start_time)
+        except Exception as e:
+            error = e
+            if attempt < retry_num:
+                backoff = min(max_backoff, retry_backoff * 2 ** (attempt - 1))
+                time.sleep(backoff * random.uniform(0.5, 1.0))
+    return SearchResult(query, None, repr(error), retry_num, time.perf_counter() - start_time)
+
+
+def _wait_result(future, timer):
+    if timer is None or future.done():
+        return future.result()
+    with timer.stage('search_wait'):
+        return future.result()
+
+
+def concurrent_search(search_fn, queries, max_concurrency=8, retry_num=3, retry_backoff=1.0, timer=None):
+    """
+    Run `search_fn` over `queries` in a thread pool with at most `max_concurrency` requests in flight,
+    and yield a SearchResult for every query in the input order.
+    With a `timer`, the depth of the window of submitted queries is sampled as the 'search_queue',
+    and the time the consumer waits for a search as the 'search_wait' stage.
+    """
+    max_concurrency = max(1, max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = deque()
+        for query in queries:
+            # keep a bounded window of submitted queries, so memory does not grow with the number of queries
+            if len(pending) >= 2 * max_concurrency:
+                yield _wait_result(pending.popleft(), timer)
+            pending.append(executor.submit(search_with_retry, search_fn, query, retry_num, retry_backoff))
+            if timer is not None:
+                timer.record_depth('search_queue', len(pending))
+        while pending:
+            yield _wait_result(pending.popleft(), timer)
@@ -0,0 +1,359 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pyarrow as pa
+
+from evalparrot.metric.retrieval_metrics import compute_per_query_retrieval_metrics, get_gold_ids_list, get_guess_ids
+
+HITS_SCHEMA = pa.schema([
+    ('query_ind', pa.int64()),
+    ('rank', pa.int32()),
+    ('wikipedia_id', pa.string()),
+    ('doc_name', pa.string()),
+    ('chunk_id', pa.int64()),
+    ('chunk_hash', pa.string()),
+    ('start_paragraph_id', pa.int32()),
+    ('end_paragraph_id', pa.int32()),
+    ('match', pa.string()),
+    ('is_gold', pa.bool_()),
+])
+
+CHUNKS_SCHEMA = pa.schema([
+    ('chunk_hash', pa.string()),
+    ('chunk_text', pa.string()),
+])
+
+
+def get_queries_schema(metric_names):
+    return pa.schema([
+        ('query_ind', pa.int64()),
+        ('id', pa.string()),
+        ('input', pa.string()),
+        ('failed', pa.bool_()),
+        ('search_latency', pa.float64()),
+    ] + [(name, pa.float64()) for name in metric_names])
+
+
+HITS_NAME = 'hits.arrow'
+CHUNKS_NAME = 'chunks.arrow'
+QUERIES_NAME = 'queries.arrow'
+RAGAS_SCORES_NAME = 'ragas_scores.arrow'
+
+
+def hash_chunk(chunk_text):
+    return hashlib.sha1(chunk_text.encode('utf-8')).hexdigest()
+
+
+class ArrowBatchWriter:
+    """
+    Stream rows into an Arrow IPC stream file in record batches of `batch_rows`, so the file can be memory mapped.
+    The batches flushed before an interruption can still be read back by `iter_record_batches`.
+    """
+
+    def __init__(self, path, schema, batch_rows=4096):
+        self.path = path
+        self.schema = schema
+        self.batch_rows = batch_rows
+        self._columns = {name: [] for name in schema.names}
+        self._row_num = 0
+        self._file = open(path, 'wb')
+        self._writer = pa.ipc.new_stream(pa.PythonFile(self._file, mode='w'), schema)
+
+    def append(self, row):
+        for name, values in self._columns.items():
+            values.append(row.get(name))
+        self._row_num += 1
+        if self._row_num >= self.batch_rows:
+            self.flush()
+
+    def write_batch(self, batch):
+        self.flush()
+        self._writer.write_batch(batch)
+
+    def flush(self):
+        if self._row_num:
+            self._writer.write_batch(pa.RecordBatch.from_pydict(self._columns, schema=self.schema))
+            self._columns = {name: [] for name in self.schema.names}
+            self._row_num = 0
+            self._file.flush()
+
+    def sync(self):
+        """Flush the buffered rows and fsync them, so they survive an interruption of the run."""
+        self.flush()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        self._file.close()
+
+
+def read_table(path):
+    """Read an Arrow IPC stream file with zero copy, the buffers of the table are memory mapped from the file."""
+    return pa.ipc.open_stream(pa.memory_map(path, 'r')).read_all()
+
+
+def iter_record_batches(path):
+    """Yield the record batches of an Arrow IPC stream file, up to the last complete one if it was interrupted."""
+    try:
+        reader = pa.ipc.open_stream(pa.memory_map(path, 'r'))
+    except (pa.ArrowInvalid, OSError):
+        return
+    while True:
+        try:
+            yield reader.read_next_batch()
+        except StopIteration:
+            return
+        except (pa.ArrowInvalid, OSError):
+            # the half-written tail of an interrupted run
+            return
+
+
+def get_kilt_metric_names(ks=(1, 5)):
+    return list(compute_per_query_retrieval_metrics([], [], ks=ks))
+
+
+class KiltResultStoreWriter:
+    """
+    Stream the per-query results of a kilt_score run into Arrow IPC stream files of `store_dir`, query by query:
+    `hits.arrow` has one row per ranked chunk of every query, with its provenance, whether it is a gold page
+    and the hash of its chunk text, `chunks.arrow` has the text of every distinct chunk once,
+    and `queries.arrow` has one row per query with its search latency and the value of every metric of `ks`.
+    The metrics are computed for `batch_rows` queries at a time, when their rows are flushed.
+    With `resume`, the chunks of the former run of `store_dir` are kept, and the rows of the queries are written again.
+    """
+
+    def __init__(self, store_dir, ks=(1, 5), resume=False, batch_rows=4096, timer=None):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.ks = ks
+        self.batch_rows = batch_rows
+        self.timer = timer
+        self.metric_names = get_kilt_metric_names(ks)
+        self.chunk_hashes = set()
+        self.query_num = 0
+        chunks_path = os.path.join(store_dir, CHUNKS_NAME)
+        former_chunks_path = chunks_path + '.former'
+        if resume and os.path.exists(chunks_path):
+            os.replace(chunks_path, former_chunks_path)
+        self._chunks_writer = ArrowBatchWriter(chunks_path, CHUNKS_SCHEMA, batch_rows)
+        if os.path.exists(former_chunks_path):
+            for batch in iter_record_batches(former_chunks_path):
+                self._chunks_writer.write_batch(batch)
+                self.chunk_hashes.update(batch.column('chunk_hash').to_pylist())
+            os.remove(former_chunks_path)
+        self._hits_writer = ArrowBatchWriter(os.path.join(store_dir, HITS_NAME), HITS_SCHEMA, batch_rows)
+        self._queries_writer = ArrowBatchWriter(os.path.join(store_dir, QUERIES_NAME),
+                                                get_queries_schema(self.metric_names), batch_rows)
+        # the rows of the queries whose metrics are not computed yet, with their guess ids and gold records
+        self._pending = []
+
+    def has_chunks(self, guess_record):
+        """Whether the text of every chunk of the guess record is in the store, e.g. when resuming from it."""
+        return all(provenance.get('meta', {}).get('chunk_hash') in self.chunk_hashes
+                   for provenance in guess_record['output'][0]['provenance'])
+
+    def add_chunk(self, chunk_hash, chunk_text):
+        if chunk_hash not in self.chunk_hashes:
+            self._chunks_writer.append({'chunk_hash': chunk_hash, 'chunk_text': chunk_text})
+            self.chunk_hashes.add(chunk_hash)
+
+    def add_chunk_batch(self, batch):
+        """Add the chunks of a record batch of `chunks.arrow`, e.g. of another store."""
+        for chunk_hash, chunk_text in zip(batch.column('chunk_hash').to_pylist(),
+                                          batch.column('chunk_text').to_pylist()):
+            self.add_chunk(chunk_hash, chunk_text)
+
+    def append(self, query_ind, guess_record, gold_record, chunk_texts=None):
+        """
+        Append the rows of one query, `chunk_texts` is the text of every chunk of the guess record,
+        it can be omitted when they are already in the store.
+        """
+        gold_ids = {gold_id for gold_ids in get_gold_ids_list(gold_record) for gold_id in gold_ids}
+        output = guess_record['output'][0]
+        for rank, provenance in enumerate(output['provenance']):
+            meta = provenance.get('meta', {})
+            if chunk_texts is not None:
+                self.add_chunk(meta['chunk_hash'], chunk_texts[rank])
+            self._hits_writer.append({
+                'query_ind': query_ind,
+                'rank': rank,
+                'wikipedia_id': provenance['wikipedia_id'],
+                'doc_name': str(meta['doc_name']) if meta.get('doc_name') is not None else None,
+                'chunk_id': meta.get('chunk_id'),
+                'chunk_hash': meta.get('chunk_hash'),
+                'start_paragraph_id': provenance.get('start_paragraph_id'),
+                'end_paragraph_id': provenance.get('end_paragraph_id'),
+                'match': meta.get('match'),
+                'is_gold': str(provenance['wikipedia_id']).strip() in gold_ids,
+            })
+        self._pending.append(({
+            'query_ind': query_ind,
+            'id': str(guess_record['id']),
+            'input': guess_record['input'],
+            'failed': output['answer'] == 'failed. please retry.',
+            'search_latency': guess_record.get('search_latency'),
+        }, get_guess_ids(guess_record), gold_record))
+        self.query_num += 1
+        if len(self._pending) >= self.batch_rows:
+            self._flush_queries()
+
+    def _flush_queries(self):
+        if not self._pending:
+            return
+        rows, guess_ids_list, gold_records = zip(*self._pending)
+        self._pending = []
+        if self.timer is None:
+            per_query_metrics = compute_per_query_retrieval_metrics(guess_ids_list, gold_records, ks=self.ks)
+        else:
+            with self.timer.stage('scoring'):
+                per_query_metrics = compute_per_query_retrieval_metrics(guess_ids_list, gold_records, ks=self.ks)
+        for ind, row in enumerate(rows):
+            for name in self.metric_names:
+                row[name] = float(per_query_metrics[name][ind])
+            self._queries_writer.append(row)
+
+    def flush_queries(self):
+        """Compute the metrics of the queries appended so far and flush their rows, so `queries.arrow` can be read."""
+        self._flush_queries()
+        self._queries_writer.flush()
+
+    def sync(self):
+        """fsync the chunks written so far, so a resumed run finds the text of the guess records written after."""
+        self._chunks_writer.sync()
+
+    def close(self):
+        self._flush_queries()
+        for writer in [self._chunks_writer, self._hits_writer, self._queries_writer]:
+            writer.close()
+        return self.store_dir
+
+
+def _column_2_numpy(table, name):
+    column = table.column(name)
+    if column.num_chunks == 1:
+        return column.chunk(0).to_numpy(zero_copy_only=False)
+    return column.to_numpy()
+
+
+def summarize_kilt_result_store(store_dir, metric_names=None):
+    """
+    Return the ordered dict of the mean of every metric over the queries of `queries.arrow`,
+    the metric columns are read as memory mapped numpy arrays.
+    The values are averaged in the query order, so the result does not depend on the order the rows were written.
+    """
+    table = read_table(os.path.join(store_dir, QUERIES_NAME))
+    if metric_names is None:
+        metric_names = [name for name in table.column_names
+                        if name not in ['query_ind', 'id', 'input', 'failed', 'search_latency']]
+    order = np.argsort(_column_2_numpy(table, 'query_ind'), kind='stable')
+    summary = OrderedDict()
+    for name in metric_names:
+        values = _column_2_numpy(table, name)[order]
+        summary[name] = float(np.mean(values)) if len(values) else 0.0
+    return summary
+
+
+def read_kilt_metric_values(store_dir, metric_names):
+    """Return the dict of metric name to the numpy array of its value of every query of `queries.arrow`."""
+    table = read_table(os.path.join(store_dir, QUERIES_NAME))
+    order = np.argsort(_column_2_numpy(table, 'query_ind'), kind='stable')
+    return {name: _column_2_numpy(table, name)[order] for name in metric_names}
+
+
+def read_chunk_texts(store_dir, chunk_hashes=None):
+    """Return the dict of chunk hash to chunk text of `chunks.arrow`, only of `chunk_hashes` when it is given."""
+    chunk_hash_2_text = dict()
+    for batch in iter_record_batches(os.path.join(store_dir, CHUNKS_NAME)):
+        for chunk_hash, chunk_text in zip(batch.column('chunk_hash').to_pylist(),
+                                          batch.column('chunk_text').to_pylist()):
+            if chunk_hashes is None or chunk_hash in chunk_hashes:
+                chunk_hash_2_text[chunk_hash] = chunk_text
+    return chunk_hash_2_text
+
+
+def summarize_kilt_hits(store_dir, get_gold_record, ks=(1, 5), top_k=None, batch_queries=4096):
+    """
+    Return the ordered dict of the mean of every kilt_score metric of `ks` over the queries of the store,
+    scored again from the hits of `hits.arrow` ranked before `top_k`, e.g. to evaluate every top_k of one search.
+    `get_gold_record` returns the kilt gold record of a query id, and every query_ind of the store should be unique.
+    The queries are scored `batch_queries` at a time.
+    """
+    queries = read_table(os.path.join(store_dir, QUERIES_NAME))
+    hits = read_table(os.path.join(store_dir, HITS_NAME))
+    query_inds = _column_2_numpy(queries, 'query_ind')
+    order = np.argsort(query_inds, kind='stable')
+    ids = queries.column('id')
+    hit_query_inds = _column_2_numpy(hits, 'query_ind')
+    if top_k is not None:
+        keep = _column_2_numpy(hits, 'rank') < top_k
+        hit_query_inds = hit_query_inds[keep]
+        hit_wikipedia_ids = hits.column('wikipedia_id').filter(pa.array(keep))
+    else:
+        hit_wikipedia_ids = hits.column('wikipedia_id')
+    # the hits of a query are written together in the rank order, so a stable sort keeps the rank order
+    hit_order = np.argsort(hit_query_inds, kind='stable')
+    sorted_hit_query_inds = hit_query_inds[hit_order]
+    hit_starts = np.searchsorted(sorted_hit_query_inds, query_inds, side='left')
+    hit_ends = np.searchsorted(sorted_hit_query_inds, query_inds, side='right')
+    metric_names = get_kilt_metric_names(ks)
+    metric_sums = np.zeros(len(metric_names), dtype=np.float64)
+    for batch_start in range(0, len(order), batch_queries):
+        batch_order = order[batch_start: batch_start + batch_queries]
+        batch_hit_rows = [hit_order[hit_starts[row_ind]: hit_ends[row_ind]] for row_ind in batch_order]
+        wikipedia_ids = hit_wikipedia_ids.take(pa.array(np.concatenate(batch_hit_rows + [np.zeros(0, np.int64)]),
+                                                        pa.int64())).to_pylist()
+        hit_bounds = np.cumsum([0] + [len(hit_rows) for hit_rows in batch_hit_rows])
+        guess_ids_list = [wikipedia_ids[hit_bounds[ind]: hit_bounds[ind + 1]] for ind in range(len(batch_order))]
+        gold_records = [get_gold_record(id_) for id_ in ids.take(pa.array(batch_order, pa.int64())).to_pylist()]
+        per_query_metrics = compute_per_query_retrieval_metrics(guess_ids_list, gold_records, ks=ks)
+        metric_sums += [np.sum(per_query_metrics[name]) for name in metric_names]
+    return OrderedDict((name, float(metric_sum / len(order)) if len(order) else 0.0)
+                       for name, metric_sum in zip(metric_names, metric_sums))
+
+
+def write_ragas_scores(store_dir, result_list):
+    """Write the per-row scores of every ragas run of `result_list` into `ragas_scores.arrow`, with a `run_ind` column."""
+    os.makedirs(store_dir, exist_ok=True)
+    tables = []
+    for run_ind, result in enumerate(result_list):
+        # the scores of a ragas Result are already an arrow backed dataset
+        scores = result.scores.with_format('arrow')[:].combine_chunks()
+        binary_columns = getattr(result, 'binary_columns', [])
+        scores = scores.append_column('run_ind', pa.array([run_ind] * scores.num_rows, pa.int64()))
+        scores = scores.replace_schema_metadata({'binary_columns': ','.join(binary_columns)})
+        tables.append(scores)
+    table = pa.concat_tables(tables)
+    with pa.OSFile(os.path.join(store_dir, RAGAS_SCORES_NAME), 'wb') as sink:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def summarize_ragas_scores(store_dir):
+    """
+    Return the dict of metric name to the mean and var of its score over the runs of `ragas_scores.arrow`,
+    the same as `calcu_mean_var()` of the ragas Results, including the harmonic mean `ragas_score`.
+    """
+    table = read_table(os.path.join(store_dir, RAGAS_SCORES_NAME))
+    binary_columns = (table.schema.metadata or {}).get(b'binary_columns', b'').decode('utf-8').split(',')
+    run_inds = table.column('run_ind').to_numpy()
+    metric_names = [name for name in table.column_names if name != 'run_ind']
+    name_2_run_scores = OrderedDict((name, []) for name in metric_names)
+    ragas_scores = []
+    for run_ind in np.unique(run_inds):
+        mask = run_inds == run_ind
+        values = []
+        for name in metric_names:
+            value = np.mean(table.column(name).to_numpy()[mask])
+            name_2_run_scores[name].append(value)
+            if name not in binary_columns:
+                values.append(value)
+        # the same harmonic mean as ragas Result
+        if len(values) > 1:
+            ragas_scores.append(len(values) / np.sum(1.0 / np.array(values)))
+    if ragas_scores:
+        name_2_run_scores['ragas_score'] = ragas_scores
+    return {name: {'mean': np.mean(scores), 'var': np.var(scores)} for name, scores in name_2_run_scores.items()}
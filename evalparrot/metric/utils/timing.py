@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+class StageTimer:
+    """
+    Thread-safe instrumentation of one evaluation run.
+    It accumulates the wall time and count of named stages, the latency samples of named calls,
+    the depth samples of named queues and plain counters like the token used,
+    and `report()` summarizes them into a json-serializable dict.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_2_wall_time = OrderedDict()
+        self.stage_2_count = OrderedDict()
+        self.call_2_latencies = OrderedDict()
+        self.queue_2_depths = OrderedDict()
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+
+    def add_stage_time(self, name, seconds):
+        with self._lock:
+            self.stage_2_wall_time[name] = self.stage_2_wall_time.get(name, 0.0) + seconds
+            self.stage_2_count[name] = self.stage_2_count.get(name, 0) + 1
+
+    def record_latency(self, name, seconds):
+        with self._lock:
+            self.call_2_latencies.setdefault(name, []).append(seconds)
+
+    def record_depth(self, name, depth):
+        with self._lock:
+            self.queue_2_depths.setdefault(name, []).append(depth)
+
+    def add_count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        with self._lock:
+            stages = OrderedDict((name, {'wall_time': wall_time, 'count': self.stage_2_count[name]})
+                                 for name, wall_time in self.stage_2_wall_time.items())
+            latency = OrderedDict((name, summarize_latencies(latencies))
+                                  for name, latencies in self.call_2_latencies.items())
+            queue_depth = OrderedDict((name, summarize_latencies(depths))
+                                      for name, depths in self.queue_2_depths.items())
+            return {
+                'stages': stages,
+                'latency': latency,
+                'queue_depth': queue_depth,
+                'counters': dict(self.counters),
+            }
+
+
+def summarize_latencies(latencies, percentiles=LATENCY_PERCENTILES):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    summary = OrderedDict(count=int(len(latencies)))
+    if len(latencies) == 0:
+        return summary
+    summary['mean'] = float(latencies.mean())
+    for percentile, value in zip(percentiles, np.percentile(latencies, percentiles)):
+        summary[f'p{percentile}'] = float(value)
+    summary['max'] = float(latencies.max())
+    return summary
+
+
+@contextmanager
+def timed_call(timer, name):
+    """Record the latency of the block as a call `name` of `timer`, failed calls are counted as `{name}_error`."""
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        timer.add_count(f'{name}_error')
+        raise
+    finally:
+        timer.record_latency(name, time.perf_counter() - start)
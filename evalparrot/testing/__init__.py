@@ -0,0 +1,2 @@
+from .stub_parrot_server import StubParrotServer
+from .kilt_fixture import InMemoryKnowledgeSource, build_synthetic_kilt_fixture
\ No newline at end of file
@@ -0,0 +1,119 @@
+import json
+import os
+import random
+import threading
+
+from evalparrot.metric.utils.dataset.kilt_data import urls
+
+DEFAULT_PAGE_DUMP_NAME = 'kilt_pages.jsonl'
+
+
+class InMemoryKnowledgeSource:
+    """
+    Stand-in of the kilt KnowledgeSource with all pages in memory, for benchmarking and testing without mongo.
+    The pages have the same fields as the kilt mongo documents, `_id`, `wikipedia_id`, `wikipedia_title` and `text`.
+    """
+
+    def __init__(self, pages):
+        self.id_2_page = {str(page['_id']): page for page in pages}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_page_dump(cls, page_dump_path):
+        with open(page_dump_path, 'r', encoding='utf-8') as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def get_page_by_id(self, wikipedia_id):
+        page = self.id_2_page.get(str(wikipedia_id))
+        with self._lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return page
+
+    def prefetch(self, wikipedia_ids):
+        pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'pages': len(self.id_2_page),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def dump_pages(pages, page_dump_path):
+    with open(page_dump_path, 'w', encoding='utf-8') as f:
+        for page in pages:
+            f.write(json.dumps(page) + '\n')
+
+
+def _random_sentence(rng, vocabulary, word_num):
+    return ' '.join(rng.choice(vocabulary) for _ in range(word_num)).capitalize() + '.'
+
+
+def build_synthetic_kilt_fixture(kilt_data_path, kilt_dataset_name='hotpotqa', query_num=200, page_num=None,
+                                 paragraphs_per_page=8, provenance_per_query=2, noise_word_num=4, vocabulary_size=5000,
+                                 seed=0):
+    """
+    Write a synthetic kilt dev jsonl of `query_num` queries and a dump of its wikipedia pages into `kilt_data_path`,
+    and return the InMemoryKnowledgeSource of the pages.
+    Every query takes its input from the words of its gold paragraphs plus `noise_word_num` random words,
+    so a lexical retriever can mostly find them.
+    The other files of the dataset are written empty, so that `download_kilt_jsonl()` finds them and does not download.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f'w{ind}' for ind in range(vocabulary_size)]
+    page_num = page_num or max(provenance_per_query, query_num * provenance_per_query // 2)
+    pages = []
+    for page_ind in range(page_num):
+        wikipedia_id = str(100000 + page_ind)
+        title = _random_sentence(rng, vocabulary, 2)[:-1]
+        text = [title + '\n'] + [' '.join(_random_sentence(rng, vocabulary, rng.randint(8, 16))
+                                          for _ in range(rng.randint(2, 5))) + '\n'
+                                 for _ in range(paragraphs_per_page - 1)]
+        pages.append({'_id': wikipedia_id, 'wikipedia_id': wikipedia_id, 'wikipedia_title': title, 'text': text})
+
+    os.makedirs(kilt_data_path, exist_ok=True)
+    data_jsonl_path = os.path.join(kilt_data_path, f'{kilt_dataset_name}-dev-kilt.jsonl')
+    for url in urls:
+        if kilt_dataset_name in url:
+            file_name = url.split('/')[-1]
+            file_path = os.path.join(kilt_data_path, file_name)
+            if 'dev' in file_name:
+                data_jsonl_path = file_path
+            else:
+                open(file_path, 'w').close()
+    with open(data_jsonl_path, 'w', encoding='utf-8') as f:
+        for query_ind in range(query_num):
+            provenance = []
+            input_words = []
+            for page in rng.sample(pages, provenance_per_query):
+                paragraph_id = rng.randint(1, paragraphs_per_page - 1)
+                paragraph = page['text'][paragraph_id]
+                provenance.append({
+                    'wikipedia_id': page['wikipedia_id'],
+                    'title': page['wikipedia_title'],
+                    'start_paragraph_id': paragraph_id,
+                    'start_character': 0,
+                    'end_paragraph_id': paragraph_id,
+                    'end_character': len(paragraph),
+                    'bleu_score': 1.0,
+                })
+                words = paragraph.replace('.', '').split()
+                input_words += rng.sample(words, min(6, len(words)))
+            input_words += [rng.choice(vocabulary) for _ in range(noise_word_num)]
+            rng.shuffle(input_words)
+            f.write(json.dumps({
+                'id': f'synthetic_{query_ind}',
+                'input': ' '.join(input_words) + '?',
+                'output': [{'answer': 'no answer', 'provenance': provenance}],
+            }) + '\n')
+    dump_pages(pages, os.path.join(kilt_data_path, DEFAULT_PAGE_DUMP_NAME))
+    return InMemoryKnowledgeSource(pages)
@@ -0,0 +1,191 @@
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def split_chunks(text, chunk_size=1000):
+    """Split a document into chunks of whole lines, each of them at most `chunk_size` characters unless a line is longer."""
+    chunks = []
+    current = ''
+    for line in text.split('\n'):
+        if not line.strip():
+            continue
+        if current and len(current) + len(line) + 1 > chunk_size:
+            chunks.append(current)
+            current = ''
+        current = current + '\n' + line if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class LexicalIndex:
+    """BM25 index of the chunks of the documents of one kb, rebuilt lazily at the first search after a change."""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_name_2_chunks = dict()
+        self._dirty = True
+
+    def _build(self):
+        self.chunks = []
+        self.term_counts = []
+        for doc_name, chunks in self.doc_name_2_chunks.items():
+            for chunk_id, (chunk_text, term_count) in enumerate(chunks):
+                self.chunks.append((doc_name, chunk_id, chunk_text))
+                self.term_counts.append(term_count)
+        self.lengths = [sum(term_count.values()) for term_count in self.term_counts]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.term_2_chunk_inds = defaultdict(list)
+        for chunk_ind, term_count in enumerate(self.term_counts):
+            for term in term_count:
+                self.term_2_chunk_inds[term].append(chunk_ind)
+        self._dirty = False
+
+    def upsert(self, doc_name, chunk_texts):
+        self.doc_name_2_chunks[doc_name] = [(chunk_text, Counter(tokenize(chunk_text))) for chunk_text in chunk_texts]
+        self._dirty = True
+
+    def delete(self, doc_name):
+        self.doc_name_2_chunks.pop(doc_name, None)
+        self._dirty = True
+
+    def search(self, query, top_k=10):
+        if self._dirty:
+            self._build()
+        chunk_num = len(self.chunks)
+        chunk_ind_2_score = defaultdict(float)
+        for term in set(tokenize(query)):
+            chunk_inds = self.term_2_chunk_inds.get(term, [])
+            if not chunk_inds:
+                continue
+            idf = math.log(1 + (chunk_num - len(chunk_inds) + 0.5) / (len(chunk_inds) + 0.5))
+            for chunk_ind in chunk_inds:
+                tf = self.term_counts[chunk_ind][term]
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_ind] / self.avg_length)
+                chunk_ind_2_score[chunk_ind] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(chunk_ind_2_score.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        return [{'doc_name': self.chunks[chunk_ind][0],
+                 'chunk_id': self.chunks[chunk_ind][1],
+                 'chunk_text': self.chunks[chunk_ind][2]} for chunk_ind, _ in ranked]
+
+
+class StubParrotServer:
+    """
+    Local stand-in of the parrot service, for benchmarking and testing evalparrot without parrot and milvus.
+    It implements the db create/delete, document upsert/delete and search apis used by `ParrotClient`,
+    the documents are chunked by lines and searched with a BM25 lexical retriever, all in memory.
+    `search_latency` and `upsert_latency` seconds are added to every such request,
+    randomly scaled by up to `latency_jitter` of it, to mimic the service time of a real parrot.
+    Use it as a context manager, or call `start()` and `stop()`, and pass `address` as the parrot_service_address.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, search_latency=0.0, upsert_latency=0.0, latency_jitter=0.0,
+                 chunk_size=1000):
+        self.search_latency = search_latency
+        self.upsert_latency = upsert_latency
+        self.latency_jitter = latency_jitter
+        self.chunk_size = chunk_size
+        self.kb_id_2_index = dict()
+        self.api_2_count = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _sleep(self, latency):
+        if latency > 0:
+            time.sleep(latency * (1 + random.uniform(-self.latency_jitter, self.latency_jitter)))
+
+    def _get_index(self, db_config):
+        index = self.kb_id_2_index.get(db_config['kb_id'])
+        assert index is not None, f'kb {db_config["kb_id"]} does not exist.'
+        return index
+
+    def handle(self, api, body):
+        """Return the `data` of the response of `api`, or raise if the request fails."""
+        with self._lock:
+            self.api_2_count[api] += 1
+        if api == '/api/v1/db/create':
+            with self._lock:
+                self.kb_id_2_index.setdefault(body['db_config']['kb_id'], LexicalIndex())
+            return True
+        if api == '/api/v1/db/delete':
+            with self._lock:
+                assert self.kb_id_2_index.pop(body['kb_id'], None) is not None, f'kb {body["kb_id"]} does not exist.'
+            return True
+        if api == '/api/v1/document/upsert':
+            self._sleep(self.upsert_latency)
+            with open(body['source'], 'r') as f:
+                text = f.read()
+            chunk_texts = split_chunks(text, self.chunk_size)
+            with self._lock:
+                self._get_index(body['db_config']).upsert(body['doc_name'], chunk_texts)
+            return max(1, len(tokenize(text)))
+        if api == '/api/v1/document/delete':
+            with self._lock:
+                self._get_index(body['db_config']).delete(body['doc_name'])
+            return True
+        if api == '/api/v1/search':
+            self._sleep(self.search_latency)
+            with self._lock:
+                return self._get_index(body['db_config']).search(body['query'], body['search_param']['top_k'] or 10)
+        raise KeyError(f'unknown api {api}')
+
+    def _build_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                try:
+                    status, response = 200, {'data': server.handle(self.path, body)}
+                except KeyError as e:
+                    status, response = 404, {'error': str(e)}
+                except Exception as e:
+                    status, response = 500, {'error': repr(e)}
+                response_bytes = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response_bytes)))
+                self.end_headers()
+                self.wfile.write(response_bytes)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -16,5 +16,9 @@ setup(name='evalparrot',
           "langchain",
           "tqdm",
           "numpy",
+          "pyarrow",
       ],
+      entry_points={
+          'console_scripts': ['evalparrot=evalparrot.__main__:main'],
+      },
       )
@@ -0,0 +1,20 @@
+import pytest
+
+from evalparrot.testing import StubParrotServer, build_synthetic_kilt_fixture
+
+
+@pytest.fixture(scope='session')
+def stub_parrot():
+    with StubParrotServer() as server:
+        yield server
+
+
+@pytest.fixture
+def kilt_fixture(tmp_path, monkeypatch):
+    # eval_parrot_kilt reads and writes under the working dir, ./datasets/kilt_data and ./outputs/kilt
+    monkeypatch.chdir(tmp_path)
+
+    def build(query_num):
+        return build_synthetic_kilt_fixture('./datasets/kilt_data', 'hotpotqa', query_num=query_num)
+
+    return build
@@ -0,0 +1,129 @@
+"""
+Regression tests of `eval_parrot_kilt` run offline, against the bundled stub parrot server and a synthetic kilt fixture.
+"""
+import json
+import os
+
+import pytest
+
+from evalparrot import eval_parrot_kilt, eval_parrot_kilt_top_k_sweep, merge_parrot_kilt_shards
+from evalparrot.evaluate_parrot_kilt import prepare_kilt_run
+from evalparrot.metric.utils.checkpoint import ResumableJsonlWriter
+from evalparrot.metric.utils.result_store import read_table
+
+QUERY_NUM = 20
+
+
+def _metrics(eval_result):
+    return {name: value for name, value in eval_result.items() if isinstance(value, (int, float))}
+
+
+def _read_guess_records(result_name):
+    with open(f'./outputs/kilt/{result_name}/guess_output.jsonl', 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+def _run(stub_parrot, knowledge_source, result_name, **kwargs):
+    kwargs.setdefault('search_cache_mode', 'off')
+    return eval_parrot_kilt(parrot_service_address=stub_parrot.address, result_name=result_name,
+                            pre_query_num=QUERY_NUM, knowledge_source=knowledge_source, match_workers=0, **kwargs)
+
+
+def test_resume_after_torn_guess_output(stub_parrot, kilt_fixture):
+    knowledge_source = kilt_fixture(QUERY_NUM)
+    eval_result = _run(stub_parrot, knowledge_source, 'torn')
+    guess_output_path = './outputs/kilt/torn/guess_output.jsonl'
+    with open(guess_output_path, 'r+b') as f:
+        # cut the last record in the middle, as an interrupted write leaves it
+        f.truncate(os.path.getsize(guess_output_path) - 20)
+
+    resumed_result = _run(stub_parrot, knowledge_source, 'torn')
+    assert resumed_result['timing']['counters']['queries'] == 1
+    assert _metrics(resumed_result) == pytest.approx(_metrics(eval_result))
+    assert len(_read_guess_records('torn')) == QUERY_NUM
+
+
+def test_warm_rerun_served_from_search_cache(stub_parrot, kilt_fixture):
+    knowledge_source = kilt_fixture(QUERY_NUM)
+    cache_kwargs = dict(resume=False, search_cache_mode='read_write', search_cache_path='./outputs/search_cache.sqlite')
+    eval_result = _run(stub_parrot, knowledge_source, 'warm', **cache_kwargs)
+    assert eval_result['timing']['search_cache']['misses'] == QUERY_NUM
+
+    warm_result = _run(stub_parrot, knowledge_source, 'warm', **cache_kwargs)
+    assert warm_result['timing']['search_cache']['hits'] == QUERY_NUM
+    assert warm_result['timing']['search_cache']['misses'] == 0
+    assert _metrics(warm_result) == pytest.approx(_metrics(eval_result))
+
+
+def test_top_k_sweep_matches_standalone_runs(stub_parrot, kilt_fixture):
+    knowledge_source = kilt_fixture(QUERY_NUM)
+    top_k_list = [1, 3, 5]
+    sweep_result = eval_parrot_kilt_top_k_sweep(parrot_service_address=stub_parrot.address, result_name='sweep',
+                                                top_k_list=top_k_list, pre_query_num=QUERY_NUM,
+                                                knowledge_source=knowledge_source, search_cache_mode='off',
+                                                match_workers=0, ks=[1, 3, 5])
+    for top_k in top_k_list:
+        eval_result = _run(stub_parrot, knowledge_source, 'sweep', top_k=top_k, resume=False, ks=[1, 3, 5])
+        assert sweep_result['no_rerank'][f'top_{top_k}'] == pytest.approx(_metrics(eval_result)), top_k
+
+
+def test_provenance_match_doc_name_and_fuzzy(stub_parrot, kilt_fixture):
+    knowledge_source = kilt_fixture(QUERY_NUM)
+    multi_result = _run(stub_parrot, knowledge_source, 'match_multi', doc_gen_type='multi')
+    single_result = _run(stub_parrot, knowledge_source, 'match_single', doc_gen_type='single')
+
+    for result_name, match in [('match_multi', 'doc_name'), ('match_single', 'fuzzy')]:
+        for guess_record in _read_guess_records(result_name):
+            provenance_list = guess_record['output'][0]['provenance']
+            assert provenance_list
+            assert all(provenance['meta']['match'] == match for provenance in provenance_list)
+            if match == 'doc_name':
+                # a document of the 'multi' corpus is a whole wikipedia page named by its wikipedia_id
+                assert all(provenance['wikipedia_id'] == provenance['meta']['doc_name']
+                           for provenance in provenance_list)
+    # the fuzzy matching is only the fallback, the exact doc_name provenance can not do worse
+    assert multi_result['recall@5'] > 0.9
+    assert 0.8 < single_result['recall@5'] <= multi_result['recall@5']
+
+
+def test_merged_shards_match_unsharded_run(stub_parrot, kilt_fixture):
+    knowledge_source = kilt_fixture(QUERY_NUM)
+    eval_result = _run(stub_parrot, knowledge_source, 'unsharded')
+
+    prepare_kilt_run(parrot_service_address=stub_parrot.address, result_name='sharded', pre_query_num=QUERY_NUM,
+                     knowledge_source=knowledge_source)
+    for shard_ind in range(3):
+        _run(stub_parrot, knowledge_source, 'sharded', shard=f'{shard_ind}/3')
+    merged_result = merge_parrot_kilt_shards(result_name='sharded')
+    assert _metrics(merged_result) == _metrics(eval_result)
+    # the per-query rows of the merged result store are the same as well, but for the search latency
+    merged_queries = read_table('./outputs/kilt/sharded/results/queries.arrow').drop(['search_latency'])
+    queries = read_table('./outputs/kilt/unsharded/results/queries.arrow').drop(['search_latency'])
+    assert merged_queries.sort_by('query_ind').equals(queries.sort_by('query_ind'))
+
+
+def test_adaptive_batches_write_only_their_queries(stub_parrot, kilt_fixture, monkeypatch):
+    knowledge_source = kilt_fixture(QUERY_NUM)
+    finalize_num = 0
+    finalize = ResumableJsonlWriter.finalize
+
+    def counted_finalize(self, key_order):
+        nonlocal finalize_num
+        finalize_num += 1
+        return finalize(self, key_order)
+
+    monkeypatch.setattr(ResumableJsonlWriter, 'finalize', counted_finalize)
+    adaptive_kwargs = dict(adaptive_target_width=0.0, adaptive_batch_size=6, adaptive_min_queries=6)
+    eval_result = _run(stub_parrot, knowledge_source, 'adaptive', **adaptive_kwargs)
+    assert eval_result['adaptive']['query_num'] == QUERY_NUM
+    assert len(eval_result['adaptive']['history']) == 4
+    # the guess records are rewritten once at the end, not after every batch
+    assert finalize_num == 1
+    query_inds = read_table('./outputs/kilt/adaptive/results/queries.arrow').column('query_ind').to_pylist()
+    assert sorted(query_inds) == list(range(QUERY_NUM))
+    assert len(_read_guess_records('adaptive')) == QUERY_NUM
+
+    resumed_result = _run(stub_parrot, knowledge_source, 'adaptive', **adaptive_kwargs)
+    assert resumed_result['timing']['counters'].get('queries', 0) == 0
+    assert _metrics(resumed_result) == _metrics(eval_result)
+    assert resumed_result['adaptive']['confidence_intervals'] == eval_result['adaptive']['confidence_intervals']
@@ -0,0 +1,182 @@
+"""
+Pin the parity of `compute_retrieval_metrics` with KILT's `kilt.eval_retrieval`.
+The expected values are worked out by KILT's get_rank, rprecision and compute,
+and are also checked against the copy of them below, on the hand-built queries and on random ones.
+"""
+import random
+
+import pytest
+
+from evalparrot.metric.retrieval_metrics import compute_per_query_retrieval_metrics, compute_retrieval_metrics, \
+    get_rank, rprecision
+
+KS = (1, 2, 3, 10)
+
+
+def _gold(id_, *evidence_sets):
+    return {'id': id_, 'output': [{'provenance': [{'wikipedia_id': page} for page in evidence_set]}
+                                  for evidence_set in evidence_sets]}
+
+
+def _guess(id_, guess_ids):
+    return {'id': id_, 'output': [{'provenance': [{'wikipedia_id': guess_id} for guess_id in guess_ids]}]}
+
+
+GOLD_LIST = [
+    # one evidence set of two pages, completed after an unrelated page
+    _gold('q0', ['A', 'B']),
+    # two alternative evidence sets, one of them given twice
+    _gold('q1', ['C'], ['D'], ['C']),
+    _gold('q2', ['F']),
+    # a page shared by a two-page and a one-page evidence set
+    _gold('q3', ['G', 'H'], ['G']),
+]
+GUESS_IDS_LIST = [
+    ['A', 'X', 'B'],
+    # duplicated guess ids count once
+    ['C', 'C', 'E', 'D'],
+    # empty guess
+    [],
+    # fewer guesses than k
+    ['G'],
+]
+
+EXPECTED_PER_QUERY = {
+    'Rprec': [0.5, 1.0, 0.0, 1.0],
+    'precision@1': [0.0, 1.0, 0.0, 0.0],
+    # the evidence set of q0 is one point of the rank, placed at its last page B, after the unrelated X
+    'precision@2': [0.5, 0.5, 0.0, 0.5],
+    'recall@2': [1.0, 0.5, 0.0, 0.5],
+    'success_rate@2': [1.0, 1.0, 0.0, 1.0],
+    'precision@3': [1 / 3, 2 / 3, 0.0, 1 / 3],
+    'recall@3': [1.0, 1.0, 0.0, 0.5],
+    'success_rate@3': [1.0, 1.0, 0.0, 1.0],
+    'precision@10': [0.1, 0.2, 0.0, 0.1],
+    'recall@10': [1.0, 1.0, 0.0, 0.5],
+    'success_rate@10': [1.0, 1.0, 0.0, 1.0],
+}
+
+
+def test_get_rank_and_rprecision():
+    assert get_rank(['A', 'X', 'B'], GOLD_LIST[0]) == ([False, True], 1)
+    assert get_rank(['C', 'C', 'E', 'D'], GOLD_LIST[1]) == ([True, False, True], 2)
+    assert get_rank([], GOLD_LIST[2]) == ([], 0)
+    assert get_rank(['G'], GOLD_LIST[3]) == (['evidence_set:0', True], 2)
+    assert [rprecision(guess_ids, gold) for guess_ids, gold in zip(GUESS_IDS_LIST, GOLD_LIST)] == \
+        EXPECTED_PER_QUERY['Rprec']
+
+
+def test_per_query_metrics_match_kilt():
+    per_query_metrics = compute_per_query_retrieval_metrics(GUESS_IDS_LIST, GOLD_LIST, ks=KS)
+    for name, expected in EXPECTED_PER_QUERY.items():
+        assert per_query_metrics[name].tolist() == pytest.approx(expected), name
+
+
+def test_aggregate_metrics_match_kilt():
+    metrics = compute_retrieval_metrics(GUESS_IDS_LIST, GOLD_LIST, ks=KS)
+    for name, expected in EXPECTED_PER_QUERY.items():
+        assert metrics[name] == pytest.approx(sum(expected) / len(expected)), name
+
+
+# The oracle below is kilt.eval_retrieval (github.com/facebookresearch/KILT) reduced to the wikipedia_id rank key.
+# It ranks all the guess ids and takes the first k points of the rank, k only sizes the metrics.
+
+
+def _kilt_get_ids_list(datapoint):
+    ids_list = []
+    for output in datapoint['output']:
+        current_ids_list = []
+        if 'provenance' in output:
+            for provenance in output['provenance']:
+                if 'wikipedia_id' in provenance:
+                    current_ids_list.append(str(provenance['wikipedia_id']).strip())
+        ids_list.append(list(dict.fromkeys(current_ids_list)))
+    return ids_list
+
+
+def _kilt_get_rank(guess_item, gold_item):
+    guess_ids = _kilt_get_ids_list(guess_item)[0]
+    rank = []
+    num_distinct_evidence_sets = 0
+    if len(guess_ids) > 0:
+        evidence_sets = []
+        for output in gold_item['output']:
+            if 'provenance' in output:
+                e_set = {str(provenance['wikipedia_id']).strip() for provenance in output['provenance']}
+                if e_set not in evidence_sets:
+                    evidence_sets.append(e_set)
+        num_distinct_evidence_sets = len(evidence_sets)
+        for guess_id in guess_ids:
+            found = False
+            for idx, e_set in enumerate(evidence_sets):
+                e_set_id = 'evidence_set:{}'.format(idx)
+                if guess_id in e_set:
+                    found = True
+                    if e_set_id in rank:
+                        rank.remove(e_set_id)
+                    e_set.remove(guess_id)
+                    if len(e_set) == 0:
+                        rank.append(True)
+                    else:
+                        rank.append(e_set_id)
+            if not found:
+                rank.append(False)
+    return rank, num_distinct_evidence_sets
+
+
+def _kilt_rprecision(guess_item, gold_item):
+    guess_ids = _kilt_get_ids_list(guess_item)[0]
+    rprec_list = []
+    for gold_ids in _kilt_get_ids_list(gold_item):
+        r = len(gold_ids)
+        num = sum(1 for prediction in guess_ids[:r] if prediction in gold_ids)
+        rprec_list.append(num / r if r > 0 else 0)
+    return max(rprec_list)
+
+
+def _kilt_compute(gold_dataset, guess_dataset, ks):
+    result = {'Rprec': 0.0}
+    for k in ks:
+        result[f'precision@{k}'] = 0.0
+        if k > 1:
+            result[f'recall@{k}'] = 0.0
+            result[f'success_rate@{k}'] = 0.0
+    for guess_item, gold_item in zip(guess_dataset, gold_dataset):
+        for k in ks:
+            rank, num_distinct_evidence_sets = _kilt_get_rank(guess_item, gold_item)
+            if num_distinct_evidence_sets > 0:
+                result[f'precision@{k}'] += rank[:k].count(True) / k
+                if k > 1:
+                    result[f'recall@{k}'] += rank[:k].count(True) / num_distinct_evidence_sets
+                    result[f'success_rate@{k}'] += 1 if True in rank[:k] else 0
+        result['Rprec'] += _kilt_rprecision(guess_item, gold_item)
+    return {name: value / len(guess_dataset) for name, value in result.items()}
+
+
+def _random_queries(query_num, seed=0):
+    rnd = random.Random(seed)
+    pages = [str(ind) for ind in range(12)]
+    gold_list, guess_ids_list = [], []
+    for ind in range(query_num):
+        evidence_sets = [rnd.sample(pages, rnd.randint(1, 3)) for _ in range(rnd.randint(1, 3))]
+        gold_list.append(_gold(f'r{ind}', *evidence_sets))
+        guess_ids_list.append([rnd.choice(pages) for _ in range(rnd.randint(0, 8))])
+    return gold_list, guess_ids_list
+
+
+@pytest.mark.parametrize('gold_list, guess_ids_list', [(GOLD_LIST, GUESS_IDS_LIST), _random_queries(500)])
+def test_against_kilt_oracle(gold_list, guess_ids_list):
+    guess_list = [_guess(gold['id'], guess_ids) for gold, guess_ids in zip(gold_list, guess_ids_list)]
+    expected = _kilt_compute(gold_list, guess_list, KS)
+    metrics = compute_retrieval_metrics(guess_ids_list, gold_list, ks=KS)
+    for name, value in expected.items():
+        assert metrics[name] == pytest.approx(value), name
+
+
+def test_against_installed_kilt():
+    eval_retrieval = pytest.importorskip('kilt.eval_retrieval')
+    guess_list = [_guess(gold['id'], guess_ids) for gold, guess_ids in zip(GOLD_LIST, GUESS_IDS_LIST)]
+    expected = eval_retrieval.compute(GOLD_LIST, guess_list, ks=list(KS), rank_keys=['wikipedia_id'])
+    metrics = compute_retrieval_metrics(GUESS_IDS_LIST, GOLD_LIST, ks=KS)
+    for name, value in expected.items():
+        assert metrics[name] == pytest.approx(value), name